@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 import os
+import time
 import yaml
 import aws_cdk as cdk
 
+synth_started = time.perf_counter()
+
 from aws_serverless_ops.serverless_ops_tasks import ServerlessOpsTasks
 
 # The core stacks we'll create
 from aws_serverless_ops.api_gateway import ServerlessOpsApi
 from aws_serverless_ops.ecs_cluster import ServerlessOpsEcs
+from aws_serverless_ops import asset_cache
 
 # Place referenced common settings in settings.yml
 with open('settings.yml', 'r') as file:
@@ -31,6 +35,7 @@ app = cdk.App()
 # If you have an existing cluster and/or APIGW, you can replace these with a lookup
 # call to query your environment and return the object, to then pass to the tasks.
 ops_api = ServerlessOpsApi(app, "ServerlessOpsApi",
+    throttling = settings.get('api', {}).get('throttling'),
     # The env declarations are taken from the current CLI configuration
     # See login.sh for how I prep my environment before running cdk commands
     env=cdk.Environment(account=os.getenv('CDK_DEFAULT_ACCOUNT'), region=os.getenv('CDK_DEFAULT_REGION'))
@@ -40,10 +45,12 @@ ops_cluster = ServerlessOpsEcs(app, "ServerlessOpsCluster",
     target_vpc = settings['global']['target_vpc']
 )
 
-# We'll create one stack for all tasks and define the tasks themselves as NestedStacks
+# We'll create one stack for all tasks and define the tasks themselves inside NestedStacks
 # There are two main benefits here:
 # 1. In the event we have many tasks, each CloudFormation stack can only have 500 resources,
-#    but a nested stack only counts as one in the main stack.
+#    but a nested stack only counts as one in the main stack. The task registry (task_registry.py)
+#    gives each task from settings.yml its own nested stack, or packs them into as many shared ones as
+#    needed to stay under that, and CloudFormation deploys the nested stacks in parallel.
 # 2. If we create each task as its own stack, we have to specify which to deploy and they'll each
 #    show individually in the CloudFormation console. This might be desired in some cases, but not
 #    for this demo
@@ -57,3 +64,6 @@ ops_tasks = ServerlessOpsTasks(app, "ServerlessOpsTasksStack",
 
 
 app.synth()
+
+# How long each asset took and whether it came from the cache (see asset_cache.py), on stderr
+asset_cache.report(time.perf_counter() - synth_started)
@@ -8,6 +8,7 @@ from constructs import Construct
 class ServerlessOpsApi(Stack):
 
     def __init__(self, scope: Construct, construct_id: str, 
+        throttling = None, # Dict: optional per-method stage throttling, i.e. {"/db/backup/POST": {"rate_limit": 50, "burst_limit": 500}}
         **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
@@ -30,7 +31,15 @@ class ServerlessOpsApi(Stack):
                     response_length = True,
                     status = True,
                     user = True
-                )
+                ),
+                # Requests a second (and burst) per method before API Gateway answers 429, the account's limits otherwise.
+                # See benchmarks/load_control_plane.py for what the submission path behind POST /db/backup can take
+                method_options = {
+                    path: api_gw.MethodDeploymentOptions(
+                        throttling_rate_limit = limits.get('rate_limit'),
+                        throttling_burst_limit = limits.get('burst_limit')
+                    ) for path, limits in (throttling or {}).items()
+                }
             )
         )
         
@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import shutil
+import fnmatch
+import hashlib
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+import jsii
+from aws_cdk import (
+    AssetHashType,
+    BundlingOptions,
+    ILocalBundling,
+    aws_lambda as _lambda,
+)
+
+"""
+Keeping `cdk synth` fast: assets are only rebuilt when their inputs change.
+
+- Lambda functions (python_function_code): the asset hash is a hash of the inputs, i.e. the
+  source files, requirements.txt and the runtime, instead of the bundled output. Bundling runs
+  locally without Docker (pip downloads Lambda-compatible wheels into the bundle) and the result
+  is kept in a cache directory keyed by that hash, so an unchanged function is a copy. Docker is
+  only used when local bundling can't work (i.e. a dependency without a manylinux wheel), and
+  then only when the inputs changed: cdk.out already holds the asset for a known custom hash.
+- Docker images (EXCLUDES on DockerImageAsset/from_image_asset): the image isn't built at synth,
+  it's fingerprinted, and at deploy it's only built/pushed when ECR doesn't have that hash yet.
+  Leaving out files that aren't build inputs (bytecode, test caches) keeps the hash, and so the
+  image, the same after a test run. The Dockerfile (and its FROM line) is part of the hash; pin
+  the base image by digest to have base image updates change it too.
+
+Every asset's time is printed to stderr at the end of the synth (report()), along with whether
+it was a cache hit. The cache lives in ASSET_CACHE_DIR (default ~/.cache/serverless-ops-assets),
+cache it between CI runs to get the same speed there; delete it to force a rebuild.
+"""
+
+# Never inputs to a build
+EXCLUDES = ["__pycache__", "*.pyc", ".pytest_cache", ".mypy_cache", ".ruff_cache", "*.egg-info"]
+
+CACHE_DIR = os.environ.get("ASSET_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "serverless-ops-assets")
+
+# Lambda's default architecture
+PIP_PLATFORM = "manylinux2014_x86_64"
+
+timings = []
+_hashes = {}
+
+
+def excluded(relative_path):
+    return any(fnmatch.fnmatch(part, pattern) for part in relative_path.split(os.sep) for pattern in EXCLUDES)
+
+
+def input_files(directory):
+    """The asset's input files, relative to directory, sorted"""
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not excluded(name))
+        for name in files:
+            relative = os.path.relpath(os.path.join(root, name), directory)
+            if not excluded(relative):
+                found.append(relative)
+    return sorted(found)
+
+
+def input_hash(directory, extra = ()):
+    """sha256 over every input file's path and content, plus extra strings (runtime, build options)"""
+    memo_key = (os.path.abspath(directory), tuple(extra))
+    if memo_key not in _hashes:
+        digest = hashlib.sha256()
+        for value in extra:
+            digest.update(b"extra\0" + str(value).encode() + b"\0")
+        for relative in input_files(directory):
+            digest.update(b"file\0" + relative.encode() + b"\0")
+            with open(os.path.join(directory, relative), "rb") as file:
+                for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        _hashes[memo_key] = digest.hexdigest()
+    return _hashes[memo_key]
+
+
+@contextmanager
+def timed(label, detail = ""):
+    started = time.perf_counter()
+    result = {"detail": detail}
+    try:
+        yield result
+    finally:
+        timings.append((label, time.perf_counter() - started, result["detail"]))
+
+
+@jsii.implements(ILocalBundling)
+class LocalPythonBundling:
+    """pip + copy on this machine, with the result cached by input hash (see the module notes)"""
+
+    def __init__(self, directory, python_version, asset_hash):
+        self.directory = directory
+        self.python_version = python_version
+        self.asset_hash = asset_hash
+
+    def build(self, target):
+        requirements = os.path.join(self.directory, "requirements.txt")
+        if os.path.exists(requirements):
+            # Wheels for Lambda's platform and Python, whatever this machine runs
+            subprocess.run([sys.executable, "-m", "pip", "install", "--quiet", "--disable-pip-version-check", "--no-compile",
+                "-r", requirements, "--target", target, "--platform", PIP_PLATFORM, "--implementation", "cp",
+                "--python-version", self.python_version, "--only-binary=:all:"], check = True)
+        for relative in input_files(self.directory):
+            destination = os.path.join(target, relative)
+            os.makedirs(os.path.dirname(destination), exist_ok = True)
+            shutil.copy2(os.path.join(self.directory, relative), destination)
+
+    def try_bundle(self, output_dir, options):
+        cached = os.path.join(CACHE_DIR, self.asset_hash)
+        with timed("bundle " + self.directory) as result:
+            if os.path.isdir(cached):
+                result["detail"] = "cache hit " + self.asset_hash[:12]
+            else:
+                os.makedirs(CACHE_DIR, exist_ok = True)
+                building = tempfile.mkdtemp(dir = CACHE_DIR, prefix = ".building-")
+                try:
+                    self.build(building)
+                except (subprocess.CalledProcessError, OSError) as e:
+                    shutil.rmtree(building, ignore_errors = True)
+                    result["detail"] = "local bundling failed (" + str(e) + "), using Docker"
+                    return False
+                # Rename into place, so an interrupted build is never mistaken for a cached one
+                try:
+                    os.rename(building, cached)
+                except OSError:
+                    shutil.rmtree(building, ignore_errors = True)  # a parallel synth got there first
+                result["detail"] = "built " + self.asset_hash[:12]
+            shutil.copytree(cached, output_dir, dirs_exist_ok = True)
+        return True
+
+
+def python_function_code(directory, runtime):
+    """Code for a pure-Python Lambda function in directory (requirements.txt optional), hashed and bundled as above"""
+    python_version = runtime.name.replace("python", "")
+    asset_hash = input_hash(directory, extra = [runtime.name, PIP_PLATFORM])
+    return _lambda.Code.from_asset(directory,
+        asset_hash = asset_hash,
+        asset_hash_type = AssetHashType.CUSTOM,
+        exclude = EXCLUDES,
+        bundling = BundlingOptions(
+            image = runtime.bundling_image,
+            command = ["bash", "-c", "(test ! -f requirements.txt || pip install --no-cache-dir -r requirements.txt -t /asset-output)"
+                " && cp -au . /asset-output"],
+            local = LocalPythonBundling(directory, python_version, asset_hash)
+        )
+    )
+
+
+def report(total_seconds = None):
+    """Print the assets' timings (and the whole synth's) to stderr"""
+    for label, seconds, detail in timings:
+        print("[assets] %-40s %7.2fs  %s" % (label, seconds, detail), file = sys.stderr)
+    if total_seconds is not None:
+        print("[assets] %-40s %7.2fs" % ("synth", total_seconds), file = sys.stderr)
@@ -1,12 +1,14 @@
 from aws_cdk import(
     Stack,
+    aws_iam as iam,
     aws_ssm as ssm,
 )
 from constructs import Construct
+import json
 
-# For each task, create a NestedStack in the tasks subfolder and import here
-from aws_serverless_ops.tasks.task_ecs_mysqlworker import MySqlWorker
-from aws_serverless_ops.tasks.task_lambda_mysql_user import MySqlUsersLambda
+# Tasks are declared in settings.yml (tasks: section, module/class per task) and built by the
+# registry, which only imports the task modules it needs and packs the tasks into NestedStacks
+from aws_serverless_ops.task_registry import TaskRegistry, DEFAULT_MAX_RESOURCES
 
 class ServerlessOpsTasks(Stack):
 
@@ -17,48 +19,67 @@ class ServerlessOpsTasks(Stack):
         **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
-        # Create the mysql worker task (db backup, restore)
+        # Create the tasks listed in settings.yml (mysql worker for db backup/restore, mysql user lambda, ...)
+        # Each task is a NestedStack of its own, or shares a shard NestedStack sized to stay under CloudFormation's
+        # 500 resources per stack ("shard:" in settings.yml)
         # Todo: have task self-update rights to Parameter Store /serverlessops/databases
-        task_mysqlworker = MySqlWorker(self, settings['tasks']['fargate']['mysql_worker']['name'],
+        registry = TaskRegistry(settings['tasks'],
+            max_resources = settings.get('task_shards', {}).get('max_resources', DEFAULT_MAX_RESOURCES)
+        )
+        self.tasks = registry.build(self,
             # Referencing the cluster and api created via the core stacks above
             # See "Accessing resources in a different stack" from https://docs.aws.amazon.com/cdk/v2/guide/resources.html
             ops_cluster = ops_ecs_cluster,
             ops_api = ops_apigateway,
-            docker_path = settings['tasks']['fargate']['mysql_worker']['image_path'],
-            #ssm_keybase = "/serverlessops/databases"
+            settings = settings
         )
+        parameter_readers = [role for task in self.tasks.values() for role in task.parameter_readers]
 
-        # Create the mysql user lambda (add new user)
-        task_mysqluser = MySqlUsersLambda(self, settings['tasks']['lambda']['mysql_users']['name'],
-            asset_path = settings['tasks']['lambda']['mysql_users']['asset_path'],
-            function_code = settings['tasks']['lambda']['mysql_users']['function_code'],
-            entry_point = settings['tasks']['lambda']['mysql_users']['entry_point'],
-            target_vpc = settings['global']['target_vpc']
-        )
-        
         # Create Parameter Store values for demo entries in the settings.yml
         # You may not want to manage user/pass info in this manner, but it is useful to see for a demo.
         # If managing the Parameter Store values outside CDK, I would have this section cut down to just 
-        # setting the keybase and ensuring the task role has rights to it
-        
+        # setting the keybase and ensuring the task role has rights to it (the grant below does exactly that)
+        keybase = "/serverlessops/databases"
+
+        # One statement per role covering everything under the keybase, instead of a grant_read per parameter.
+        # Per-parameter grants add a policy statement for every key of every db/env, which bloats the template
+        # and eventually runs into the IAM policy size limit as databases are added.
+        # SecureString values encrypted with the default aws/ssm key need no extra KMS rights; with a customer
+        # managed key, also grant kms:Decrypt on that key.
+        for role in parameter_readers:
+            role.add_to_principal_policy(iam.PolicyStatement(
+                actions = ["ssm:GetParameter", "ssm:GetParameters", "ssm:GetParametersByPath"],
+                resources = [self.format_arn(service = "ssm", resource = "parameter", resource_name = keybase.lstrip("/") + "/*")]
+            ))
+
         # This will loop through settings.yml's parameters: databases section and create keys at /serverlessops/databases in Parameter Store
         # This isn't well written, as it only handles strings, does no validation, and doesn't use the "secret" flag for the password
+        # (CloudFormation can't create SecureString parameters, create those outside CDK, the tasks read them either way)
+        #
+        # parameter_layout (settings.yml) picks how the values are stored:
+        # - documents: one JSON document per db/env at /serverlessops/databases/db/env, read by the tasks in one call
+        # - keys: the original layout, one parameter per key at /serverlessops/databases/db/env/key
+        layout = settings.get('parameter_layout', 'keys')
         for db in settings['parameters']['databases']:
             for env in settings['parameters']['databases'][db]:
+                values = settings['parameters']['databases'][db][env]
+                if layout == 'documents':
+                    ssm.StringParameter(self, db+"/"+env,
+                        parameter_name = keybase + "/" + db + "/" + env,
+                        string_value = json.dumps(values, sort_keys=True),
+                        # JSON documents for several keys can outgrow the 4KB standard tier
+                        tier = ssm.ParameterTier.INTELLIGENT_TIERING
+                    )
+                    continue
+
                 root_param = ssm.StringParameter(self, db+"/"+env,
-                    parameter_name = "/serverlessops/databases/" + db + "/" + env,
+                    parameter_name = keybase + "/" + db + "/" + env,
                     string_value = "Settings for ServerlessOps DB worker task"
                 )
-                # Add task rights to use this parameter -- commenting out, call grants to the specific key not subkeys too. Moved to section below for now.
-                # root_param.grant_read(task_mysqlworker.task_role)
-                
-                for key, value in settings['parameters']['databases'][db][env].items():
+                for key, value in values.items():
                     #print(f"{key} - {value}")
                     param = ssm.StringParameter(self, key,
-                        parameter_name = "/serverlessops/databases/" + db + "/" + env + "/" + key,
-                        string_value = value
+                        parameter_name = keybase + "/" + db + "/" + env + "/" + key,
+                        # Nested settings (i.e. retention:) are stored as JSON strings
+                        string_value = value if isinstance(value, str) else json.dumps(value)
                     )
-                    # Add task rights to use this parameter
-                    # param.grant_read(task_mysqlworker.execution_role)
-                    param.grant_read(task_mysqlworker.task_role)
-                    param.grant_read(task_mysqluser.role)
@@ -0,0 +1,160 @@
+import importlib
+
+from aws_cdk import NestedStack
+from constructs import Construct
+
+# CloudFormation allows 500 resources per stack. Leave headroom for the things CDK adds on its own
+# (nested stack parameters/outputs for cross-stack references, Lambda permissions for API methods, etc.)
+DEFAULT_MAX_RESOURCES = 400
+
+
+def task_specs(tasks_settings):
+    """
+    Flatten the tasks: section of settings.yml into a list of task specs
+
+    Tasks are grouped under tasks: (fargate:, lambda:, ...), anything in a group that has a
+    "module" and "class" is a task the registry will build.
+    Each spec is the task's own settings dict (module, class, name, plus whatever the task needs),
+    with "group" and "key" added so errors can point back at the settings entry.
+    Tasks with "enabled: false" are skipped (and never imported).
+    """
+    specs = []
+    for group, group_tasks in tasks_settings.items():
+        for key, task_settings in group_tasks.items():
+            if not isinstance(task_settings, dict) or 'module' not in task_settings:
+                continue
+            if task_settings.get('enabled', True) is False:
+                continue
+            spec = dict(task_settings)
+            spec['group'] = group
+            spec['key'] = key
+            specs.append(spec)
+    return specs
+
+
+def load_task_class(spec):
+    """Import the task's module only when the task is actually being built"""
+    try:
+        module = importlib.import_module(spec['module'])
+        return getattr(module, spec['class'])
+    except (ImportError, AttributeError) as e:
+        raise ValueError("settings.yml tasks: " + spec['group'] + ": " + spec['key'] + " points at " +
+            spec['module'] + "." + spec['class'] + " which could not be loaded: " + str(e))
+
+
+def pack_tasks(estimates, max_resources = DEFAULT_MAX_RESOURCES, pinned = None):
+    """
+    Assign tasks to shards so no shard goes over max_resources
+
+    estimates, dict = task name -> estimated CloudFormation resource count
+    pinned, dict = task name -> shard number, for tasks that must not move between stacks
+
+    Response: list of shards, each a list of task names
+
+    First-fit decreasing: biggest tasks first, each into the first shard with room. Sorting on
+    (size, name) keeps the assignment stable between synths when nothing changed. Note that a task
+    moving to a different shard means CloudFormation deletes and re-creates its resources, so pin
+    ("shard: N" in settings.yml) anything that shouldn't be replaced as the task list grows.
+    """
+    pinned = pinned or {}
+    shards = []
+    totals = []
+
+    def ensure(shard):
+        while len(shards) <= shard:
+            shards.append([])
+            totals.append(0)
+
+    for name, shard in sorted(pinned.items(), key=lambda item: (item[1], item[0])):
+        ensure(shard)
+        shards[shard].append(name)
+        totals[shard] += estimates[name]
+
+    unpinned = [name for name in estimates if name not in pinned]
+    for name in sorted(unpinned, key=lambda name: (-estimates[name], name)):
+        size = estimates[name]
+        for shard, total in enumerate(totals):
+            if total + size <= max_resources:
+                break
+        else:
+            # Nothing has room (or the task alone is bigger than the budget), start a new shard
+            shard = len(shards)
+            ensure(shard)
+        shards[shard].append(name)
+        totals[shard] += size
+    return shards
+
+
+class TaskRegistry:
+    """
+    Builds the tasks declared in settings.yml, each in its own nested stack or packed into shared ones
+
+    By default a task gets a nested stack of its own, named after it, with the same construct paths
+    (so the same logical IDs) as before the registry. "shard: N" pins it into TaskShardN instead,
+    "shard: auto" lets pack_tasks place it. Moving a deployed task between the two (or between
+    shards) means CloudFormation re-creates its resources, see the README before doing so.
+
+    Task classes are Constructs that provide:
+    - from_settings(scope, construct_id, task_settings, **shared): build the task from its settings.yml entry.
+      shared holds the core infra (ops_cluster, ops_api) and the full settings dict.
+    - estimate_resources(task_settings): rough CloudFormation resource count, used for packing
+    - parameter_readers: the IAM roles that need to read the task's Parameter Store values
+    """
+
+    def __init__(self, tasks_settings, max_resources = DEFAULT_MAX_RESOURCES):
+        self.specs = {}
+        for spec in task_specs(tasks_settings):
+            if spec['name'] in self.specs:
+                raise ValueError("settings.yml tasks: two tasks are named " + spec['name'])
+            self.specs[spec['name']] = spec
+        self.max_resources = max_resources
+
+    def plan(self):
+        """
+        Where each configured task goes
+
+        Response: (own, shards): the names of the tasks that get their own nested stack (no "shard:"),
+        and the shard assignment (list of lists of task names) for the rest
+        """
+        own = []
+        estimates = {}
+        pinned = {}
+        for name, spec in self.specs.items():
+            task_class = load_task_class(spec)
+            shard = spec.get('shard')
+            if shard is None:
+                own.append(name)
+                continue
+            if shard != "auto" and (not isinstance(shard, int) or isinstance(shard, bool) or shard < 0):
+                raise ValueError("settings.yml tasks: " + spec['group'] + ": " + spec['key'] + " has shard: " + str(shard) +
+                    ", expected a shard number or auto")
+            estimates[name] = task_class.estimate_resources(spec)
+            if shard != "auto":
+                pinned[name] = shard
+        return own, pack_tasks(estimates, self.max_resources, pinned)
+
+    def build(self, scope: Construct, **shared):
+        """
+        Create the tasks: each task without a "shard:" in its own NestedStack named after it, the
+        others in one NestedStack per shard
+
+        Response: dict of task name -> task construct
+        """
+        tasks = {}
+        own, shards = self.plan()
+        for name in own:
+            # The layout from before the registry, when each task was a NestedStack of its own. The task is the
+            # stack's "Default" child, which CDK leaves out of logical IDs, so its resources keep theirs and a
+            # deployed stack updates in place instead of replacing them
+            spec = self.specs[name]
+            tasks[name] = load_task_class(spec).from_settings(NestedStack(scope, name), "Default", spec, **shared)
+        for number, shard in enumerate(shards):
+            if not shard:
+                # Only possible when tasks are pinned past an unused shard number
+                continue
+            # No dependencies between shards, so CloudFormation deploys them in parallel
+            shard_stack = NestedStack(scope, "TaskShard" + str(number))
+            for name in shard:
+                spec = self.specs[name]
+                tasks[name] = load_task_class(spec).from_settings(shard_stack, name, spec, **shared)
+        return tasks
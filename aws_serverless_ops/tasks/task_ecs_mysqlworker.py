@@ -1,27 +1,272 @@
 from aws_cdk import (
     Duration,
-    NestedStack,
+    Stack,
+    RemovalPolicy,
+    Size,
+    aws_dynamodb as dynamodb,
     aws_ecs as ecs,
     aws_iam as iam,
+    aws_kms as kms,
     aws_logs as logs,
     aws_stepfunctions as sf,
     aws_stepfunctions_tasks as tasks,
     aws_ssm as ssm,
-    aws_apigateway as api_gw
+    aws_apigateway as api_gw,
+    aws_lambda as _lambda,
+    aws_sqs as sqs,
+    aws_secretsmanager as secretsmanager,
+    aws_applicationautoscaling as appscaling,
+    aws_events as events,
+    aws_events_targets as events_targets,
 )
 from constructs import Construct
 import json
 from aws_cdk.aws_ecr_assets import DockerImageAsset
 
-class MySqlWorker(NestedStack):
+from aws_serverless_ops import asset_cache
+
+# The metrics sidecar's image, pinned so a new agent release doesn't reach running tasks unannounced.
+# Override with metrics_agent_image in settings.yml, tags at https://gallery.ecr.aws/cloudwatch-agent/cloudwatch-agent
+METRICS_AGENT_IMAGE = "public.ecr.aws/cloudwatch-agent/cloudwatch-agent:1.300026.3b189"
+
+class MySqlWorker(Construct):
+
+    @classmethod
+    def from_settings(cls, scope: Construct, construct_id: str, task_settings, ops_cluster, ops_api, **shared):
+        """Build from the tasks: fargate: mysql_worker: entry in settings.yml (see task_registry.py)"""
+        return cls(scope, construct_id,
+            # Referencing the cluster and api created via the core stacks
+            # See "Accessing resources in a different stack" from https://docs.aws.amazon.com/cdk/v2/guide/resources.html
+            ops_cluster = ops_cluster,
+            ops_api = ops_api,
+            docker_path = task_settings['image_path'],
+            idempotency = task_settings.get('idempotency'),
+            export_parquet = task_settings.get('export_parquet', False),
+            lambda_route = task_settings.get('lambda_route'),
+            worker_pool = task_settings.get('worker_pool'),
+            backup_encryption = task_settings.get('backup_encryption'),
+            throttle = task_settings.get('throttle'),
+            key_layout = task_settings.get('key_layout'),
+            callbacks = task_settings.get('callbacks'),
+            submission = task_settings.get('submission'),
+            retention_schedule = task_settings.get('retention_schedule'),
+            metrics_agent_image = task_settings.get('metrics_agent_image') or METRICS_AGENT_IMAGE,
+        )
+
+    @classmethod
+    def estimate_resources(cls, task_settings):
+        """Roughly what this task adds to its stack, used to pack tasks into nested stacks"""
+        # Task definition, roles/policies, log groups, security group, state machine, catalog table
+        count = 17
+        if task_settings.get('idempotency', {}).get('enabled'):
+            # Submit Lambda, its role/policy and the API Gateway invoke permissions
+            count += 6
+        if task_settings.get('lambda_route', {}).get('enabled'):
+            # Small-backup Lambda, its role/policy and security group
+            count += 4
+        if task_settings.get('worker_pool', {}).get('enabled'):
+            # Queue + DLQ and policy, pool task definition/service/security group/log groups,
+            # scaling target, step scaling policies and their alarms
+            count += 14
+        if task_settings.get('backup_encryption', {}).get('enabled') and not task_settings['backup_encryption'].get('kms_key_arn'):
+            # The backups' KMS key
+            count += 1
+        if task_settings.get('callbacks', {}).get('enabled'):
+            # Callback Lambda, its role/policy and the signing secret
+            count += 4
+        if task_settings.get('retention_schedule', {}).get('enabled'):
+            # The rule, its role/policy and the tasks' security group
+            count += 4
+        return count
+
+    def _add_metrics_agent(self, task_definition, worker_container, stream_prefix):
+        """
+        CloudWatch agent sidecar: turns the worker's Embedded Metric Format documents into CloudWatch metrics
+        (dump/compress/upload time, bytes, compression ratio, throughput per db/env/job). Logs shipped by the
+        awslogs driver aren't scanned for EMF, so the worker sends them here over UDP on the task's localhost.
+        The agent batches them into log events, no PutMetricData calls from the job itself.
+        """
+        metrics_agent = task_definition.add_container("CloudWatchAgent",
+            image = ecs.ContainerImage.from_registry(self.metrics_agent_image),
+            essential = False,
+            memory_reservation_mib = 64,
+            environment = {
+                "CW_CONFIG_CONTENT": json.dumps({"logs": {"metrics_collected": {"emf": {}}, "force_flush_interval": 1}})
+            },
+            logging = ecs.LogDrivers.aws_logs(
+                stream_prefix = stream_prefix
+            )
+        )
+        worker_container.add_container_dependencies(ecs.ContainerDependency(
+            container = metrics_agent,
+            condition = ecs.ContainerDependencyCondition.START
+        ))
+
+    def _add_retention_schedule(self, retention_schedule, ops_cluster, fargate_task, fargate_task_container):
+        """
+        Run db_retention (docker/mysql-worker/retention.py) for each listed db/env on an EventBridge schedule
+
+        One rule, a Fargate task per db/env started straight from EventBridge: there's no caller waiting on
+        the result, so no state machine, and the worker runs with the "localtest" token (nothing to report to).
+        Failures show up in the task's logs and its exit code.
+        """
+        rule = events.Rule(self, "RetentionSchedule",
+            description = "db_retention for the db/envs under retention_schedule in settings.yml",
+            schedule = events.Schedule.expression(retention_schedule.get('schedule', "cron(0 5 * * ? *)"))
+        )
+        for db_name, db_envs in retention_schedule.get('databases', {}).items():
+            for db_env in db_envs:
+                rule.add_target(events_targets.EcsTask(
+                    cluster = ops_cluster,
+                    task_definition = fargate_task,
+                    platform_version = ecs.FargatePlatformVersion.LATEST,
+                    container_overrides = [events_targets.ContainerOverride(
+                        container_name = fargate_task_container.container_name,
+                        environment = [
+                            events_targets.TaskEnvironmentVariable(name="TASK_TOKEN_ENV_VARIABLE", value="localtest"),
+                            events_targets.TaskEnvironmentVariable(name="JOB_NAME", value="db_retention"),
+                            events_targets.TaskEnvironmentVariable(name="DB_NAME", value=db_name),
+                            events_targets.TaskEnvironmentVariable(name="DB_ENV", value=db_env),
+                            events_targets.TaskEnvironmentVariable(name="DRY_RUN", value="true" if retention_schedule.get('dry_run') else "false"),
+                        ]
+                    )]
+                ))
+
+    def _notify(self, notify_lambda, name, status, result_path, next_state):
+        """
+        Push the job's result to the submission's callback (lambda/job-callback), then go on to next_state
+
+        Response: the state to use in place of next_state. Executions without a callback skip straight to it,
+        and a delivery that fails is recorded in $.callback_error without failing the job.
+        """
+        notify = tasks.LambdaInvoke(self, name,
+            lambda_function = notify_lambda,
+            payload = sf.TaskInput.from_object({
+                "status": status,
+                "execution_arn": sf.JsonPath.string_at("$$.Execution.Id"),
+                "execution_input": sf.JsonPath.object_at("$$.Execution.Input"),
+                "result": sf.JsonPath.object_at(result_path)
+            }),
+            # The job's output stays what the worker returned
+            result_path = sf.JsonPath.DISCARD
+        )
+        notify.add_catch(next_state, result_path = "$.callback_error")
+        notify.next(next_state)
+        return (sf.Choice(self, name + "?")
+            .when(sf.Condition.is_present("$$.Execution.Input.callback"), notify)
+            .otherwise(next_state)
+        )
+
+    def _add_worker_pool(self, worker_pool, ops_cluster, docker_image, fargate_task, worker_environment):
+        """
+        Queue, ECS service and queue-depth scaling for worker-pool mode
+
+        Response: the StepFunction state that queues a job and waits for its task token
+        """
+        dead_letters = sqs.Queue(self, "MySqlWorkerJobsDlq",
+            retention_period = Duration.days(14)
+        )
+        job_queue = sqs.Queue(self, "MySqlWorkerJobs",
+            # Workers keep messages invisible while their jobs run (pool.py heartbeats), this only
+            # matters when a worker dies mid-job: the job is offered again after this long
+            visibility_timeout = Duration.minutes(5),
+            dead_letter_queue = sqs.DeadLetterQueue(max_receive_count = 3, queue = dead_letters)
+        )
+
+        # Same image, role and environment as the RunTask version, started in pool mode
+        pool_task = ecs.FargateTaskDefinition(self, "MysqlWorkerPoolTask",
+            memory_limit_mib = worker_pool.get('memory_mib', 1024),
+            cpu = worker_pool.get('cpu', 512),
+            task_role = fargate_task.task_role
+        )
+        pool_container = pool_task.add_container("MysqlWorkerContainer",
+            image = ecs.ContainerImage.from_docker_image_asset(docker_image),
+            entry_point = ["python", "/app/worker.py", "pool"],
+            logging = ecs.LogDrivers.aws_logs(
+                stream_prefix = "serverlessops-pool-mysql"
+            ),
+            environment = {
+                "POOL_QUEUE_URL": job_queue.queue_url,
+                "POOL_JOBS_PER_WORKER": str(worker_pool.get('jobs_per_worker', 1)),
+                "AWS_EMF_AGENT_ENDPOINT": "udp://127.0.0.1:25888",
+                # The task's memory is shared by the jobs it runs at once
+                "BACKUP_STREAM_MEMORY_MB": str(worker_pool.get('memory_mib', 1024) // worker_pool.get('jobs_per_worker', 1)),
+                **worker_environment
+            },
+            # Room to finish the jobs in hand on scale-in/deploys (SIGTERM, then SIGKILL after this)
+            stop_timeout = Duration.seconds(120)
+        )
+        self._add_metrics_agent(pool_task, pool_container, "serverlessops-pool-mysql-metrics")
+        job_queue.grant_consume_messages(fargate_task.task_role)
+        # pool.py protects a worker from scale-in while it has jobs, through the ECS agent, which calls these as the task role
+        fargate_task.task_role.add_to_principal_policy(iam.PolicyStatement(
+            actions = ["ecs:UpdateTaskProtection", "ecs:GetTaskProtection"],
+            resources = [Stack.of(self).format_arn(service = "ecs", resource = "task", resource_name = ops_cluster.cluster_name + "/*")]
+        ))
+
+        pool_service = ecs.FargateService(self, "MysqlWorkerPool",
+            cluster = ops_cluster,
+            task_definition = pool_task,
+            desired_count = worker_pool.get('min_workers', 1),
+            min_healthy_percent = 0
+        )
+        self.pool_service = pool_service
+        self.job_queue = job_queue
+
+        # Scale on jobs waiting: each step adds workers while messages sit in the queue, and removes one when
+        # it's empty (busy workers have ECS scale-in protection set by pool.py, so only idle ones go)
+        scaling = pool_service.auto_scale_task_count(
+            min_capacity = worker_pool.get('min_workers', 1),
+            max_capacity = worker_pool.get('max_workers', 10)
+        )
+        scaling.scale_on_metric("QueueDepthScaling",
+            metric = job_queue.metric_approximate_number_of_messages_visible(period = Duration.minutes(1)),
+            scaling_steps = [
+                appscaling.ScalingInterval(upper = 0, change = -1),
+                appscaling.ScalingInterval(lower = 1, change = +1),
+                appscaling.ScalingInterval(lower = 10, change = +3),
+                appscaling.ScalingInterval(lower = 50, change = +10),
+            ],
+            adjustment_type = appscaling.AdjustmentType.CHANGE_IN_CAPACITY,
+            cooldown = Duration.seconds(60)
+        )
+
+        return tasks.SqsSendMessage(self, "QueueMySqlWorkerJob",
+            queue = job_queue,
+            integration_pattern = sf.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+            message_body = sf.TaskInput.from_object({
+                "task_token": sf.JsonPath.task_token,
+                "job_name": sf.JsonPath.string_at("$.job_name"),
+                "job_options": sf.JsonPath.object_at("$.job_options")
+            }),
+            # pool.py sends a heartbeat every minute while the job runs
+            heartbeat = Duration.seconds(600)
+        )
 
     def __init__(self, scope: Construct, construct_id: str, 
         ops_cluster,    # Object: The ECS cluster to be used
         ops_api,        # Object: The API Gateway to be used
         docker_path,    # String: The path to the docker image, from CDK root, i.e. "docker/mysql-worker"
+        idempotency = None, # Dict: optional settings for coalescing duplicate submissions (see settings.yml)
+        export_parquet = False, # Bool: install pyarrow in the image so db_export can write Parquet
+        lambda_route = None, # Dict: optional settings for running small backups as a Lambda function (see settings.yml)
+        worker_pool = None, # Dict: optional settings for running jobs on a queue-fed ECS service (see settings.yml)
+        backup_encryption = None, # Dict: optional settings for client-side encryption of backups (see settings.yml)
+        throttle = None, # Dict: optional thresholds for slowing jobs down while the database is busy (see settings.yml)
+        key_layout = None, # Dict: optional S3 key layout for backups/exports, i.e. hash-sharded prefixes (see settings.yml)
+        callbacks = None, # Dict: optional settings for pushing each job's result to a callback given at submission (see settings.yml)
+        submission = None, # Dict: optional retries and limits on the submission path, POST /db/backup to RunTask (see settings.yml)
+        retention_schedule = None, # Dict: optional schedule for db_retention jobs per db/env (see settings.yml)
+        metrics_agent_image = METRICS_AGENT_IMAGE, # String: the CloudWatch agent sidecar's image, with a version tag or digest
         **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        # A tag or digest, never latest: every task launch would otherwise pull whatever the agent's newest release is
+        image_version = metrics_agent_image.rsplit("/", 1)[-1]
+        if "@" not in image_version and (":" not in image_version or image_version.endswith(":latest")):
+            raise ValueError("settings.yml mysql_worker: metrics_agent_image " + metrics_agent_image + " needs a version tag or digest")
+        self.metrics_agent_image = metrics_agent_image
+
         # Define the docker image to be used by Fargate
         # This call will:
         # 1. build the image
@@ -29,17 +274,67 @@ class MySqlWorker(NestedStack):
         # 3. deploy the image to the dedicated ECR
         # See https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_ecr_assets/DockerImageAsset.html for more info
         #     particularly if you need to specify build args, etc.
-        docker_image = DockerImageAsset(self, "MySqlWorker",
-            directory = docker_path
-            # directory="docker/mysql-worker"
-        )
+        # Bytecode/test caches aren't build inputs, leaving them out keeps the hash (and so the image) the same
+        # after a test run, see asset_cache.py
+        with asset_cache.timed("fingerprint " + docker_path) as timing:
+            docker_image = DockerImageAsset(self, "MySqlWorker",
+                directory = docker_path,
+                # directory="docker/mysql-worker"
+                build_args = {"EXPORT_PARQUET": "true" if export_parquet else "false"},
+                exclude = asset_cache.EXCLUDES
+            )
+            timing["detail"] = "image " + docker_image.asset_hash[:12] + " (built at deploy only if ECR doesn't have it)"
 
         # create the Fargate task
+        # Encrypted backups are streamed, their multipart upload keeps parts in memory (see docker/mysql-worker/envelope.py)
+        encrypting = bool(backup_encryption and backup_encryption.get('enabled'))
+        task_memory = backup_encryption.get('memory_mib', 2048) if encrypting else 512
         fargate_task = ecs.FargateTaskDefinition(self, "MysqlWorkerEcsTask",
-            memory_limit_mib = 512,
+            memory_limit_mib = task_memory,
             cpu = 256
         )
 
+        # Backup catalog, one item per finished backup (see docker/mysql-worker/catalog.py)
+        # Keyed db_name#db_env + created_at so latest / point-in-time / size history lookups are a single Query
+        # RETAIN: the catalog describes backups that outlive the stack
+        catalog_table = dynamodb.Table(self, "BackupCatalog",
+            partition_key = dynamodb.Attribute(name="db_key", type=dynamodb.AttributeType.STRING),
+            sort_key = dynamodb.Attribute(name="created_at", type=dynamodb.AttributeType.NUMBER),
+            billing_mode = dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy = RemovalPolicy.RETAIN
+        )
+        catalog_table.grant_read_write_data(fargate_task.task_role)
+        self.catalog_table = catalog_table
+
+        # What every flavor of the worker (RunTask, Lambda, pool) gets in its environment
+        worker_environment = {
+            "CATALOG_TABLE": catalog_table.table_name
+        }
+        backup_key = None
+        if encrypting:
+            # Backups are streamed through client-side envelope encryption (docker/mysql-worker/envelope.py): a data key
+            # per backup from this KMS key, only its encrypted copy stored with the backup. RETAIN: without the key the
+            # backups can't be restored.
+            if backup_encryption.get('kms_key_arn'):
+                backup_key = kms.Key.from_key_arn(self, "BackupKey", backup_encryption['kms_key_arn'])
+            else:
+                backup_key = kms.Key(self, "BackupKey",
+                    description = "Data keys for client-side encryption of serverlessops database backups",
+                    enable_key_rotation = True,
+                    removal_policy = RemovalPolicy.RETAIN
+                )
+            worker_environment["BACKUP_KMS_KEY_ID"] = backup_key.key_arn
+            worker_environment["BACKUP_STREAM_THREADS"] = str(backup_encryption.get('threads', 4))
+            # GenerateDataKey for backups, Decrypt for restores
+            backup_key.grant_encrypt_decrypt(fargate_task.task_role)
+        self.backup_key = backup_key
+        if throttle and throttle.get('enabled'):
+            # Thresholds for load-aware throttling of dumps/exports (docker/mysql-worker/throttle.py), one JSON variable
+            worker_environment["THROTTLE"] = json.dumps(throttle)
+        if key_layout and key_layout.get('strategy', 'flat') != 'flat':
+            # Where objects land under s3_path (docker/mysql-worker/layout.py), one JSON variable
+            worker_environment["S3_LAYOUT"] = json.dumps(key_layout)
+
         # assign the docker image to the Fargate task
         # For more logging info, see https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_ecs/LogDriver.html#aws_cdk.aws_ecs.LogDriver
         # specifically, if you need to change the loggroup or prefix
@@ -47,12 +342,32 @@ class MySqlWorker(NestedStack):
             image = ecs.ContainerImage.from_docker_image_asset(docker_image),
             logging = ecs.LogDrivers.aws_logs(
                 stream_prefix = "serverlessops-task-mysql"
-            )
+            ),
+            environment = {
+                # Per-stage metrics (docker/mysql-worker/metrics.py) go to the agent sidecar below
+                "AWS_EMF_AGENT_ENDPOINT": "udp://127.0.0.1:25888",
+                # What a streamed upload sizes its in-flight parts by (docker/mysql-worker/envelope.py)
+                "BACKUP_STREAM_MEMORY_MB": str(task_memory),
+                **worker_environment
+            }
+        )
+
+        self._add_metrics_agent(fargate_task, fargate_task_container, "serverlessops-task-mysql-metrics")
+        fargate_task.task_role.add_managed_policy(iam.ManagedPolicy.from_aws_managed_policy_name("CloudWatchAgentServerPolicy"))
+        # Finding a database's readers/replicas to dump from (docker/mysql-worker/sources.py)
+        describe_readers = iam.PolicyStatement(
+            actions = ["rds:DescribeDBClusters", "rds:DescribeDBInstances"],
+            resources = ["*"]
         )
+        fargate_task.task_role.add_to_principal_policy(describe_readers)
+
+        if retention_schedule and retention_schedule.get('enabled'):
+            self._add_retention_schedule(retention_schedule, ops_cluster, fargate_task, fargate_task_container)
 
         # Ensure fargate task can talk to Parameter Store by exposing the task execution role to be used when creating the parameters
         self.task_role = fargate_task.task_role
         self.execution_role = fargate_task.execution_role
+        self.parameter_readers = [self.task_role]
 
         # Create the StepFunction task
         # The "environment" block is where container envvars are passed in. 
@@ -61,27 +376,53 @@ class MySqlWorker(NestedStack):
         #   info and just validating it's been specified.
         # For a true deployment, sensitive information like user/pass should NOT be done this way. Check the
         #   demo version of worker.py to see how to leverage Parameter Store instead.
-        sf_task = tasks.EcsRunTask(self, "RunMySqlWorker",
-            integration_pattern = sf.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
-            cluster = ops_cluster,
-            task_definition = fargate_task,
-            launch_target = tasks.EcsFargateLaunchTarget(platform_version=ecs.FargatePlatformVersion.LATEST),
-            heartbeat = Duration.seconds(600),
-            container_overrides = [tasks.ContainerOverride(
-                container_definition = fargate_task_container,
-                environment = [
-                    tasks.TaskEnvironmentVariable(name="TASK_TOKEN_ENV_VARIABLE", value=sf.JsonPath.string_at("$$.Task.Token")),
-                    tasks.TaskEnvironmentVariable(name="JOB_NAME", value=sf.JsonPath.string_at("$.job_name")),
-                    tasks.TaskEnvironmentVariable(name="DB_NAME", value=sf.JsonPath.string_at("$.job_options.db_name")),
-                    tasks.TaskEnvironmentVariable(name="DB_HOST", value=sf.JsonPath.string_at("$.job_options.db_host")),
-                    tasks.TaskEnvironmentVariable(name="DB_PORT", value=sf.JsonPath.string_at("$.job_options.db_port")),
-                    tasks.TaskEnvironmentVariable(name="DB_USER", value=sf.JsonPath.string_at("$.job_options.db_user")),
-                    tasks.TaskEnvironmentVariable(name="DB_PASS", value=sf.JsonPath.string_at("$.job_options.db_pass")),
-                    tasks.TaskEnvironmentVariable(name="S3_BUCKET", value=sf.JsonPath.string_at("$.job_options.s3_bucket")),
-                    tasks.TaskEnvironmentVariable(name="S3_PATH", value=sf.JsonPath.string_at("$.job_options.s3_path")),
-                ]
-            )]
-        )
+        if worker_pool and worker_pool.get('enabled'):
+            # Worker-pool mode: jobs go on a queue for a long-running ECS service to pick up (see
+            # docker/mysql-worker/pool.py) instead of each starting its own Fargate task, so a burst of jobs
+            # isn't paced by task launches. The worker answers with the task token, like the RunTask version.
+            sf_task = self._add_worker_pool(worker_pool, ops_cluster, docker_image, fargate_task, worker_environment)
+        else:
+            sf_task = tasks.EcsRunTask(self, "RunMySqlWorker",
+                integration_pattern = sf.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+                cluster = ops_cluster,
+                task_definition = fargate_task,
+                launch_target = tasks.EcsFargateLaunchTarget(platform_version=ecs.FargatePlatformVersion.LATEST),
+                heartbeat = Duration.seconds(600),
+                container_overrides = [tasks.ContainerOverride(
+                    container_definition = fargate_task_container,
+                    environment = [
+                        tasks.TaskEnvironmentVariable(name="TASK_TOKEN_ENV_VARIABLE", value=sf.JsonPath.string_at("$$.Task.Token")),
+                        tasks.TaskEnvironmentVariable(name="JOB_NAME", value=sf.JsonPath.string_at("$.job_name")),
+                        tasks.TaskEnvironmentVariable(name="DB_NAME", value=sf.JsonPath.string_at("$.job_options.db_name")),
+                        # Defaulted by ApplyJobDefaults below, the catalog keys backups by db_name#db_env like the Lambda route and pool do
+                        tasks.TaskEnvironmentVariable(name="DB_ENV", value=sf.JsonPath.string_at("$.job_options.db_env")),
+                        tasks.TaskEnvironmentVariable(name="DB_HOST", value=sf.JsonPath.string_at("$.job_options.db_host")),
+                        tasks.TaskEnvironmentVariable(name="DB_PORT", value=sf.JsonPath.string_at("$.job_options.db_port")),
+                        tasks.TaskEnvironmentVariable(name="DB_USER", value=sf.JsonPath.string_at("$.job_options.db_user")),
+                        tasks.TaskEnvironmentVariable(name="DB_PASS", value=sf.JsonPath.string_at("$.job_options.db_pass")),
+                        tasks.TaskEnvironmentVariable(name="S3_BUCKET", value=sf.JsonPath.string_at("$.job_options.s3_bucket")),
+                        tasks.TaskEnvironmentVariable(name="S3_PATH", value=sf.JsonPath.string_at("$.job_options.s3_path")),
+                        # Optional, defaulted by ApplyJobDefaults below. "cpu,memory,stacks" profiles the job (see profiling.py)
+                        tasks.TaskEnvironmentVariable(name="PROFILE", value=sf.JsonPath.string_at("$.job_options.profile")),
+                        # Optional, for job_name "db_export": csv or parquet, and a comma separated table list (empty: all tables)
+                        tasks.TaskEnvironmentVariable(name="EXPORT_FORMAT", value=sf.JsonPath.string_at("$.job_options.export_format")),
+                        tasks.TaskEnvironmentVariable(name="EXPORT_TABLES", value=sf.JsonPath.string_at("$.job_options.export_tables")),
+                    ]
+                )]
+            )
+            run_task_retry = (submission or {}).get('run_task_retry')
+            if run_task_retry:
+                # RunTask is throttled (and Fargate launches are rate limited) well below what StartExecution
+                # accepts, so a burst of jobs fails here without a retry. Numbers from benchmarks/load_control_plane.py
+                sf_task.add_retry(
+                    errors = run_task_retry.get('errors', ["ECS.AmazonECSException"]),
+                    max_attempts = run_task_retry.get('max_attempts', 6),
+                    interval = Duration.seconds(run_task_retry.get('interval_seconds', 2)),
+                    backoff_rate = run_task_retry.get('backoff_rate', 2),
+                    max_delay = Duration.seconds(run_task_retry.get('max_delay_seconds', 60)),
+                    # Full jitter, so executions throttled together don't all retry together
+                    jitter_strategy = sf.JitterType.FULL if run_task_retry.get('jitter', True) else sf.JitterType.NONE
+                )
 
         # Fail State, here is where you'd put logic to take when there's a failure, like sending an SNS notification.
         # For demo, just logging a message
@@ -97,11 +438,146 @@ class MySqlWorker(NestedStack):
         )
 
         # Create StepFunction chain of states
-        st_definition = sf_task.next(sf.Choice(self, "JobComplete?")
-            .when(sf.Condition.string_equals("$.status", "FAILED"), sf_step_fail) # change "FAILED" to whatever failure message you're sending back from the container
-            .when(sf.Condition.string_equals("$.status", "job complete"), sf_step_success) # change "job complete" to whatever success message you're sending back from the container
-            .otherwise(sf_step_fail) # for demo purposes, just failing if no replies are known
+        # Optional job_options get their defaults here, so callers only pass them when they need them
+        # (a missing path in the container overrides above would fail the execution)
+        sf_job_defaults = sf.Pass(self, "JobDefaults",
+            result = sf.Result.from_object({
+                "db_env": "none",
+                "profile": "",
+                "export_format": "csv",
+                "export_tables": ""
+            }),
+            result_path = "$.job_defaults"
+        )
+        sf_apply_defaults = sf.Pass(self, "ApplyJobDefaults",
+            parameters = {
+                "job_name.$": "$.job_name",
+                "job_options.$": "States.JsonMerge($.job_defaults, $.job_options, false)"
+            }
+        )
+
+        # Callbacks: a submission can include "callback" (a webhook or SQS queue), and the job's final result is pushed
+        # there from the success/fail paths, signed, instead of the client polling /db/backup/status
+        on_success = sf_step_success
+        on_fail = sf_step_fail
+        on_error = None
+        if callbacks and callbacks.get('enabled'):
+            # Callback targets come from whoever calls POST /db/backup, so they only go where settings.yml says
+            if not callbacks.get('allowed_hosts') and not callbacks.get('queue_arns'):
+                raise ValueError("settings.yml callbacks: enabled needs allowed_hosts (webhooks) and/or queue_arns (SQS)")
+            signing_secret = secretsmanager.Secret(self, "CallbackSigningSecret",
+                description = "HMAC key signing serverlessops job callbacks, receivers verify deliveries with it",
+                generate_secret_string = secretsmanager.SecretStringGenerator(exclude_punctuation = True, password_length = 48)
+            )
+            # Outside the VPC on purpose: webhooks go to the internet, never to private endpoints
+            notify_lambda = _lambda.Function(self, "MySqlWorkerCallback",
+                code = _lambda.Code.from_asset(callbacks.get('asset_path', "lambda/job-callback"), exclude = asset_cache.EXCLUDES),
+                handler = "app.handler",
+                runtime = _lambda.Runtime.PYTHON_3_9,
+                # Room for every attempt's timeout plus the backoff between them
+                timeout = Duration.seconds(120),
+                environment = {
+                    "CALLBACK_SECRET_ARN": signing_secret.secret_arn,
+                    "CALLBACK_MAX_ATTEMPTS": str(callbacks.get('max_attempts', 5)),
+                    "CALLBACK_ALLOWED_HOSTS": json.dumps(callbacks.get('allowed_hosts') or [])
+                }
+            )
+            signing_secret.grant_read(notify_lambda)
+            if callbacks.get('queue_arns'):
+                # Only these, never every queue in the account (this stack's own job queue included)
+                notify_lambda.add_to_role_policy(iam.PolicyStatement(
+                    actions = ["sqs:SendMessage"],
+                    resources = callbacks['queue_arns']
+                ))
+            self.callback_secret = signing_secret
+
+            on_success = self._notify(notify_lambda, "NotifySuccess", "SUCCEEDED", "$", sf_step_success)
+            on_fail = self._notify(notify_lambda, "NotifyFailure", "FAILED", "$", sf_step_fail)
+            # Jobs that fail outright (SendTaskFailure, heartbeat/timeouts) are caught to be notified, then still fail
+            # with their own error and cause
+            sf_task_failed = sf.Fail(self, "MySqlWorkerTaskFailed",
+                error_path = "$.error.Error",
+                cause_path = "$.error.Cause"
+            )
+            on_error = self._notify(notify_lambda, "NotifyError", "FAILED", "$.error", sf_task_failed)
+            sf_task.add_catch(on_error, result_path = "$.error")
+
+        sf_job_complete = (sf.Choice(self, "JobComplete?")
+            .when(sf.Condition.string_equals("$.status", "FAILED"), on_fail) # change "FAILED" to whatever failure message you're sending back from the container
+            .when(sf.Condition.string_equals("$.status", "job complete"), on_success) # change "job complete" to whatever success message you're sending back from the container
+            .otherwise(on_fail) # for demo purposes, just failing if no replies are known
         )
+        sf_task.next(sf_job_complete)
+
+        backup_lambda = None
+        if lambda_route and lambda_route.get('enabled'):
+            # Small backups: a Fargate task for a few MB spends far longer provisioning and pulling the image than
+            # dumping, so db_backup jobs for databases under max_size_mb run as a Lambda function instead.
+            # Same image and code (docker/mysql-worker/lambda_handler.py wraps worker.py's db_backup), started
+            # through awslambdaric, and the same task token reporting, so the rest of the state machine doesn't change.
+            backup_lambda = _lambda.DockerImageFunction(self, "MySqlWorkerLambda",
+                code = _lambda.DockerImageCode.from_image_asset(docker_path,
+                    # Same directory and build args as the Fargate image above, so it's the same build
+                    build_args = {"EXPORT_PARQUET": "true" if export_parquet else "false"},
+                    exclude = asset_cache.EXCLUDES,
+                    entrypoint = ["python", "-m", "awslambdaric"],
+                    cmd = ["lambda_handler.handler"]
+                ),
+                memory_size = lambda_route.get('memory_mb', 2048),
+                # /tmp holds the dump while it's compressed
+                ephemeral_storage_size = Size.mebibytes(lambda_route.get('ephemeral_storage_mb', 2048)),
+                timeout = Duration.seconds(lambda_route.get('timeout_seconds', 900)),
+                # Same network as the Fargate task, so the database's security group rules are the same too
+                vpc = ops_cluster.vpc,
+                environment = dict(worker_environment, BACKUP_STREAM_MEMORY_MB = str(lambda_route.get('memory_mb', 2048)))
+            )
+            catalog_table.grant_read_write_data(backup_lambda)
+            if backup_key:
+                backup_key.grant_encrypt_decrypt(backup_lambda)
+            backup_lambda.add_to_role_policy(describe_readers)
+            self.parameter_readers.append(backup_lambda.role)
+
+            # Estimate the database size (data + index, from information_schema) with the same function
+            sf_estimate = tasks.LambdaInvoke(self, "EstimateDbSize",
+                lambda_function = backup_lambda,
+                payload = sf.TaskInput.from_object({
+                    "action": "estimate",
+                    "job_options": sf.JsonPath.object_at("$.job_options")
+                }),
+                payload_response_only = True,
+                result_path = "$.estimate",
+                task_timeout = sf.Timeout.duration(Duration.seconds(60))
+            )
+            sf_lambda_task = tasks.LambdaInvoke(self, "RunMySqlWorkerLambda",
+                lambda_function = backup_lambda,
+                integration_pattern = sf.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+                payload = sf.TaskInput.from_object({
+                    "action": "backup",
+                    "task_token": sf.JsonPath.task_token,
+                    "job_name": sf.JsonPath.string_at("$.job_name"),
+                    "job_options": sf.JsonPath.object_at("$.job_options")
+                }),
+                # Lambda can't outlive its timeout, give up waiting for the token shortly after
+                task_timeout = sf.Timeout.duration(Duration.seconds(lambda_route.get('timeout_seconds', 900) + 60))
+            )
+            sf_lambda_task.next(sf_job_complete)
+            if on_error:
+                sf_lambda_task.add_catch(on_error, result_path = "$.error")
+            # If the estimate fails (no rights on information_schema, ...) the job just runs on Fargate
+            sf_estimate.add_catch(sf_task, result_path = "$.estimate_error")
+            sf_route = sf_estimate.next(sf.Choice(self, "SmallEnoughForLambda?")
+                .when(sf.Condition.number_less_than_equals("$.estimate.size_bytes", lambda_route.get('max_size_mb', 500) * 1024 * 1024), sf_lambda_task)
+                .otherwise(sf_task)
+            )
+            # Only backups are routed by size, every other job goes to Fargate
+            sf_dispatch = (sf.Choice(self, "RouteBySize?")
+                .when(sf.Condition.string_equals("$.job_name", "db_backup"), sf_route)
+                .otherwise(sf_task)
+            )
+        else:
+            sf_dispatch = sf_task
+
+        st_definition = sf_job_defaults.next(sf_apply_defaults).next(sf_dispatch)
 
         # Create the logging group
         sf_logs = logs.LogGroup(self, "/serverlessops/MySqlWorkerLogs")
@@ -118,6 +594,9 @@ class MySqlWorker(NestedStack):
         )
         # Ensure task can report its heartbeat status back to StepFunctions
         sf_statemachine.grant_task_response(fargate_task.task_role)
+        if backup_lambda:
+            sf_statemachine.grant_task_response(backup_lambda)
+        # (the worker pool's tasks share fargate_task's role, so they're covered above)
 
         # By default, APIGW doesn't create a role, create one to use for StepFunction calls (Integration Request)
         db_iam_role = iam.Role(self, "ServerlessOpsDbWorkerRole",
@@ -131,33 +610,61 @@ class MySqlWorker(NestedStack):
         # Create APIGW resources and methods for /db and /db/backup
         db_resource = ops_api.root.add_resource("db")
         db_backup_resource = db_resource.add_resource("backup")
-        db_backup_method_request_template = {
-            "input":           "$util.escapeJavaScript($input.json('$'))",
-            "stateMachineArn": sf_statemachine.state_machine_arn
-        }
-        db_backup_method = db_backup_resource.add_method("POST",
-            api_gw.AwsIntegration(
-                service = "states",
-                action = "StartExecution",
-                integration_http_method = "POST",
-                options = api_gw.IntegrationOptions(
-                    passthrough_behavior = api_gw.PassthroughBehavior.NEVER,
-                    credentials_role = db_iam_role,
-                    request_templates = { "application/json": json.dumps(db_backup_method_request_template, indent=4) },
-                    integration_responses = [
-                        api_gw.IntegrationResponse(
-                            status_code = "200",
-                            response_templates = { "application/json": "" } # you should define a template that returns a format you'll support, just passing through for the demo
-                        )
-                    ]
-                )
-            ),
-            method_responses = [ 
-                api_gw.MethodResponse(
-                    status_code="200"
-                ) 
-            ]
-        )
+        if idempotency and idempotency.get('enabled'):
+            # Put the job-submit Lambda in front of StartExecution so duplicate submissions for the same
+            # job/db/env coalesce into one execution. See lambda/job-submit/app.py for the logic.
+            # Plain lambda.Function is enough here, the function only needs boto3 which the runtime provides.
+            submit_lambda = _lambda.Function(self, "MySqlWorkerSubmit",
+                code = _lambda.Code.from_asset(idempotency['asset_path'], exclude = asset_cache.EXCLUDES),
+                handler = "app.handler",
+                runtime = _lambda.Runtime.PYTHON_3_9,
+                timeout = Duration.seconds(30),
+                # Each new job makes a DescribeExecution per earlier window it looks at, a call StepFunctions refills at
+                # 25 a second; a cap keeps a burst from spending the bucket on calls that then time out (None: unreserved)
+                reserved_concurrent_executions = (submission or {}).get('submit_concurrency') or None,
+                environment = {
+                    "STATE_MACHINE_ARN": sf_statemachine.state_machine_arn,
+                    "COALESCE_WINDOW_SECONDS": str(idempotency.get('window_seconds', 900)),
+                    "FRESHNESS_SECONDS": str(idempotency.get('freshness_seconds', 0)),
+                    # boto3 reads its retry settings from these, for the throttled StepFunctions calls
+                    "AWS_RETRY_MODE": (submission or {}).get('sdk_retry_mode', "legacy"),
+                    "AWS_MAX_ATTEMPTS": str((submission or {}).get('sdk_max_attempts', 5))
+                }
+            )
+            # StartExecution, plus DescribeExecution (part of grant_read) for finding in-flight/recent ones
+            sf_statemachine.grant_start_execution(submit_lambda)
+            sf_statemachine.grant_read(submit_lambda)
+            db_backup_method = db_backup_resource.add_method("POST",
+                api_gw.LambdaIntegration(submit_lambda)
+            )
+        else:
+            db_backup_method_request_template = {
+                "input":           "$util.escapeJavaScript($input.json('$'))",
+                "stateMachineArn": sf_statemachine.state_machine_arn
+            }
+            db_backup_method = db_backup_resource.add_method("POST",
+                api_gw.AwsIntegration(
+                    service = "states",
+                    action = "StartExecution",
+                    integration_http_method = "POST",
+                    options = api_gw.IntegrationOptions(
+                        passthrough_behavior = api_gw.PassthroughBehavior.NEVER,
+                        credentials_role = db_iam_role,
+                        request_templates = { "application/json": json.dumps(db_backup_method_request_template, indent=4) },
+                        integration_responses = [
+                            api_gw.IntegrationResponse(
+                                status_code = "200",
+                                response_templates = { "application/json": "" } # you should define a template that returns a format you'll support, just passing through for the demo
+                            )
+                        ]
+                    )
+                ),
+                method_responses = [ 
+                    api_gw.MethodResponse(
+                        status_code="200"
+                    ) 
+                ]
+            )
 
         # Create resources and methods for /db/backup/status
         # Mapping template for status responses, created as a string since we're making no transformations via CDK
@@ -0,0 +1,80 @@
+import os
+
+from aws_cdk import (
+    Duration,
+    aws_apigateway as api_gw,
+    aws_lambda as _lambda,
+    aws_ec2 as ec2,
+)
+from constructs import Construct
+
+from aws_serverless_ops import asset_cache
+
+class MySqlDiagnosticsLambda(Construct):
+
+    @classmethod
+    def from_settings(cls, scope: Construct, construct_id: str, task_settings, ops_api, settings, **shared):
+        """Build from the tasks: lambda: mysql_diagnostics entry in settings.yml (see task_registry.py)"""
+        return cls(scope, construct_id,
+            ops_api = ops_api,
+            asset_path = task_settings['asset_path'],
+            function_code = task_settings['function_code'],
+            entry_point = task_settings['entry_point'],
+            target_vpc = settings['global']['target_vpc'],
+            max_concurrency = task_settings.get('max_concurrency', 5),
+            settings_ttl_seconds = task_settings.get('settings_ttl_seconds', 300),
+            max_execution_ms = task_settings.get('max_execution_ms', 5000)
+        )
+
+    @classmethod
+    def estimate_resources(cls, task_settings):
+        """Roughly what this task adds to its stack, used to pack tasks into nested stacks"""
+        # Function, role, policy, security group, API resource, method, two invoke permissions
+        return 8
+
+    def __init__(self, scope: Construct, construct_id: str,
+        ops_api,                    # Object: The API Gateway to add GET /diagnostics to
+        asset_path,                 # String: the function's folder, i.e. "lambda/mysql-diagnostics"
+        function_code,
+        entry_point,
+        target_vpc,
+        max_concurrency = 5,        # Int: reserved concurrency, each warm environment has its own cache (see app.py)
+        settings_ttl_seconds = 300, # Int: how long a db/env's Parameter Store settings are reused
+        max_execution_ms = 5000,    # Int: statement time limit for the diagnostics queries
+        **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        ops_vpc = ec2.Vpc.from_lookup(self, "ServerlessOpsVpc",
+            vpc_id = target_vpc
+        )
+
+        # Read-only, whitelisted queries by name (see lambda/mysql-diagnostics/diagnostics.py), cached per query
+        # and served from pooled connections that survive between warm invocations
+        diagnostics_lambda = _lambda.Function(self, 'MySqlDiagnostics',
+            code = asset_cache.python_function_code(asset_path, _lambda.Runtime.PYTHON_3_9),
+            handler = os.path.splitext(function_code)[0] + "." + entry_point,
+            runtime = _lambda.Runtime.PYTHON_3_9,
+            vpc = ops_vpc,
+            timeout = Duration.seconds(30),
+            # Caps the warm environments, and so how many caches (and connections) a burst of refreshes spreads over
+            reserved_concurrent_executions = max_concurrency,
+            environment = {
+                "SETTINGS_TTL_SECONDS": str(settings_ttl_seconds),
+                "MAX_EXECUTION_MS": str(max_execution_ms)
+            }
+        )
+
+        # GET /diagnostics?db_name=...&db_env=...&query=...
+        diagnostics_resource = ops_api.root.add_resource("diagnostics")
+        diagnostics_resource.add_method("GET",
+            api_gw.LambdaIntegration(diagnostics_lambda),
+            request_parameters = {
+                "method.request.querystring.db_name": True,
+                "method.request.querystring.db_env": True,
+                "method.request.querystring.query": False
+            }
+        )
+
+        # Ensure we can assign ParameterStore rights by exposing the role
+        self.role = diagnostics_lambda.role
+        self.parameter_readers = [self.role]
@@ -1,14 +1,32 @@
+import os
+
 from aws_cdk import (
     CfnOutput,
     Duration,
-    NestedStack,
-    aws_lambda_python_alpha as lambda_alpha_,
     aws_lambda as _lambda,
     aws_ec2 as ec2,
 )
 from constructs import Construct
 
-class MySqlUsersLambda(NestedStack):
+from aws_serverless_ops import asset_cache
+
+class MySqlUsersLambda(Construct):
+
+    @classmethod
+    def from_settings(cls, scope: Construct, construct_id: str, task_settings, settings, **shared):
+        """Build from the tasks: lambda: mysql_users entry in settings.yml (see task_registry.py)"""
+        return cls(scope, construct_id,
+            asset_path = task_settings['asset_path'],
+            function_code = task_settings['function_code'],
+            entry_point = task_settings['entry_point'],
+            target_vpc = settings['global']['target_vpc']
+        )
+
+    @classmethod
+    def estimate_resources(cls, task_settings):
+        """Roughly what this task adds to its stack, used to pack tasks into nested stacks"""
+        # Function, role, policy, security group
+        return 4
 
     def __init__(self, scope: Construct, construct_id: str, 
         asset_path,
@@ -25,12 +43,18 @@ class MySqlUsersLambda(NestedStack):
 
         # Defines an AWS Lambda resource
         """
-        This section uses the alpha version of cdk's lambda module:
+        This section used to use the alpha version of cdk's lambda module (PythonFunction):
         https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_lambda_python_alpha/README.html
 
         Normally, you need to either package the function code or add in a bundler section
-        to perform the necessary work (pip install, etc). The alpha module will spawn a
-        local docker container, run the `pip install -r requirements`, and bundle for you.
+        to perform the necessary work (pip install, etc). The alpha module spawns a
+        local docker container, runs the `pip install -r requirements`, and bundles for you,
+        on every synth, which made `cdk synth` take minutes even when nothing changed.
+
+        It now uses option 3 below, through asset_cache.python_function_code: the asset is
+        hashed from its inputs (the files here, requirements.txt, the runtime), bundled locally
+        with pip when that hash is new (Docker only as a fallback) and reused from a cache when
+        it isn't. See aws_serverless_ops/asset_cache.py.
 
         Be sure to include any python packages in the lambda/mysql-users/requirements.txt if
         you edit the Python file there to use any other dependencies.
@@ -53,11 +77,12 @@ class MySqlUsersLambda(NestedStack):
         created. By default, CDK uses best-practice values, and omitting `vpc_subnets` defaults
         to PRIVATE subnets (ones without an Internet Gateway).
         """
-        mysql_user_lambda = lambda_alpha_.PythonFunction(self, 'MySqlUser',
-            entry = asset_path,
-            index=function_code,
-            handler=entry_point,
-            runtime=_lambda.Runtime.PYTHON_3_9,
+        mysql_user_lambda = _lambda.Function(self, 'MySqlUser',
+            # Keeps the deployment package to what the function imports (no bytecode/test caches):
+            # a smaller package is faster to fetch and unpack on every cold start
+            code = asset_cache.python_function_code(asset_path, _lambda.Runtime.PYTHON_3_9),
+            handler = os.path.splitext(function_code)[0] + "." + entry_point,
+            runtime = _lambda.Runtime.PYTHON_3_9,
             vpc = ops_vpc,
             timeout = Duration.minutes(5)
         )
@@ -82,6 +107,7 @@ class MySqlUsersLambda(NestedStack):
 
         # Ensure we can assign ParameterStore rights by exposing the role
         self.role = mysql_user_lambda.role
+        self.parameter_readers = [self.role]
 
         # Output relevant information user needs to reference later
         # 
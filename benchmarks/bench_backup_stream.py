@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the backup encryption/checksum stage (docker/mysql-worker/envelope.py)
+
+The stage sits after compression in the streaming backup (mysqldump | gzip | stage | S3), so it
+has to take compressed bytes at least as fast as gzip produces them. Reports, in MB/s:
+- compression: gzip level 6 (what db_backup.sh's gzip uses), one thread like gzip, input and output
+- stage: AES-GCM encryption + per-part/whole-object sha256 over the compressed data, at 1..N
+  threads, and checksums only (no KMS key). S3 is an in-memory stand-in that drops the bytes, so
+  this is the stage's CPU cost, not network.
+- restore: verification + decryption of the same object
+
+and whether each stage setting keeps up with compression. Data is synthetic INSERT statements
+that compress about like a real dump.
+
+Run it on (or pinned to) the task's vCPUs, i.e. 4 for a 4-vCPU Fargate task:
+    python benchmarks/bench_backup_stream.py [--cpus 4] [--mb 256] [--threads 1,2,4]
+
+Needs the cryptography package (requirements-dev.txt).
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "docker", "mysql-worker"))
+
+import envelope
+
+
+class BenchKms:
+    """Hands out random data keys and unwraps the last one (one backup at a time)"""
+
+    def generate_data_key(self, KeyId, KeySpec):
+        self.key = os.urandom(32)
+        return {"Plaintext": self.key, "CiphertextBlob": b"wrapped" * 20, "KeyId": KeyId}
+
+    def decrypt(self, CiphertextBlob):
+        return {"Plaintext": self.key}
+
+
+def synthetic_dump(size):
+    """INSERT statements with a mix of ids, numbers and words, size bytes of them"""
+    rng = random.Random(42)
+    words = ["classic", "model", "order", "shipped", "pending", "customer", "motorcycle", "vintage", "invoice", "euro"]
+    rows = []
+    total = 0
+    while total < size:
+        row = "INSERT INTO `orders` VALUES (%d,'%s %s',%d.%02d,'2024-%02d-%02d','%s');\n" % (rng.randint(1, 10 ** 7),
+            rng.choice(words), rng.choice(words), rng.randint(0, 99999), rng.randint(0, 99), rng.randint(1, 12),
+            rng.randint(1, 28), "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(rng.randint(4, 24))))
+        rows.append(row)
+        total += len(row)
+    return "".join(rows).encode()[:size]
+
+
+def rate(size, seconds):
+    return size / 1024 / 1024 / seconds
+
+
+def bench_compress(data):
+    started = time.perf_counter()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    out = []
+    for offset in range(0, len(data), envelope.CHUNK_SIZE):
+        out.append(compressor.compress(data[offset:offset + envelope.CHUNK_SIZE]))
+    out.append(compressor.flush())
+    return b"".join(out), time.perf_counter() - started
+
+
+def bench_stage(compressed, threads, encrypt):
+    s3 = envelope.LocalS3(keep = False)
+    started = time.perf_counter()
+    sums = envelope.stream_to_s3(io.BytesIO(compressed), s3, "bench", "dump.sql.gz", kms = BenchKms(),
+        kms_key_id = "alias/bench" if encrypt else None, threads = threads)
+    return sums, time.perf_counter() - started
+
+
+def bench_restore(compressed, threads):
+    s3 = envelope.LocalS3()
+    kms = BenchKms()
+    sums = envelope.stream_to_s3(io.BytesIO(compressed), s3, "bench", "dump.sql.gz", kms = kms, kms_key_id = "alias/bench",
+        threads = threads)
+    written = [0]
+
+    def discard(chunk):
+        written[0] += len(chunk)
+
+    started = time.perf_counter()
+    envelope.restore_stream(io.BytesIO(s3.objects[("bench", "dump.sql.gz")]), sums, discard, kms = kms, threads = threads)
+    seconds = time.perf_counter() - started
+    assert written[0] == len(compressed)
+    return seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument("--mb", type = int, default = 256, help = "uncompressed dump size")
+    parser.add_argument("--threads", default = "1,2,4")
+    parser.add_argument("--cpus", type = int, default = 0, help = "pin to this many CPUs (Linux), i.e. 4 for a 4-vCPU task")
+    args = parser.parse_args()
+
+    if args.cpus:
+        os.sched_setaffinity(0, sorted(os.sched_getaffinity(0))[:args.cpus])
+    print("CPUs available: " + str(len(os.sched_getaffinity(0))))
+
+    data = synthetic_dump(args.mb * 1024 * 1024)
+    compressed, compress_seconds = bench_compress(data)
+    compressed_rate = rate(len(compressed), compress_seconds)
+    print("compression (gzip -6, 1 thread): %.1f MB/s in, %.1f MB/s out, ratio %.2f"
+        % (rate(len(data), compress_seconds), compressed_rate, len(data) / len(compressed)))
+
+    print("%-28s %10s %14s %10s" % ("stage", "MB/s", "x compression", "keeps up"))
+    for threads in [int(value) for value in args.threads.split(",")]:
+        for encrypt in (True, False):
+            sums, seconds = bench_stage(compressed, threads, encrypt)
+            stage_rate = rate(len(compressed), seconds)
+            label = ("encrypt+checksum" if encrypt else "checksum only") + ", " + str(threads) + " threads"
+            print("%-28s %10.1f %14.2f %10s" % (label, stage_rate, stage_rate / compressed_rate,
+                "yes" if stage_rate >= compressed_rate else "NO"))
+        restore_seconds = bench_restore(compressed, threads)
+        print("%-28s %10.1f" % ("restore verify+decrypt, " + str(threads), rate(len(compressed), restore_seconds)))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark for the mysql-users Lambda (lambda/mysql-users/app.py)
+
+Each run is a fresh Python process, like a new Lambda execution environment, and reports:
+- import/init time of app.py (what Lambda's init phase pays: imports, logging, AWS clients)
+- which heavy modules the init phase pulled in (pymysql should not be one of them)
+- first-call latency of handler() (first Parameter Store lookup, pymysql import, connect, queries)
+- second-call latency, on the same process (a warm invocation)
+
+Parameter Store is a local stand-in (an HTTP server answering GetParameter with the db settings,
+reached through AWS_ENDPOINT_URL_SSM), so no AWS account is needed, the numbers don't include SSM's
+network latency, and older versions of app.py can be measured the same way for comparison.
+Without --db-host the connect goes to a closed local port and fails fast, which still covers
+everything up to the first byte to MySQL. Point it at a real (throwaway) database to include the
+connect and the CREATE USER/GRANT queries.
+
+Run it before and after changing app.py or its imports, the output is meant to be compared.
+
+Usage (from the repo root, with boto3 and pymysql installed):
+    python benchmarks/bench_lambda_cold_start.py [--runs 10]
+        [--db-host HOST --db-user USER --db-pass PASS --db-name NAME [--db-port 3306]]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSET_DIR = os.path.join(REPO_ROOT, "lambda", "mysql-users")
+
+# Modules worth knowing about if they show up in the init phase
+WATCHED_MODULES = ["pymysql", "cProfile", "tracemalloc", "pstats"]
+
+# Runs in the child process: one cold start and two invocations, timings printed as JSON
+CHILD = r'''
+import json, sys, time
+started = time.perf_counter()
+import app
+init = time.perf_counter() - started
+loaded = [name for name in WATCHED if name in sys.modules]
+
+calls = []
+for number in range(2):
+    started = time.perf_counter()
+    try:
+        app.handler(dict(EVENT, update_user="bench_user_" + str(number)), None)
+    except SystemExit:
+        # No database to talk to: add_user exits after the failed connect, which is fine here
+        pass
+    calls.append(time.perf_counter() - started)
+print("BENCH " + json.dumps({"init": init, "first": calls[0], "second": calls[1], "loaded": loaded}))
+'''
+
+
+def parameter_store(settings):
+    """Start a local GetParameter stand-in that returns settings as the db/env document"""
+    body = json.dumps({"Parameter": {"Value": json.dumps(settings)}}).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-amz-json-1.1")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+
+def run_once(endpoint, event):
+    code = "WATCHED = " + repr(WATCHED_MODULES) + "\nEVENT = " + repr(event) + "\n" + CHILD
+    env = dict(os.environ, AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+        AWS_ACCESS_KEY_ID = "bench", AWS_SECRET_ACCESS_KEY = "bench", AWS_ENDPOINT_URL_SSM = endpoint,
+        PYTHONDONTWRITEBYTECODE = "1")
+    env.pop('PROFILE', None)
+    result = subprocess.run([sys.executable, "-c", code], cwd = ASSET_DIR, env = env, check = True,
+        text = True, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+    for line in result.stdout.splitlines():
+        if line.startswith("BENCH "):
+            return json.loads(line[len("BENCH "):])
+    raise RuntimeError("benchmark child printed no result:\n" + result.stdout)
+
+
+def median_ms(samples):
+    return statistics.median(samples) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument("--runs", type = int, default = 10)
+    parser.add_argument("--db-host", default = "127.0.0.1")
+    parser.add_argument("--db-port", default = "1")
+    parser.add_argument("--db-user", default = "bench")
+    parser.add_argument("--db-pass", default = "bench")
+    parser.add_argument("--db-name", default = "bench")
+    args = parser.parse_args()
+
+    settings = {"db_host": args.db_host, "db_port": args.db_port, "db_user": args.db_user, "db_pass": args.db_pass}
+    event = {"db_name": args.db_name, "db_env": "bench", "update_pass": "bench_pass"}
+
+    server = parameter_store(settings)
+    endpoint = "http://127.0.0.1:" + str(server.server_address[1])
+    results = [run_once(endpoint, event) for _ in range(args.runs)]
+    server.shutdown()
+    print("runs: " + str(args.runs) + " (fresh process each)")
+    print("init (import app):   %8.1f ms median" % median_ms([result["init"] for result in results]))
+    print("first handler call:  %8.1f ms median" % median_ms([result["first"] for result in results]))
+    print("second handler call: %8.1f ms median" % median_ms([result["second"] for result in results]))
+    loaded = sorted(set(name for result in results for name in result["loaded"]))
+    print("loaded during init:  " + (", ".join(loaded) if loaded else "none of " + ", ".join(WATCHED_MODULES)))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Synth-time benchmark for the task registry (aws_serverless_ops/task_registry.py)
+
+Builds ServerlessOpsTasks with 2 to 200 synthetic tasks ("shard: auto") and reports, per task count:
+- synth time (building the constructs plus writing the cloud assembly)
+- how many nested stacks the registry packed the tasks into
+- resources in the biggest stack. Nested stacks deploy in parallel, so deploy time follows the
+  biggest stack rather than the total, and this has to stay under CloudFormation's 500 limit.
+
+The synthetic task is a stand-in with a fixed number of cheap resources (SSM parameters), so
+the numbers reflect the registry and CDK, not Docker or Lambda bundling.
+
+Usage (from the repo root, with the CDK requirements installed):
+    python benchmarks/bench_task_registry.py [--counts 2,10,50,100,200] [--resources-per-task 20]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aws_cdk as cdk
+from aws_cdk import aws_ssm as ssm
+from constructs import Construct
+
+from aws_serverless_ops.serverless_ops_tasks import ServerlessOpsTasks
+
+
+class SyntheticTask(Construct):
+    """Task stand-in: N SSM parameters and a parameter_readers list, like the real tasks"""
+
+    @classmethod
+    def from_settings(cls, scope, construct_id, task_settings, **shared):
+        return cls(scope, construct_id, task_settings['resources'])
+
+    @classmethod
+    def estimate_resources(cls, task_settings):
+        return task_settings['resources']
+
+    def __init__(self, scope, construct_id, resources):
+        super().__init__(scope, construct_id)
+        for number in range(resources):
+            ssm.StringParameter(self, "Param" + str(number), string_value = "x")
+        self.parameter_readers = []
+
+
+def settings_for(task_count, resources_per_task, max_resources):
+    tasks = {}
+    for number in range(task_count):
+        tasks["task" + str(number)] = {
+            "module": SyntheticTask.__module__,
+            "class": "SyntheticTask",
+            "name": "SyntheticTask" + str(number),
+            "resources": resources_per_task,
+            "shard": "auto",
+        }
+    return {
+        "task_shards": {"max_resources": max_resources},
+        "tasks": {"synthetic": tasks},
+        "parameters": {"databases": {}},
+    }
+
+
+def run(task_count, resources_per_task, max_resources):
+    with tempfile.TemporaryDirectory() as outdir:
+        started = time.perf_counter()
+        app = cdk.App(outdir = outdir)
+        ServerlessOpsTasks(app, "BenchTasksStack",
+            ops_ecs_cluster = None,
+            ops_apigateway = None,
+            settings = settings_for(task_count, resources_per_task, max_resources)
+        )
+        assembly = app.synth()
+        elapsed = time.perf_counter() - started
+
+        stacks = []
+        for name in os.listdir(outdir):
+            if name.endswith(".template.json"):
+                with open(os.path.join(outdir, name)) as file:
+                    stacks.append(len(json.load(file).get("Resources", {})))
+        nested = len(stacks) - len(assembly.stacks)
+    return elapsed, nested, max(stacks), sum(stacks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument("--counts", default = "2,10,50,100,200")
+    parser.add_argument("--resources-per-task", type = int, default = 20)
+    parser.add_argument("--max-resources", type = int, default = 400)
+    args = parser.parse_args()
+
+    print(f"{'tasks':>6} {'synth s':>8} {'stacks':>7} {'biggest':>8} {'total':>7}")
+    for count in [int(value) for value in args.counts.split(",")]:
+        elapsed, nested, biggest, total = run(count, args.resources_per_task, args.max_resources)
+        print(f"{count:>6} {elapsed:>8.2f} {nested:>7} {biggest:>8} {total:>7}")
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark for the mysql-worker container image (docker/mysql-worker)
+
+Reports:
+- image size
+- container start time (docker run of a no-op, what every Fargate task pays before worker.py runs)
+- import time of worker.py inside the container
+- time from container start to the first byte of mysqldump output (needs a reachable MySQL, see --db-host)
+
+Every Fargate task pulls the image and starts a fresh container, so these numbers are paid per job.
+Run it before and after changing the Dockerfile, i.e. build the old one with --dockerfile to compare.
+
+Usage (from the repo root, needs Docker):
+    python benchmarks/bench_worker_image.py [--image TAG | --dockerfile PATH] [--runs 5]
+        [--db-host HOST --db-user USER --db-pass PASS --db-name NAME [--db-port 3306]]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTEXT = os.path.join(REPO_ROOT, "docker", "mysql-worker")
+
+
+def docker(*args, capture = True):
+    return subprocess.run(["docker"] + list(args), check = True, text = True,
+        stdout = subprocess.PIPE if capture else subprocess.DEVNULL, stderr = subprocess.PIPE).stdout
+
+
+def build(tag, dockerfile):
+    started = time.perf_counter()
+    docker("build", "-q", "-t", tag, "-f", dockerfile, CONTEXT)
+    return time.perf_counter() - started
+
+
+def timed_run(image, *command, env = None):
+    """Wall time of docker run, from the client's point of view (includes container start)"""
+    args = ["run", "--rm", "--entrypoint", command[0]]
+    for key, value in (env or {}).items():
+        args += ["-e", key + "=" + value]
+    started = time.perf_counter()
+    output = docker(*(args + [image] + list(command[1:])))
+    return time.perf_counter() - started, output
+
+
+def median_ms(samples):
+    return statistics.median(samples) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument("--image", help = "existing image to measure, skips the build")
+    parser.add_argument("--dockerfile", default = os.path.join(CONTEXT, "Dockerfile"))
+    parser.add_argument("--runs", type = int, default = 5)
+    parser.add_argument("--db-host")
+    parser.add_argument("--db-port", default = "3306")
+    parser.add_argument("--db-user")
+    parser.add_argument("--db-pass")
+    parser.add_argument("--db-name")
+    args = parser.parse_args()
+
+    image = args.image
+    if not image:
+        image = "serverlessops-mysql-worker:bench"
+        print(f"build:              {build(image, args.dockerfile):.1f} s")
+
+    size = int(docker("image", "inspect", "--format", "{{.Size}}", image).strip())
+    print(f"image size:         {size / 1024 / 1024:.1f} MiB")
+
+    starts = [timed_run(image, "true")[0] for _ in range(args.runs)]
+    print(f"container start:    {median_ms(starts):.0f} ms (median of {args.runs})")
+
+    # Measured inside the container so it's just the import, not the container start
+    import_script = "import time; t = time.perf_counter(); import worker; print(time.perf_counter() - t)"
+    imports = [float(timed_run(image, "python", "-c", import_script, env = {"PYTHONPATH": "/app"})[1])
+        for _ in range(args.runs)]
+    print(f"worker.py import:   {median_ms(imports):.0f} ms (median of {args.runs})")
+
+    if args.db_host:
+        # Same mysqldump call as db_backup.sh, stopping at the first byte of output
+        dump = ("mysqldump -u\"$DB_USER\" -h\"$DB_HOST\" -P\"$DB_PORT\" -p\"$DB_PASS\" --databases \"$DB_NAME\""
+            " | head -c 1 > /dev/null")
+        env = {"DB_HOST": args.db_host, "DB_PORT": args.db_port, "DB_USER": args.db_user,
+            "DB_PASS": args.db_pass, "DB_NAME": args.db_name}
+        first_bytes = [timed_run(image, "bash", "-c", dump, env = env)[0] for _ in range(args.runs)]
+        print(f"start to first byte: {median_ms(first_bytes):.0f} ms (median of {args.runs})")
+    else:
+        print("start to first byte: skipped, pass --db-host/--db-user/--db-pass/--db-name to measure")
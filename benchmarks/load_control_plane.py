@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+"""
+Load test for the job submission path (POST /db/backup -> StartExecution -> EcsRunTask) against rate-limited stand-ins
+
+Replays an arrival pattern of job submissions through local stand-ins for API Gateway, the
+job-submit Lambda (lambda/job-submit, when idempotency is enabled), StepFunctions and ECS/Fargate.
+Each service's control plane is a token bucket like the real ones: a bucket of --*-burst tokens,
+refilled at --*-rate a second, one token per call, ThrottlingException (or 429) when it's empty.
+The stand-ins retry the way the deployed pieces do:
+- the client (whoever POSTs to /db/backup) retries 429/5xx and throttled answers, exponential
+  backoff with full jitter, --client-attempts times
+- the job-submit Lambda's StepFunctions client retries throttled calls (botocore's legacy or
+  standard mode, submission: sdk_retry_mode/sdk_max_attempts), until its 30s timeout; API Gateway
+  gives up on it after 29s and answers 504 while it keeps going
+- the state machine retries RunTask errors with the submission: run_task_retry: policy (none: the
+  execution fails)
+Reports per pattern:
+- accepted (the client got an execution ARN) and dispatched (RunTask started the task) latency
+  percentiles, from the job's first POST
+- jobs that never got a task (client gave up, execution failed at RunTask), and extra tasks started
+  for a job (its client retried after a 504 but the first execution still started)
+- throttles per service and call, retries per layer, 504s, the job-submit Lambda's peak concurrency
+
+Time is simulated (a discrete-event loop, not sleeps), so a 500-job burst with minutes of backoff
+runs in a fraction of a second, and --seed makes runs repeatable. Nothing calls AWS.
+
+Defaults come from settings.yml (tasks: fargate: mysql_worker: idempotency:/submission:, and
+api: throttling: for /db/backup/POST), so a run tests what would be deployed; every flag overrides
+one of them. The service limits default to the documented quotas for the large regions (us-east-1,
+us-west-2, eu-west-1 for StepFunctions). Some can be raised, and other regions are lower, so check
+Service Quotas and pass your account's numbers.
+
+    python benchmarks/load_control_plane.py [--pattern burst steady ramp poisson] [--jobs 500] [--rate 20]
+        [--databases 500] [--no-idempotency] [--run-task-retries 8] [--submit-concurrency 0] [--seed 1]
+    python benchmarks/load_control_plane.py --find-saturation [--slo 60]
+"""
+import argparse
+import collections
+import heapq
+import itertools
+import math
+import os
+import random
+
+import yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUBMIT_PATH = "/db/backup/POST"
+
+# How long things take when they aren't throttled, in seconds
+API_LATENCY = 0.015        # API Gateway in and out
+LAMBDA_COLD_START = 0.35   # job-submit's init (boto3 import and client)
+SFN_CALL_LATENCY = 0.03    # one StepFunctions API call from the Lambda
+STATE_TRANSITIONS = 0.1    # StartExecution to the RunMySqlWorker state (JobDefaults, ApplyJobDefaults)
+RUN_TASK_LATENCY = 0.15    # the state machine's RunTask call
+API_TIMEOUT = 29.0         # API Gateway's integration timeout
+LAMBDA_TIMEOUT = 30.0      # job-submit's timeout (task_ecs_mysqlworker.py)
+# lambda/job-submit/app.py
+MAX_NAME_ATTEMPTS = 10
+MAX_LOOKBACK_WINDOWS = 4
+
+
+class Wait:
+    """Yielded by a process to wait for a Future, at most timeout seconds"""
+
+    def __init__(self, future, timeout):
+        self.future = future
+        self.timeout = timeout
+
+
+class Future:
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.waiters = []
+
+
+class Simulation:
+    """
+    A discrete-event loop: processes are generators that yield a delay in seconds (or a Wait), and
+    run when the simulated clock gets there
+    """
+
+    def __init__(self, seed):
+        self.now = 0.0
+        self.queue = []
+        self.order = itertools.count()
+        self.random = random.Random(seed)
+
+    def start(self, process, delay = 0.0, value = None):
+        heapq.heappush(self.queue, (self.now + delay, next(self.order), process, value))
+
+    def resolve(self, future, value):
+        future.done = True
+        future.value = value
+        for process, woken in future.waiters:
+            if not woken[0]:
+                woken[0] = True
+                self.start(process, value = value)
+
+    def run(self):
+        while self.queue:
+            self.now, _, process, value = heapq.heappop(self.queue)
+            try:
+                step = process.send(value)
+            except StopIteration:
+                continue
+            if isinstance(step, Wait):
+                if step.future.done:
+                    self.start(process, value = step.future.value)
+                    continue
+                woken = [False]
+                step.future.waiters.append((process, woken))
+                self.start(self.timer(process, woken), step.timeout)
+            else:
+                self.start(process, step)
+
+    def timer(self, process, woken):
+        # Wakes the waiter with None (timed out), unless the future got there first
+        if not woken[0]:
+            woken[0] = True
+            self.start(process, value = None)
+        return
+        yield
+
+
+class TokenBucket:
+    """burst tokens, refilled at rate a second; burst 0 never throttles"""
+
+    def __init__(self, burst, rate):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated = 0.0
+
+    def take(self, now):
+        if not self.burst:
+            return True
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+def backoff(rng, attempt, base, cap):
+    """Full jitter: anywhere from 0 to base * 2^attempt, at most cap"""
+    return rng.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class ControlPlane:
+    """The stand-ins, the executions they know about, and what happened to each job"""
+
+    def __init__(self, sim, options):
+        self.sim = sim
+        self.options = options
+        self.buckets = {
+            "API Gateway": TokenBucket(options.api_burst, options.api_rate),
+            "DescribeExecution": TokenBucket(options.describe_burst, options.describe_rate),
+            "StartExecution": TokenBucket(options.start_burst, options.start_rate),
+            "RunTask": TokenBucket(options.run_task_burst, options.run_task_rate),
+            "Fargate launches": TokenBucket(options.launch_burst, options.launch_rate),
+        }
+        self.throttles = collections.Counter()
+        self.retries = collections.Counter()
+        self.events = collections.Counter()
+        # job-submit's execution environments
+        self.in_flight = 0
+        self.environments = 0
+        self.peak_in_flight = 0
+        self.vcpus = 0.0
+        # name -> {"key", "status", "stopped"}
+        self.executions = {}
+        self.names = itertools.count()
+        self.first_post = {}
+        self.jobs = {}
+        self.accepted = {}
+        self.dispatched = {}
+        self.tasks = collections.Counter()
+        # Keys that got a task, coalesced jobs are served by their key's
+        self.served = set()
+
+    def admit(self, name):
+        if self.buckets[name].take(self.sim.now):
+            return True
+        self.throttles[name] += 1
+        return False
+
+    # The client
+
+    def client(self, job):
+        """POST /db/backup until it's accepted or out of attempts"""
+        options = self.options
+        self.first_post[job["id"]] = self.sim.now
+        self.jobs[job["id"]] = job["key"]
+        for attempt in range(options.client_attempts):
+            if attempt:
+                self.retries["client"] += 1
+                yield backoff(self.sim.random, attempt - 1, options.client_base, options.client_cap)
+            answer = yield from self.post(job)
+            if answer == "accepted":
+                self.accepted.setdefault(job["id"], self.sim.now)
+                return
+            self.events[answer] += 1
+        self.events["client gave up"] += 1
+
+    def post(self, job):
+        yield API_LATENCY
+        if not self.admit("API Gateway"):
+            return "429 from API Gateway"
+        if not self.options.idempotency:
+            # Direct AwsIntegration: one StartExecution, no retries. Its only integration response has no
+            # selection pattern, so a throttled StartExecution comes back as a 200 without an executionArn
+            yield SFN_CALL_LATENCY
+            if not self.admit("StartExecution"):
+                return "throttled, answered 200"
+            self.start_execution(job, "direct-" + str(next(self.names)))
+            yield API_LATENCY
+            return "accepted"
+
+        # LambdaIntegration: a throttled invoke is a 500, a slow one a 504 after 29s (the function keeps going)
+        if self.in_flight >= self.options.submit_concurrency:
+            self.throttles["job-submit Lambda"] += 1
+            return "500 (Lambda throttled)"
+        result = Future()
+        self.sim.start(self.submit_lambda(job, result))
+        answer = yield Wait(result, API_TIMEOUT)
+        if answer is None:
+            return "504 from API Gateway"
+        yield API_LATENCY
+        return answer
+
+    # lambda/job-submit/app.py
+
+    def submit_lambda(self, job, result):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        deadline = self.sim.now + LAMBDA_TIMEOUT
+        if self.in_flight > self.environments:
+            self.environments += 1
+            yield LAMBDA_COLD_START
+        try:
+            answer = yield from self.submit(job, deadline)
+        finally:
+            self.in_flight -= 1
+        self.sim.resolve(result, answer)
+
+    def sdk_call(self, name, deadline):
+        """One StepFunctions call with botocore's retries. Response: whether it got through"""
+        options = self.options
+        for attempt in range(options.sdk_max_attempts):
+            if attempt:
+                self.retries["job-submit SDK"] += 1
+                # legacy and standard both back off rand * 2^attempt, standard caps it at 20s
+                delay = self.sim.random.random() * 2 ** (attempt - 1)
+                if options.sdk_retry_mode != "legacy":
+                    delay = min(delay, 20.0)
+                if self.sim.now + delay > deadline:
+                    return None
+                yield delay
+            yield SFN_CALL_LATENCY
+            if self.admit(name):
+                return True
+        return False
+
+    def submit(self, job, deadline):
+        options = self.options
+        key = job["key"]
+        window = int(self.sim.now // options.window_seconds)
+        lookback = min(MAX_LOOKBACK_WINDOWS, max(1, math.ceil(options.freshness_seconds / options.window_seconds)))
+        # Earlier windows' names, described until the first one that doesn't exist
+        for earlier in range(window - 1, window - 1 - lookback, -1):
+            for attempt in range(MAX_NAME_ATTEMPTS):
+                ok = yield from self.sdk_call("DescribeExecution", deadline)
+                if not ok:
+                    return "timed out" if ok is None else "503 (DescribeExecution throttled)"
+                existing = self.executions.get("%s-%d-%d" % (key, earlier, attempt))
+                if existing is None:
+                    break
+                if self.reusable(existing):
+                    self.events["coalesced"] += 1
+                    return "accepted"
+        for attempt in range(MAX_NAME_ATTEMPTS):
+            name = "%s-%d-%d" % (key, window, attempt)
+            ok = yield from self.sdk_call("StartExecution", deadline)
+            if not ok:
+                return "timed out" if ok is None else "503 (StartExecution throttled)"
+            existing = self.executions.get(name)
+            if existing is None:
+                self.start_execution(job, name)
+                return "accepted"
+            if existing["status"] == "RUNNING":
+                # Same name and input as a running execution: StartExecution hands back its ARN
+                self.events["coalesced"] += 1
+                return "accepted"
+            # ExecutionAlreadyExists, described to see whether it can be reused
+            ok = yield from self.sdk_call("DescribeExecution", deadline)
+            if not ok:
+                return "timed out" if ok is None else "503 (DescribeExecution throttled)"
+            if self.reusable(existing):
+                self.events["coalesced"] += 1
+                return "accepted"
+        return "429 (out of execution names)"
+
+    def reusable(self, execution):
+        if execution["status"] == "RUNNING":
+            return True
+        return execution["status"] == "SUCCEEDED" and self.sim.now - execution["stopped"] <= self.options.freshness_seconds
+
+    # The state machine and ECS
+
+    def start_execution(self, job, name):
+        self.executions[name] = {"key": job["key"], "status": "RUNNING", "stopped": None}
+        self.sim.start(self.execution(job, name))
+
+    def finish(self, name, status):
+        execution = self.executions[name]
+        execution["status"] = status
+        execution["stopped"] = self.sim.now
+
+    def execution(self, job, name):
+        options = self.options
+        yield STATE_TRANSITIONS
+        for attempt in range(options.run_task_retries + 1):
+            if attempt:
+                self.retries["state machine"] += 1
+                delay = min(options.run_task_max_delay, options.run_task_interval * options.run_task_backoff ** (attempt - 1))
+                yield self.sim.random.uniform(0, delay) if options.run_task_jitter else delay
+            yield RUN_TASK_LATENCY
+            if not self.admit("RunTask") or not self.admit("Fargate launches"):
+                continue
+            if options.vcpu_quota and self.vcpus + options.task_vcpus > options.vcpu_quota:
+                self.throttles["vCPU quota"] += 1
+                continue
+            self.vcpus += options.task_vcpus
+            self.dispatched.setdefault(job["id"], self.sim.now)
+            self.served.add(job["key"])
+            self.tasks[job["id"]] += 1
+            yield options.job_seconds
+            self.vcpus -= options.task_vcpus
+            self.finish(name, "SUCCEEDED")
+            return
+        self.events["execution failed at RunTask"] += 1
+        self.finish(name, "FAILED")
+
+
+def arrivals(pattern, jobs, rate, rng):
+    """Submission times for jobs jobs arriving at rate a second (burst: all at once)"""
+    if pattern == "burst":
+        return [0.0] * jobs
+    if pattern == "steady":
+        return [number / rate for number in range(jobs)]
+    if pattern == "ramp":
+        # From 0 up to rate a second, linearly, until the last job
+        duration = 2.0 * jobs / rate
+        return [math.sqrt(2.0 * duration * number / rate) for number in range(jobs)]
+    if pattern == "poisson":
+        times, now = [], 0.0
+        for number in range(jobs):
+            times.append(now)
+            now += rng.expovariate(rate)
+        return times
+    raise ValueError("unknown pattern " + pattern)
+
+
+def percentile(values, share):
+    """Nearest-rank percentile, None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(share / 100.0 * len(ordered)) - 1))]
+
+
+def run(options, pattern, rate):
+    sim = Simulation(options.seed)
+    plane = ControlPlane(sim, options)
+    for number, at in enumerate(arrivals(pattern, options.jobs, rate, sim.random)):
+        job = {"id": number, "key": "db_backup-db%04d-demo" % (number % options.databases)}
+        sim.start(plane.client(job), at)
+    sim.run()
+    return plane
+
+
+def summarize(plane):
+    first = plane.first_post
+    accepted = [at - first[job] for job, at in plane.accepted.items()]
+    dispatched = [at - first[job] for job, at in plane.dispatched.items()]
+    return {
+        "accepted": accepted,
+        "dispatched": dispatched,
+        "lost": sum(1 for job in first if plane.jobs[job] not in plane.served),
+        "extra tasks": sum(count - 1 for count in plane.tasks.values()),
+    }
+
+
+def fmt(value):
+    return "-" if value is None else "%.1f" % value
+
+
+def print_report(options, results):
+    print("%-8s %6s %8s %8s %6s %5s | %6s %6s | %6s %6s %6s %6s" % ("pattern", "jobs", "accepted", "tasks", "lost", "extra",
+        "acc50", "acc99", "run50", "run90", "run99", "max"))
+    for pattern, plane in results:
+        summary = summarize(plane)
+        accepted, dispatched = summary["accepted"], summary["dispatched"]
+        print("%-8s %6d %8d %8d %6d %5d | %6s %6s | %6s %6s %6s %6s" % (pattern, options.jobs, len(accepted), len(dispatched),
+            summary["lost"], summary["extra tasks"], fmt(percentile(accepted, 50)), fmt(percentile(accepted, 99)),
+            fmt(percentile(dispatched, 50)), fmt(percentile(dispatched, 90)), fmt(percentile(dispatched, 99)),
+            fmt(max(dispatched) if dispatched else None)))
+    print("(seconds from the job's first POST: acc = the client got an execution ARN, run = RunTask started its task)")
+    print()
+    for pattern, plane in results:
+        print(pattern + ":")
+        print("  throttled: " + (", ".join("%s %d" % item for item in sorted(plane.throttles.items())) or "none"))
+        print("  retries:   " + (", ".join("%s %d" % item for item in sorted(plane.retries.items())) or "none"))
+        print("  answers:   " + (", ".join("%s %d" % item for item in sorted(plane.events.items())) or "none"))
+        if options.idempotency:
+            print("  job-submit peak concurrency %d" % plane.peak_in_flight)
+
+
+def find_saturation(options):
+    """The highest steady rate (jobs a second) where every job gets a task within --slo seconds"""
+
+    def holds(rate):
+        summary = summarize(run(options, "steady", rate))
+        return not summary["lost"] and len(summary["dispatched"]) == options.jobs and max(summary["dispatched"]) <= options.slo
+
+    low, high = 0.0, 1.0
+    while holds(high):
+        low, high = high, high * 2
+        if high > 10000:
+            return low, None
+    for step in range(12):
+        middle = (low + high) / 2
+        if holds(middle):
+            low = middle
+        else:
+            high = middle
+    return low, high
+
+
+def settings_defaults(path):
+    """The flags' defaults, from what settings.yml would deploy"""
+    with open(path) as file:
+        settings = yaml.safe_load(file)
+    worker = settings.get("tasks", {}).get("fargate", {}).get("mysql_worker", {})
+    idempotency = worker.get("idempotency") or {}
+    submission = worker.get("submission") or {}
+    run_task_retry = submission.get("run_task_retry") or {}
+    api_throttle = ((settings.get("api") or {}).get("throttling") or {}).get(SUBMIT_PATH) or {}
+    return {
+        "idempotency": bool(idempotency.get("enabled")),
+        "window_seconds": idempotency.get("window_seconds", 900),
+        "freshness_seconds": idempotency.get("freshness_seconds", 0),
+        "submit_concurrency": submission.get("submit_concurrency") or 1000,
+        "sdk_retry_mode": submission.get("sdk_retry_mode", "legacy"),
+        "sdk_max_attempts": submission.get("sdk_max_attempts") or (5 if submission.get("sdk_retry_mode", "legacy") == "legacy" else 3),
+        "run_task_retries": run_task_retry.get("max_attempts", 0),
+        "run_task_interval": run_task_retry.get("interval_seconds", 1),
+        "run_task_backoff": run_task_retry.get("backoff_rate", 2.0),
+        "run_task_max_delay": run_task_retry.get("max_delay_seconds", 60),
+        "run_task_jitter": run_task_retry.get("jitter", False),
+        # A stage's method throttling, or the account's API Gateway limit
+        "api_rate": api_throttle.get("rate_limit", 10000),
+        "api_burst": api_throttle.get("burst_limit", 5000),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument("--settings", default = os.path.join(REPO_ROOT, "settings.yml"))
+    parser.add_argument("--pattern", nargs = "+", default = ["burst", "steady", "ramp", "poisson"], choices = ["burst", "steady", "ramp", "poisson"])
+    parser.add_argument("--jobs", type = int, default = 500)
+    parser.add_argument("--rate", type = float, default = 20, help = "jobs a second (steady, poisson; ramp's peak)")
+    parser.add_argument("--databases", type = int, help = "distinct db/env pairs the jobs spread over (default: one per job, nothing coalesces)")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--find-saturation", action = "store_true", help = "search for the highest steady rate that meets --slo")
+    parser.add_argument("--slo", type = float, default = 60, help = "seconds from POST to a started task, for --find-saturation")
+    parser.add_argument("--job-seconds", type = float, default = 300, help = "how long each task runs (holds vCPUs, stays RUNNING)")
+    # What settings.yml would deploy
+    parser.add_argument("--idempotency", action = argparse.BooleanOptionalAction, help = "job-submit Lambda in front of StartExecution")
+    parser.add_argument("--window-seconds", type = int)
+    parser.add_argument("--freshness-seconds", type = int)
+    parser.add_argument("--submit-concurrency", type = int, help = "job-submit's reserved concurrency (unreserved: 1000)")
+    parser.add_argument("--sdk-retry-mode", choices = ["legacy", "standard", "adaptive"], help = "adaptive is simulated as standard")
+    parser.add_argument("--sdk-max-attempts", type = int)
+    parser.add_argument("--run-task-retries", type = int, help = "state machine retries of a failed RunTask (Retry MaxAttempts)")
+    parser.add_argument("--run-task-interval", type = float)
+    parser.add_argument("--run-task-backoff", type = float)
+    parser.add_argument("--run-task-max-delay", type = float)
+    parser.add_argument("--run-task-jitter", action = argparse.BooleanOptionalAction)
+    parser.add_argument("--api-rate", type = float, help = "POST /db/backup requests a second (stage throttling)")
+    parser.add_argument("--api-burst", type = int)
+    # The client
+    parser.add_argument("--client-attempts", type = int, default = 6)
+    parser.add_argument("--client-base", type = float, default = 0.5, help = "client backoff base, seconds")
+    parser.add_argument("--client-cap", type = float, default = 30)
+    # Service limits (burst, refill a second)
+    parser.add_argument("--describe-burst", type = int, default = 250)
+    parser.add_argument("--describe-rate", type = float, default = 25, help = "DescribeExecution")
+    parser.add_argument("--start-burst", type = int, default = 1300)
+    parser.add_argument("--start-rate", type = float, default = 300, help = "StartExecution (800/150 outside the large regions)")
+    parser.add_argument("--run-task-burst", type = int, default = 100)
+    parser.add_argument("--run-task-rate", type = float, default = 40, help = "ECS RunTask calls")
+    parser.add_argument("--launch-burst", type = int, default = 100)
+    parser.add_argument("--launch-rate", type = float, default = 20, help = "Fargate task launches")
+    parser.add_argument("--vcpu-quota", type = float, default = 0, help = "Fargate On-Demand vCPUs, 0: don't model it")
+    parser.add_argument("--task-vcpus", type = float, default = 0.25, help = "the worker task's cpu (256 = 0.25)")
+    parser.set_defaults(**settings_defaults(parser.parse_known_args()[0].settings))
+    args = parser.parse_args()
+    args.databases = args.databases or args.jobs
+
+    if args.idempotency:
+        submit = "job-submit Lambda (concurrency %d, %s retries x%d)" % (args.submit_concurrency, args.sdk_retry_mode, args.sdk_max_attempts)
+    else:
+        submit = "direct StartExecution"
+    print("%s; RunTask retries %d (interval %gs, backoff %g, max %gs%s); API %g/s burst %d" % (submit, args.run_task_retries,
+        args.run_task_interval, args.run_task_backoff, args.run_task_max_delay, ", jitter" if args.run_task_jitter else "",
+        args.api_rate, args.api_burst))
+    if args.find_saturation:
+        low, high = find_saturation(args)
+        if high is None:
+            print("every job got a task within %gs at %g jobs a second, the stand-ins didn't saturate" % (args.slo, low))
+        else:
+            print("%d jobs at a steady rate: every job gets a task within %gs up to %.2f jobs a second" % (args.jobs, args.slo, low))
+    else:
+        print("%d jobs over %d databases, %g jobs a second" % (args.jobs, args.databases, args.rate))
+        print_report(args, [(pattern, run(args, pattern, args.rate)) for pattern in args.pattern])
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Load test for the S3 key layouts (docker/mysql-worker/layout.py) against a local S3 stand-in
+
+A fleet of workers uploads export parts and backups at once, through each layout, to an in-memory
+S3 that, like the real one, limits requests per prefix: past --limit requests a second in one
+prefix it answers SlowDown, and the client backs off and retries (exponential, with jitter, like
+the SDK's standard retry mode). Reports per layout:
+- how requests spread over prefixes (prefixes used, busiest prefix's share, top prefixes)
+- SlowDown answers, retries, uploads that gave up (out of attempts), elapsed time and requests a second
+
+The stand-in's prefixes are the key up to --prefix-chars characters past s3_path/, a simplified
+version of S3 splitting busy key ranges into partitions. --limit defaults well below S3's 3,500
+writes a second per prefix so the run takes seconds; what matters is the ratio of the fleet's
+rate to the limit.
+
+    python benchmarks/load_s3_layout.py [--workers 32] [--objects 2000] [--limit 250] [--prefix-chars 2]
+"""
+import argparse
+import collections
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "docker", "mysql-worker"))
+
+import envelope
+from layout import KeyLayout
+
+S3_PATH = "backups/fleet"
+
+
+class SlowDown(Exception):
+    """S3's 503 SlowDown"""
+
+
+class PrefixLimitedS3(envelope.LocalS3):
+    """LocalS3 that allows at most limit requests a second per prefix, and counts them"""
+
+    def __init__(self, limit, prefix_chars, root = S3_PATH):
+        super().__init__(keep = False)
+        self.limit = limit
+        self.prefix_length = len(root.strip("/")) + 1 + prefix_chars
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.requests = collections.Counter()
+        self.slowdowns = 0
+
+    def prefix(self, key):
+        return key[:self.prefix_length]
+
+    def _admit(self, key):
+        prefix = self.prefix(key)
+        second = int(time.monotonic())
+        with self.lock:
+            window = self.windows.get(prefix)
+            if window is None or window[0] != second:
+                window = self.windows[prefix] = [second, 0]
+            if window[1] >= self.limit:
+                self.slowdowns += 1
+                raise SlowDown(prefix)
+            window[1] += 1
+            self.requests[prefix] += 1
+
+    def put_object(self, Bucket, Key, Body):
+        self._admit(Key)
+        super().put_object(Bucket, Key, Body)
+
+
+def put_with_retries(s3, bucket, key, body, attempts = 10, base = 0.05, cap = 2.0):
+    """Response: (retries it took, whether it made it)"""
+    for attempt in range(attempts):
+        try:
+            s3.put_object(Bucket = bucket, Key = key, Body = body)
+            return attempt, True
+        except SlowDown:
+            time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+    return attempts, False
+
+
+def fleet_names(objects, databases = 8, tables = 12):
+    """Logical names as a fleet of exports and backups produces them"""
+    names = []
+    stamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+    for number in range(objects):
+        db = "db%02d" % (number % databases)
+        if number % 10 == 0:
+            names.append(db + "-" + stamp + "-%05d.sql.gz.enc" % number)
+        else:
+            names.append("exports/" + db + "-" + stamp + "/table%02d/part-%05d.csv.gz" % (number % tables, number))
+    return names
+
+
+def run(layout, names, workers, limit, prefix_chars):
+    s3 = PrefixLimitedS3(limit, prefix_chars)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        results = list(pool.map(lambda name: put_with_retries(s3, "bench", layout.physical(S3_PATH, name), b"x"), names))
+    retries = sum(retries for retries, ok in results)
+    failed = sum(1 for retries, ok in results if not ok)
+    return s3, retries, failed, time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument("--workers", type = int, default = 32, help = "uploads in flight across the fleet")
+    parser.add_argument("--objects", type = int, default = 2000)
+    parser.add_argument("--limit", type = int, default = 250, help = "requests a second per prefix")
+    parser.add_argument("--prefix-chars", type = int, default = 2, help = "hashed layout's shard length, and the stand-in's prefix length")
+    args = parser.parse_args()
+
+    names = fleet_names(args.objects)
+    print("%d objects, %d workers, %d requests/s per prefix" % (len(names), args.workers, args.limit))
+    print("%-12s %8s %8s %8s %8s %6s %8s %7s  %s" % ("layout", "prefixes", "busiest", "slowdown", "retries", "failed", "seconds",
+        "req/s", "top prefixes"))
+    for layout in (KeyLayout("flat"), KeyLayout("hashed", args.prefix_chars)):
+        s3, retries, failed, seconds = run(layout, names, args.workers, args.limit, args.prefix_chars)
+        total = sum(s3.requests.values())
+        top = ", ".join("%s %.1f%%" % (prefix[len(S3_PATH) + 1:] + "*", 100 * count / total) for prefix, count in s3.requests.most_common(3))
+        print("%-12s %8d %7.1f%% %8d %8d %6d %8.2f %7.0f  %s" % (layout.strategy + (" (" + str(layout.prefix_chars) + ")" if layout.hashed else ""),
+            len(s3.requests), 100 * max(s3.requests.values()) / total, s3.slowdowns, retries, failed, seconds, total / seconds, top))
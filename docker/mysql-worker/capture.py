@@ -0,0 +1,160 @@
+import os
+import re
+import time
+import threading
+import subprocess
+from collections import deque
+
+"""
+Bounded capture of a subprocess's output (db_backup.sh and the tools it calls).
+
+Three jobs:
+- Tail: keeps the last N stderr lines in a fixed-size ring buffer, which is what a failure report
+  needs. Memory stays flat however much the script writes, and nothing is re-copied per line.
+- LogLimiter: what reaches stdout (and so CloudWatch Logs). Runs of lines that only differ in their
+  numbers (progress counters, "row 1234 ..." warnings) are collapsed into one summary line, and at
+  most LOG_LINES_PER_SECOND lines a second get through, the rest are counted and reported as
+  "[N lines suppressed]". Less to ingest, and less worker CPU spent printing.
+- truncate(): StepFunctions' SendTaskFailure rejects an error over 256 characters or a cause over
+  32768, so failure payloads are cut to fit (the cause keeps its end, where the actual error is).
+
+Settings (environment):
+  CAPTURE_TAIL_LINES     stderr lines kept for failure reports (default 200)
+  LOG_LINES_PER_SECOND   log lines let through per second (default 50)
+"""
+
+# SendTaskFailure limits, see https://docs.aws.amazon.com/step-functions/latest/apireference/API_SendTaskFailure.html
+ERROR_LIMIT = 256
+CAUSE_LIMIT = 32768
+
+# Longest single line kept or logged, a runaway line (a binary blob, a huge INSERT) is cut to this
+MAX_LINE = 2048
+
+TRUNCATED = "[...truncated]"
+
+
+def truncate(text, limit, keep_end = False):
+    """Cut text to at most limit characters, marking the cut. keep_end keeps the last part instead of the first"""
+    text = str(text)
+    if len(text) <= limit:
+        return text
+    if limit <= len(TRUNCATED):
+        return text[:limit]
+    if keep_end:
+        return TRUNCATED + text[len(text) - (limit - len(TRUNCATED)):]
+    return text[:limit - len(TRUNCATED)] + TRUNCATED
+
+
+class Tail:
+    """The last `lines` lines added, in a ring buffer"""
+
+    def __init__(self, lines = None):
+        self.lines = deque(maxlen = lines or int(os.environ.get('CAPTURE_TAIL_LINES', '200')))
+        self.total = 0
+
+    def add(self, line):
+        self.lines.append(truncate(line.rstrip("\n"), MAX_LINE))
+        self.total += 1
+
+    def text(self):
+        """The kept lines, noting how many were dropped before them"""
+        text = "\n".join(self.lines)
+        if self.total > len(self.lines):
+            text = "[last " + str(len(self.lines)) + " of " + str(self.total) + " lines]\n" + text
+        return text
+
+
+class LogLimiter:
+    """Writes lines, collapsing runs of similar lines and capping the lines written per second"""
+
+    def __init__(self, lines_per_second = None, write = print, clock = time.monotonic):
+        self.lines_per_second = lines_per_second or int(os.environ.get('LOG_LINES_PER_SECOND', '50'))
+        self.write = write
+        self.clock = clock
+        self.suppressed_total = 0
+        self._suppressed = 0
+        self._window = None
+        self._written = 0
+        self._last = None
+        self._repeats = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _shape(line):
+        # Lines that only differ in their numbers count as repeats
+        return re.sub(r"\d+", "#", line)
+
+    def line(self, line):
+        line = truncate(line.strip(), MAX_LINE)
+        with self._lock:
+            shape = self._shape(line)
+            if shape == self._last:
+                self._repeats += 1
+                return
+            self._flush_repeats()
+            self._last = shape
+            self._emit(line)
+
+    def _flush_repeats(self):
+        if self._repeats:
+            self._emit("[" + str(self._repeats) + " more lines like the previous one]")
+            self._repeats = 0
+
+    def _flush_suppressed(self):
+        if self._suppressed:
+            self.write("[" + str(self._suppressed) + " lines suppressed]")
+            self._suppressed = 0
+
+    def _emit(self, line):
+        now = self.clock()
+        if self._window is None or now - self._window >= 1:
+            self._flush_suppressed()
+            self._window = now
+            self._written = 0
+        if self._written < self.lines_per_second:
+            self._written += 1
+            self.write(line)
+        else:
+            self._suppressed += 1
+            self.suppressed_total += 1
+
+    def close(self):
+        """Write out whatever is still being held back (pending repeat/suppressed counts)"""
+        with self._lock:
+            self._flush_repeats()
+            self._flush_suppressed()
+            self._last = None
+
+
+def run_captured(command, on_stdout = None, tail = None, log = None, env = None):
+    """
+    Run command, logging its output through a LogLimiter and keeping a Tail of its stderr
+
+    on_stdout, callable = called with every stdout line (all of them, whatever the log shows),
+                          i.e. to parse db_backup.sh's markers
+    env, dict = the command's environment (default: this process's)
+
+    stderr is read on its own thread, so neither pipe can fill up and stall the script while we
+    wait on the other one.
+
+    Response: (return code, Tail of stderr, LogLimiter)
+    """
+    tail = tail or Tail()
+    log = log or LogLimiter()
+    process = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.PIPE, text = True, errors = "replace", env = env)
+
+    def read_stderr():
+        for line in process.stderr:
+            tail.add(line)
+            log.line(line)
+
+    reader = threading.Thread(target = read_stderr, daemon = True)
+    reader.start()
+    for line in process.stdout:
+        log.line(line)
+        if on_stdout:
+            on_stdout(line)
+    process.wait()
+    reader.join()
+    log.close()
+    return process.returncode, tail, log
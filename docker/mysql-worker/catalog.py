@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+from decimal import Decimal
+
+"""
+Backup catalog: one entry per finished backup, so "latest good backup of X before T" is a
+single indexed lookup instead of listing S3 prefixes and parsing key names.
+
+Each entry records:
+  db_name, db_env        which database/environment was backed up
+  created_at             when the backup finished (epoch seconds)
+  size_bytes             size of what was uploaded
+  codec                  how the objects are packed, i.e. "tar+gzip"
+  checksum               sha256 of the uploaded object(s)
+  binlog_file/position   binlog coordinates of the dump, if mysqldump recorded them (--master-data=2)
+  s3_bucket, object_keys where the backup lives
+  status                 "complete" (only complete backups are returned by the lookups)
+
+Two stores with the same methods:
+- DynamoCatalog: the deployed catalog, a DynamoDB table keyed on db#env + created_at
+  (the CDK creates it and passes its name to the task as CATALOG_TABLE)
+- SqliteCatalog: a local stand-in for tests and running the worker outside AWS (CATALOG_SQLITE=path)
+
+Lookups, also available from the command line (python catalog.py --help):
+  latest(db, env)               most recent complete backup
+  latest(db, env, before=T)     point-in-time: most recent complete backup at or before T
+  size_history(db, env, ...)    (created_at, size_bytes) over time, for growth reports
+"""
+
+STATUS_COMPLETE = "complete"
+
+
+def make_entry(db_name, db_env, s3_bucket, object_keys, size_bytes, checksum, codec,
+        binlog_file = None, binlog_position = None, created_at = None, status = STATUS_COMPLETE):
+    """Build a catalog entry (a plain dict, the same shape both stores return)"""
+    return {
+        "db_name": db_name,
+        "db_env": db_env,
+        "created_at": created_at if created_at is not None else time.time(),
+        "size_bytes": int(size_bytes),
+        "codec": codec,
+        "checksum": checksum,
+        "binlog_file": binlog_file,
+        "binlog_position": int(binlog_position) if binlog_position is not None else None,
+        "s3_bucket": s3_bucket,
+        "object_keys": list(object_keys),
+        "status": status,
+    }
+
+
+class SqliteCatalog:
+    """Catalog stored in a local SQLite file (or ":memory:")"""
+
+    COLUMNS = ["db_name", "db_env", "created_at", "size_bytes", "codec", "checksum", "binlog_file",
+        "binlog_position", "s3_bucket", "object_keys", "status"]
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS backups (" + ", ".join(self.COLUMNS) + ")")
+        # Every lookup is "this db/env, ordered by time", so that's the index
+        self.conn.execute("CREATE INDEX IF NOT EXISTS backups_by_db ON backups (db_name, db_env, created_at)")
+
+    def put(self, entry):
+        row = dict(entry, object_keys = json.dumps(entry["object_keys"]))
+        with self.conn:
+            self.conn.execute("INSERT INTO backups VALUES (" + ", ".join("?" * len(self.COLUMNS)) + ")",
+                [row[column] for column in self.COLUMNS])
+
+    def _entries(self, where, args, order, limit = None):
+        query = "SELECT " + ", ".join(self.COLUMNS) + " FROM backups WHERE " + where + " ORDER BY created_at " + order
+        if limit:
+            query += " LIMIT " + str(int(limit))
+        entries = []
+        for row in self.conn.execute(query, args):
+            entry = dict(zip(self.COLUMNS, row))
+            entry["object_keys"] = json.loads(entry["object_keys"])
+            entries.append(entry)
+        return entries
+
+    def latest(self, db_name, db_env, before = None):
+        where = "db_name = ? AND db_env = ? AND status = ?"
+        args = [db_name, db_env, STATUS_COMPLETE]
+        if before is not None:
+            where += " AND created_at <= ?"
+            args.append(before)
+        entries = self._entries(where, args, "DESC", limit = 1)
+        return entries[0] if entries else None
+
+    def size_history(self, db_name, db_env, since = None, until = None):
+        where = "db_name = ? AND db_env = ? AND status = ?"
+        args = [db_name, db_env, STATUS_COMPLETE]
+        if since is not None:
+            where += " AND created_at >= ?"
+            args.append(since)
+        if until is not None:
+            where += " AND created_at <= ?"
+            args.append(until)
+        return [(entry["created_at"], entry["size_bytes"]) for entry in self._entries(where, args, "ASC")]
+
+    def entries(self, db_name, db_env):
+        """Every complete backup of a db/env, oldest first"""
+        return self._entries("db_name = ? AND db_env = ? AND status = ?", [db_name, db_env, STATUS_COMPLETE], "ASC")
+
+    def remove_many(self, entries):
+        """Drop entries (i.e. backups expired by retention.py)"""
+        with self.conn:
+            self.conn.executemany("DELETE FROM backups WHERE db_name = ? AND db_env = ? AND created_at = ?",
+                [(entry["db_name"], entry["db_env"], entry["created_at"]) for entry in entries])
+
+
+class DynamoCatalog:
+    """
+    Catalog stored in DynamoDB
+
+    Table layout: partition key "db_key" (string, "db_name#db_env"), sort key "created_at" (number),
+    so every lookup is a Query on one partition, never a Scan.
+    """
+
+    def __init__(self, table_name, resource = None):
+        if resource is None:
+            import boto3
+            resource = boto3.resource('dynamodb')
+        self.table = resource.Table(table_name)
+
+    @staticmethod
+    def db_key(db_name, db_env):
+        return db_name + "#" + db_env
+
+    @staticmethod
+    def _to_item(entry):
+        item = {key: value for key, value in entry.items() if value is not None}
+        # DynamoDB numbers have to be Decimals
+        item["created_at"] = Decimal(str(entry["created_at"]))
+        item["db_key"] = DynamoCatalog.db_key(entry["db_name"], entry["db_env"])
+        return item
+
+    @staticmethod
+    def _from_item(item):
+        entry = {key: item.get(key) for key in SqliteCatalog.COLUMNS}
+        entry["created_at"] = float(item["created_at"])
+        entry["size_bytes"] = int(item["size_bytes"])
+        if entry["binlog_position"] is not None:
+            entry["binlog_position"] = int(entry["binlog_position"])
+        entry["object_keys"] = list(item.get("object_keys", []))
+        return entry
+
+    def put(self, entry):
+        self.table.put_item(Item = self._to_item(entry))
+
+    def _query(self, condition, forward, limit = None):
+        """Yield complete entries page by page (status is filtered after the key condition)"""
+        from boto3.dynamodb.conditions import Attr
+        kwargs = {
+            "KeyConditionExpression": condition,
+            "FilterExpression": Attr("status").eq(STATUS_COMPLETE),
+            "ScanIndexForward": forward,
+        }
+        if limit:
+            kwargs["Limit"] = limit
+        while True:
+            response = self.table.query(**kwargs)
+            for item in response["Items"]:
+                yield self._from_item(item)
+            if "LastEvaluatedKey" not in response:
+                return
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def latest(self, db_name, db_env, before = None):
+        from boto3.dynamodb.conditions import Key
+        condition = Key("db_key").eq(self.db_key(db_name, db_env))
+        if before is not None:
+            condition = condition & Key("created_at").lte(Decimal(str(before)))
+        # Small pages, newest first: normally the first item is the answer
+        for entry in self._query(condition, forward = False, limit = 10):
+            return entry
+        return None
+
+    def size_history(self, db_name, db_env, since = None, until = None):
+        from boto3.dynamodb.conditions import Key
+        condition = Key("db_key").eq(self.db_key(db_name, db_env))
+        low = Decimal(str(since)) if since is not None else Decimal(0)
+        high = Decimal(str(until)) if until is not None else Decimal(str(time.time() + 86400))
+        condition = condition & Key("created_at").between(low, high)
+        return [(entry["created_at"], entry["size_bytes"]) for entry in self._query(condition, forward = True)]
+
+    def entries(self, db_name, db_env):
+        """Every complete backup of a db/env, oldest first"""
+        from boto3.dynamodb.conditions import Key
+        condition = Key("db_key").eq(self.db_key(db_name, db_env))
+        return list(self._query(condition, forward = True))
+
+    def remove_many(self, entries):
+        """Drop entries (i.e. backups expired by retention.py), batched 25 per request by boto3"""
+        with self.table.batch_writer() as batch:
+            for entry in entries:
+                batch.delete_item(Key = {
+                    "db_key": self.db_key(entry["db_name"], entry["db_env"]),
+                    "created_at": Decimal(str(entry["created_at"]))
+                })
+
+
+def open_catalog():
+    """The catalog configured for this environment (CATALOG_TABLE or CATALOG_SQLITE), or None"""
+    if os.environ.get('CATALOG_TABLE'):
+        return DynamoCatalog(os.environ['CATALOG_TABLE'])
+    if os.environ.get('CATALOG_SQLITE'):
+        return SqliteCatalog(os.environ['CATALOG_SQLITE'])
+    return None
+
+
+def _parse_time(value):
+    """Accept epoch seconds or an ISO-8601 timestamp (UTC if no offset is given)"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        from datetime import datetime, timezone
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo = timezone.utc)
+        return parsed.timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Query the backup catalog")
+    parser.add_argument("--table", default = os.environ.get('CATALOG_TABLE'), help = "DynamoDB table name")
+    parser.add_argument("--sqlite", default = os.environ.get('CATALOG_SQLITE'), help = "local SQLite catalog")
+    parser.add_argument("query", choices = ["latest", "size-history"])
+    parser.add_argument("db_name")
+    parser.add_argument("db_env")
+    parser.add_argument("--before", help = "point-in-time: latest backup at or before this time (epoch or ISO-8601)")
+    parser.add_argument("--since", help = "size-history start (epoch or ISO-8601)")
+    parser.add_argument("--until", help = "size-history end (epoch or ISO-8601)")
+    args = parser.parse_args()
+
+    catalog = DynamoCatalog(args.table) if args.table else SqliteCatalog(args.sqlite or ":memory:")
+    if args.query == "latest":
+        print(json.dumps(catalog.latest(args.db_name, args.db_env, before = _parse_time(args.before)), indent = 2))
+    else:
+        history = catalog.size_history(args.db_name, args.db_env, since = _parse_time(args.since), until = _parse_time(args.until))
+        print(json.dumps([{"created_at": created_at, "size_bytes": size} for created_at, size in history], indent = 2))
@@ -6,33 +6,96 @@ PORT=$2
 USER=$3
 PASSWORD=$4
 DATABASES=$5
-s3_bucket=$6
-s3_path=$7
+# Where to leave the compressed dumps, worker.py uploads them to S3
+db_dir=${6:-/tmp/db_backups}
+# Optional FIFO: the compressed dump is streamed into it instead of being left in db_dir, and worker.py
+# encrypts/checksums and uploads it as it arrives (see envelope.py)
+stream_to=$7
 
 #HOST=serverlessops1.cluster-czpi934xq9hf.us-east-1.rds.amazonaws.com
 #USER=admin
 #PASSWORD=Password01
 
-db_dir=/tmp/db_backups
 date_format=`date +%Y-%m-%d_%H-%M`
-#s3_bucket=aws-acd-serverlessops-backups
-#s3_path=$HOST
+
+# mysqldump with the given arguments, through the rate-limiting relay when worker.py is throttling to
+# the server's load (THROTTLE_RATE_FILE, see throttle.py). Fails if either does.
+dump() {
+  if [ -n "$THROTTLE_RATE_FILE" ]; then
+    mysqldump -u$USER -h$HOST -P$PORT -p$PASSWORD $MYSQLDUMP_OPTS "$@" | python ./throttle.py relay "$THROTTLE_RATE_FILE"
+    local status=("${PIPESTATUS[@]}")
+    [ ${status[0]} -eq 0 ] && [ ${status[1]} -eq 0 ]
+  else
+    mysqldump -u$USER -h$HOST -P$PORT -p$PASSWORD $MYSQLDUMP_OPTS "$@"
+  fi
+}
+
+# Compressed dump into a file, fails if the dump or gzip does
+dump_gz() {
+  local out=$1
+  shift
+  dump "$@" | gzip -c > "$out"
+  local status=("${PIPESTATUS[@]}")
+  [ ${status[0]} -eq 0 ] && [ ${status[1]} -eq 0 ]
+}
 
 if [ ! -d $db_dir ]; then
    mkdir -p $db_dir
 fi
 
 for db in $DATABASES; do
+  if [ -n "$stream_to" ]; then
+    echo "Dumping database: $db"
+    # Announced first, worker.py starts reading the FIFO when it sees this (the redirect below waits for it)
+    echo "STREAMING $db-$date_format.sql.gz"
+    # Plain gzip rather than tar: tar needs the file's size up front
+    dump --databases $db | gzip -c > "$stream_to"
+    status=("${PIPESTATUS[@]}")
+    if [ ${status[0]} -ne 0 ] || [ ${status[1]} -ne 0 ]; then exit 1; fi
+    echo "STREAMED $db-$date_format.sql.gz"
+    continue
+  fi
+
+  if [ -n "$TABLE_BACKUP" ]; then
+    # Table-level backup (see tables.py), three dumps: the whole schema, the data of only the tables that
+    # changed (DUMP_TABLES, possibly none), and the triggers, which restores run after the data so they don't
+    # fire on the restored rows. The data dump is one --single-transaction snapshot, so the changed tables are
+    # consistent with each other; the reused ones are as they were at the last backup. --comments keeps the
+    # per-table markers restores split the data on.
+    echo "Dumping database: $db"
+    dump_gz $db_dir/$db-$date_format.schema.sql.gz --no-data --skip-triggers --databases $db || exit 1
+    echo "TABLE_ARTIFACT schema $db_dir/$db-$date_format.schema.sql.gz"
+    if [ -n "$DUMP_TABLES" ]; then
+      dump_gz $db_dir/$db-$date_format.data.sql.gz --single-transaction --no-create-info --skip-triggers --comments $db $DUMP_TABLES || exit 1
+      echo "TABLE_ARTIFACT data $db_dir/$db-$date_format.data.sql.gz"
+    fi
+    dump_gz $db_dir/$db-$date_format.triggers.sql.gz --no-data --no-create-info --no-create-db --triggers $db || exit 1
+    echo "TABLE_ARTIFACT triggers $db_dir/$db-$date_format.triggers.sql.gz"
+    echo "TABLES_DONE $db-$date_format"
+    continue
+  fi
+
   echo "Dumping database: $db"
-  mysqldump -u$USER -h$HOST -p$PASSWORD --databases $db > $db_dir/$db-$date_format.sql
+  # MYSQLDUMP_OPTS can add options, i.e. "--single-transaction --master-data=2" to record binlog coordinates
+  dump --databases $db > $db_dir/$db-$date_format.sql
   if [ $? -ne 0 ]; then exit 1; fi
 
+  # With --master-data=2 the dump starts with a commented CHANGE MASTER TO line, pass it on for the catalog
+  binlog=`head -n 100 $db_dir/$db-$date_format.sql | grep -m 1 -o "MASTER_LOG_FILE='[^']*', MASTER_LOG_POS=[0-9]*"`
+  if [ -n "$binlog" ]; then
+    echo "BINLOG `echo $binlog | sed -E "s/MASTER_LOG_FILE='([^']*)', MASTER_LOG_POS=([0-9]*)/\1 \2/"`"
+  fi
+
+  # Uncompressed size, for the compression ratio metric
+  echo "DUMP_BYTES `stat -c %s $db_dir/$db-$date_format.sql`"
+
   echo "Compressing database: $db"
-  tar -zcvf $db_dir/$db-$date_format.tgz $db_dir/$db-$date_format.sql
+  # No -v: listing every archived file only adds log volume
+  tar -zcf $db_dir/$db-$date_format.tgz $db_dir/$db-$date_format.sql
   if [ $? -ne 0 ]; then exit 1; fi
+  rm -f $db_dir/$db-$date_format.sql
 
-  echo "Uploading database: $db"
-  aws s3 cp $db_dir/$db-$date_format.tgz s3://$s3_bucket/$s3_path/
-  if [ $? -ne 0 ]; then exit 1; fi
+  # Tell worker.py what to upload (it handles S3 so the image doesn't need the AWS CLI)
+  echo "ARTIFACT $db_dir/$db-$date_format.tgz"
 done
 exit 0
@@ -0,0 +1,433 @@
+import os
+import sys
+import json
+import time
+import base64
+import struct
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Streaming client-side encryption and checksums for backups, applied while the dump is on its way
+to S3 (no second pass over a multi-hundred-GB file on the task's disk).
+
+Backup (stream_to_s3), fed the compressed dump as it's produced (db_backup.sh writes it to a FIFO):
+- Envelope encryption: KMS GenerateDataKey gives a fresh AES-256 data key per backup; only its
+  KMS-encrypted copy is stored, in the object's header. The dump is sealed with AES-GCM in
+  CHUNK_SIZE chunks, BACKUP_STREAM_THREADS of them at a time, written out in order. Each chunk's
+  nonce is its number and its associated data binds it to the header and its position (and marks
+  the last one), so chunks can't be swapped, dropped or the object cut short without restore noticing.
+- Checksums: the object goes up as a multipart upload, starting with PART_SIZE parts that double
+  every PART_GROWTH parts (S3 allows 10,000 parts, 16MB parts alone would stop at ~156GB; growing,
+  10,000 parts cover ~16TB, past S3's 5TB object limit). Each part's sha256 is sent with it (S3
+  rejects the part if it doesn't match what arrived) and a sha256 of the whole object is kept. Both
+  go in <key>.sums.json next to the object, and the whole-object one in the catalog.
+- Without a KMS key the same stage just checksums (no encryption).
+
+Restore (restore_from_s3) streams the object back, checks every part against the sums file before
+its bytes are used, then the whole-object sha256 and, when encrypted, every chunk's GCM tag, and
+writes out the compressed dump. From the worker image:
+    python envelope.py restore <bucket> <key> <output file>
+
+Object layout (encrypted):
+    MAGIC | chunk size (u32) | nonce prefix (4 bytes) | wrapped key length (u16) | wrapped key
+    then per chunk: AES-GCM ciphertext + 16 byte tag
+
+Needs the cryptography package for encryption (installed in the image).
+"""
+
+MAGIC = b"SOPSGCM1"
+ALGORITHM = "AES-256-GCM"
+TAG_SIZE = 16
+
+# Plaintext per GCM chunk, the unit of parallel work
+CHUNK_SIZE = 1024 * 1024
+# Multipart upload part size, the unit of checksumming (S3's minimum is 5MB, except the last part)
+PART_SIZE = 16 * 1024 * 1024
+# Parts double in size every this many parts, so the upload never runs out of them
+PART_GROWTH = 1000
+# S3's limits per multipart upload
+MAX_PARTS = 10000
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+# Bytes of parts in flight at once, fewer parts are sent at a time as they grow. A quarter of the memory the
+# job has (BACKUP_STREAM_MEMORY_MB, the CDK sets it from the task's memory), the rest is the part being filled,
+# its copy on the way out, the encryption pipeline and everything else in the container
+MAX_IN_FLIGHT = int(os.environ.get('BACKUP_STREAM_MEMORY_MB', '1024')) * 1024 * 1024 // 4
+
+SUMS_SUFFIX = ".sums.json"
+
+
+class ChecksumError(ValueError):
+    """The object doesn't match what was recorded when it was backed up"""
+
+
+def part_size_at(number, part_size = PART_SIZE, growth = PART_GROWTH):
+    """Size of part number (from 1) when parts start at part_size and double every growth parts (0: never)"""
+    if not growth:
+        return part_size
+    return min(MAX_PART_SIZE, part_size * 2 ** ((number - 1) // growth))
+
+
+def upload_capacity(part_size = PART_SIZE, growth = PART_GROWTH, max_parts = MAX_PARTS):
+    """The largest object an upload can take before it runs out of parts"""
+    return sum(part_size_at(number, part_size, growth) for number in range(1, max_parts + 1))
+
+
+def aesgcm(key):
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise RuntimeError("Encrypted backups need the cryptography package (pip install cryptography)")
+    return AESGCM(key)
+
+
+def chunk_nonce(prefix, index):
+    return prefix + struct.pack(">Q", index)
+
+
+def chunk_aad(header_digest, index, final):
+    return header_digest + struct.pack(">QB", index, 1 if final else 0)
+
+
+def numbered_chunks(read, size):
+    """(index, chunk, final) for each chunk read. Empty input still gives one (empty, final) chunk"""
+    index = 0
+    chunk = read(size)
+    while True:
+        following = read(size) if len(chunk) == size else b""
+        final = not following
+        yield index, chunk, final
+        if final:
+            return
+        index += 1
+        chunk = following
+
+
+def ordered_map(pool, function, items, window):
+    """Like pool.map, but with at most window items in flight, so memory stays flat on a long stream"""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(function, *item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class Encryptor:
+    """Seals numbered chunks with one data key"""
+
+    def __init__(self, data_key, wrapped_key, chunk_size = CHUNK_SIZE):
+        self.cipher = aesgcm(data_key)
+        self.chunk_size = chunk_size
+        self.nonce_prefix = os.urandom(4)
+        self.header = MAGIC + struct.pack(">I4sH", chunk_size, self.nonce_prefix, len(wrapped_key)) + wrapped_key
+        self.header_digest = hashlib.sha256(self.header).digest()
+
+    def seal(self, index, chunk, final):
+        return self.cipher.encrypt(chunk_nonce(self.nonce_prefix, index), chunk, chunk_aad(self.header_digest, index, final))
+
+
+class Decryptor:
+    """Opens the chunks of an object written by Encryptor, reading its header first"""
+
+    def __init__(self, read, unwrap):
+        fixed = read(len(MAGIC) + 10)
+        if fixed[:len(MAGIC)] != MAGIC:
+            raise ChecksumError("Not an encrypted backup (unknown header)")
+        self.chunk_size, self.nonce_prefix, wrapped_length = struct.unpack(">I4sH", fixed[len(MAGIC):])
+        wrapped_key = read(wrapped_length)
+        self.header_digest = hashlib.sha256(fixed + wrapped_key).digest()
+        self.cipher = aesgcm(unwrap(wrapped_key))
+
+    def open(self, index, record, final):
+        from cryptography.exceptions import InvalidTag
+        try:
+            return self.cipher.decrypt(chunk_nonce(self.nonce_prefix, index), record, chunk_aad(self.header_digest, index, final))
+        except InvalidTag:
+            raise ChecksumError("Chunk " + str(index) + " failed authentication (corrupted, reordered or truncated)")
+
+
+class MultipartUpload:
+    """
+    Writes a stream to S3 as a multipart upload, part_size bytes a part at first, doubling every
+    growth parts (see part_size_at)
+
+    Parts are checksummed and uploaded on threads (S3 verifies each part's sha256 on arrival), the
+    whole-object sha256 is kept on its own thread, in order.
+    """
+
+    def __init__(self, s3, bucket, key, part_size = PART_SIZE, threads = 4, growth = PART_GROWTH, max_parts = MAX_PARTS,
+            max_in_flight = MAX_IN_FLIGHT):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.growth = growth
+        self.max_parts = max_parts
+        self.threads = threads
+        self.max_in_flight = max_in_flight
+        self.upload_id = s3.create_multipart_upload(Bucket = bucket, Key = key, ChecksumAlgorithm = "SHA256")["UploadId"]
+        self.uploads = ThreadPoolExecutor(max_workers = threads)
+        self.hasher = ThreadPoolExecutor(max_workers = 1)
+        self.window = threads * 2
+        self.pending = deque()
+        self.parts = []
+        self.buffer = bytearray()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        # Time spent waiting for S3 to take parts, i.e. how much the upload holds the stream back
+        self.wait_seconds = 0
+
+    def next_size(self):
+        return part_size_at(len(self.parts) + len(self.pending) + 1, self.part_size, self.growth)
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.next_size():
+            size = self.next_size()
+            self._send(bytes(self.buffer[:size]))
+            del self.buffer[:size]
+
+    def _send(self, body):
+        number = len(self.parts) + len(self.pending) + 1
+        if number > self.max_parts:
+            raise RuntimeError("Upload of " + self.key + " is past S3's " + str(self.max_parts) + " parts ("
+                + str(upload_capacity(self.part_size, self.growth, self.max_parts)) + " bytes), raise PART_SIZE or lower PART_GROWTH")
+        self.hasher.submit(self.sha256.update, body)
+        self.pending.append(self.uploads.submit(self._upload_part, number, body))
+        # Keep memory flat as parts grow: at most max_in_flight bytes of them waiting, one at a time once a part
+        # is bigger than half of that (slower, but it fits the task)
+        self.window = max(1, min(self.threads * 2, self.max_in_flight // max(1, len(body))))
+        while len(self.pending) >= self.window:
+            started = time.perf_counter()
+            self.parts.append(self.pending.popleft().result())
+            self.wait_seconds += time.perf_counter() - started
+
+    def _upload_part(self, number, body):
+        digest = hashlib.sha256(body).digest()
+        response = self.s3.upload_part(Bucket = self.bucket, Key = self.key, UploadId = self.upload_id, PartNumber = number,
+            Body = body, ChecksumSHA256 = base64.b64encode(digest).decode())
+        return {"PartNumber": number, "ETag": response["ETag"], "ChecksumSHA256": base64.b64encode(digest).decode(), "sha256": digest.hex()}
+
+    def close(self):
+        """Send the last part and complete the upload. Response: the checksums"""
+        if self.buffer or not (self.parts or self.pending):
+            self._send(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.parts.extend(future.result() for future in self.pending)
+        self.pending.clear()
+        self.uploads.shutdown()
+        self.hasher.shutdown()
+        self.s3.complete_multipart_upload(Bucket = self.bucket, Key = self.key, UploadId = self.upload_id,
+            MultipartUpload = {"Parts": [{name: part[name] for name in ("PartNumber", "ETag", "ChecksumSHA256")} for part in self.parts]})
+        return {"size": self.size, "sha256": self.sha256.hexdigest(), "part_size": self.part_size, "part_growth": self.growth,
+            "parts": [part["sha256"] for part in self.parts]}
+
+    def abort(self):
+        self.uploads.shutdown(cancel_futures = True)
+        self.hasher.shutdown(cancel_futures = True)
+        try:
+            self.s3.abort_multipart_upload(Bucket = self.bucket, Key = self.key, UploadId = self.upload_id)
+        except Exception as e:
+            print("Could not abort the upload of " + self.key + ": " + str(e))
+
+
+class LocalS3:
+    """
+    In-memory stand-in for the S3 calls used here, for tests and benchmarks
+
+    keep=False throws the bytes away (benchmarks measuring the stage, not memory)
+    """
+
+    def __init__(self, keep = True):
+        self.keep = keep
+        self.objects = {}
+        self.uploads = {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = str(len(self.uploads) + 1)
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ChecksumSHA256 = None):
+        if ChecksumSHA256 and base64.b64encode(hashlib.sha256(Body).digest()).decode() != ChecksumSHA256:
+            raise ValueError("BadDigest: part " + str(PartNumber))
+        self.uploads[UploadId][PartNumber] = Body if self.keep else b""
+        return {"ETag": '"' + hashlib.md5(Body).hexdigest() + '"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        import io
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+
+def stream_to_s3(source, s3, bucket, key, kms = None, kms_key_id = None, threads = 4, part_size = PART_SIZE,
+        chunk_size = CHUNK_SIZE, on_chunk = None, ready = None, metrics = None, part_growth = PART_GROWTH):
+    """
+    Encrypt (when kms_key_id is set) and checksum source on its way to s3://bucket/key
+
+    source, file object = read until EOF, i.e. the FIFO db_backup.sh writes the compressed dump to
+    on_chunk, callable = called with every chunk read, before it's encrypted (i.e. to peek at the dump)
+    ready, callable = called at EOF, before the upload is completed. Returning False aborts it, so a
+                      dump that failed half way never shows up as a complete object
+
+    Response: the sums (also uploaded as key + SUMS_SUFFIX, after the object is complete)
+    """
+    started = time.perf_counter()
+    waits = [0]
+
+    def read(size):
+        # Time blocked on the source: the dump/compression can't keep up with this stage
+        began = time.perf_counter()
+        chunk = source.read(size)
+        waits[0] += time.perf_counter() - began
+        if on_chunk:
+            on_chunk(chunk)
+        return chunk
+
+    upload = MultipartUpload(s3, bucket, key, part_size, threads, part_growth)
+    try:
+        encryption = None
+        if kms_key_id:
+            data_key = kms.generate_data_key(KeyId = kms_key_id, KeySpec = "AES_256")
+            encryptor = Encryptor(data_key["Plaintext"], data_key["CiphertextBlob"], chunk_size)
+            encryption = {"algorithm": ALGORITHM, "kms_key_id": data_key.get("KeyId", kms_key_id), "chunk_size": chunk_size}
+            upload.write(encryptor.header)
+            with ThreadPoolExecutor(max_workers = threads) as pool:
+                for record in ordered_map(pool, encryptor.seal, numbered_chunks(read, chunk_size), threads * 2):
+                    upload.write(record)
+        else:
+            for index, chunk, final in numbered_chunks(read, chunk_size):
+                upload.write(chunk)
+        if ready and not ready():
+            raise RuntimeError("Upload of " + key + " aborted, its source didn't finish cleanly")
+        sums = upload.close()
+    except BaseException:
+        upload.abort()
+        raise
+    sums["encryption"] = encryption
+    s3.put_object(Bucket = bucket, Key = key + SUMS_SUFFIX, Body = json.dumps(sums, indent = 2).encode())
+
+    if metrics:
+        total = time.perf_counter() - started
+        metrics.put("StreamTime", round(total * 1000, 3), "Milliseconds")
+        metrics.put("StreamInputWaitTime", round(waits[0] * 1000, 3), "Milliseconds")
+        metrics.put("StreamUploadWaitTime", round(upload.wait_seconds * 1000, 3), "Milliseconds")
+    return sums
+
+
+class VerifiedReader:
+    """
+    File-like reader over a stored object that only hands out bytes from parts whose sha256 matched
+    the sums file, and checks the whole-object sha256 and size at the end
+    """
+
+    def __init__(self, body, sums):
+        self.body = body
+        self.sums = sums
+        self.sha256 = hashlib.sha256()
+        self.part = 0
+        self.size = 0
+        self.buffer = b""
+        self.offset = 0
+        self.done = False
+
+    def _next_part(self):
+        # Sums written before parts grew have no part_growth, their parts are all part_size
+        part_size = part_size_at(self.part + 1, self.sums["part_size"], self.sums.get("part_growth", 0))
+        data = self.body.read(part_size)
+        if not data:
+            self.done = True
+            if self.part != len(self.sums["parts"]) or self.size != self.sums["size"]:
+                raise ChecksumError("Object ended after " + str(self.part) + " parts/" + str(self.size) + " bytes, expected "
+                    + str(len(self.sums["parts"])) + "/" + str(self.sums["size"]))
+            if self.sha256.hexdigest() != self.sums["sha256"]:
+                raise ChecksumError("Object sha256 doesn't match")
+            return
+        # A read can come back short of a whole part, top it up so part boundaries line up with the sums
+        while len(data) < part_size:
+            more = self.body.read(part_size - len(data))
+            if not more:
+                break
+            data += more
+        if self.part >= len(self.sums["parts"]) or hashlib.sha256(data).hexdigest() != self.sums["parts"][self.part]:
+            raise ChecksumError("Part " + str(self.part + 1) + " sha256 doesn't match")
+        self.sha256.update(data)
+        self.part += 1
+        self.size += len(data)
+        self.buffer = data
+        self.offset = 0
+
+    def read(self, size):
+        out = []
+        while size > 0 and not self.done:
+            if self.offset >= len(self.buffer):
+                self._next_part()
+                continue
+            piece = self.buffer[self.offset:self.offset + size]
+            self.offset += len(piece)
+            size -= len(piece)
+            out.append(piece)
+        return b"".join(out)
+
+
+def restore_stream(body, sums, write, kms = None, threads = 4):
+    """
+    Verify (and decrypt) a stored object as it streams, writing out the original bytes
+
+    body, file-like = the object, i.e. get_object()["Body"]
+    sums, dict = its sums file (stream_to_s3's response)
+
+    Response: bytes written. Raises ChecksumError on any mismatch; what was written before that
+    should be thrown away.
+    """
+    reader = VerifiedReader(body, sums)
+    written = 0
+    if not sums.get("encryption"):
+        for index, chunk, final in numbered_chunks(reader.read, CHUNK_SIZE):
+            write(chunk)
+            written += len(chunk)
+        return written
+    decryptor = Decryptor(reader.read, lambda wrapped: kms.decrypt(CiphertextBlob = wrapped)["Plaintext"])
+    with ThreadPoolExecutor(max_workers = threads) as pool:
+        for chunk in ordered_map(pool, decryptor.open, numbered_chunks(reader.read, decryptor.chunk_size + TAG_SIZE), threads * 2):
+            write(chunk)
+            written += len(chunk)
+    return written
+
+
+def restore_from_s3(s3, bucket, key, output_path, kms = None, threads = 4):
+    """Download s3://bucket/key to output_path, verified (and decrypted). Response: bytes written"""
+    sums = json.loads(s3.get_object(Bucket = bucket, Key = key + SUMS_SUFFIX)["Body"].read())
+    body = s3.get_object(Bucket = bucket, Key = key)["Body"]
+    try:
+        with open(output_path, "wb") as output:
+            return restore_stream(body, sums, output.write, kms = kms, threads = threads)
+    except ChecksumError:
+        os.remove(output_path)
+        raise
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5 or sys.argv[1] != "restore":
+        sys.exit("Usage: python envelope.py restore <bucket> <key, or its .layout.json manifest> <output file>")
+    import boto3
+    from layout import resolve
+    s3 = boto3.client('s3')
+    # Hashed key layouts (see layout.py): the manifest says where the backup is
+    key = resolve(s3, sys.argv[2], sys.argv[3])
+    written = restore_from_s3(s3, sys.argv[2], key, sys.argv[4], kms = boto3.client('kms'),
+        threads = int(os.environ.get('BACKUP_STREAM_THREADS', '4')))
+    print("Verified and restored " + str(written) + " bytes to " + sys.argv[4])
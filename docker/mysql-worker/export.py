@@ -0,0 +1,354 @@
+import os
+import csv
+import gzip
+import json
+import time
+import queue
+import hashlib
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from layout import KeyLayout
+
+"""
+Table export: every table of a database (or the ones listed) to compressed CSV or Parquet parts
+in S3, with a manifest, for tools that want rows rather than a SQL script to replay.
+
+How it runs:
+- Snapshot: EXPORT_THREADS connections each open a REPEATABLE READ transaction WITH CONSISTENT
+  SNAPSHOT while a separate connection briefly holds FLUSH TABLES WITH READ LOCK, so every
+  connection sees the same point in time (the binlog position is read under the lock, when the
+  user may run SHOW MASTER STATUS). Without the rights for the lock (RDS users often lack RELOAD),
+  the snapshots are opened back to back instead, and the manifest says "consistent": false.
+- Ranges: tables with a single-column integer primary key are split into ranges of about
+  EXPORT_ROWS_PER_CHUNK rows (from MIN/MAX of the key and the table's row estimate); other tables
+  are one range. Ranges run concurrently across the connections, largest tables first, so one big
+  table no longer means one thread.
+- Parts: each range streams (unbuffered cursor, EXPORT_BATCH_ROWS at a time) into one part file,
+  gzip CSV or Parquet (zstd), uploaded as soon as it's written and then removed locally.
+- Manifest: manifest.json, written last (its presence means the export is complete), lists the
+  snapshot, every table's columns and MySQL types, and every part with its key range, rows, bytes
+  and sha256.
+
+Layout:
+    s3://bucket/<s3_path>/exports/<db>-<timestamp>/manifest.json
+    s3://bucket/<s3_path>/exports/<db>-<timestamp>/<table>/part-00000.csv.gz (or .parquet)
+With a hashed key layout (S3_LAYOUT, see layout.py) parts go to s3_path/<shard>/exports/..., the
+manifest stays where it is and lists each part's key (and its logical name).
+
+CSV parts have a header row, NULL written as \\N and binary values hex encoded. Parquet needs
+pyarrow, which the image only installs when built with --build-arg EXPORT_PARQUET=true.
+"""
+
+FORMATS = ("csv", "parquet")
+
+# How CSV parts write NULL (MySQL's own convention, LOAD DATA reads it back as NULL)
+NULL = "\\N"
+
+INTEGER_TYPES = {"tinyint", "smallint", "mediumint", "int", "integer", "bigint"}
+BINARY_TYPES = {"binary", "varbinary", "tinyblob", "blob", "mediumblob", "longblob", "bit"}
+
+
+def quote(name):
+    """Quote an identifier for MySQL"""
+    return "`" + name.replace("`", "``") + "`"
+
+
+def plan_ranges(min_key, max_key, estimated_rows, rows_per_chunk):
+    """
+    Split [min_key, max_key] into half-open ranges of roughly rows_per_chunk rows each
+
+    Response: list of (low, high) with low <= key < high, covering every key from min to max
+    """
+    if min_key is None:
+        return []
+    span = max_key - min_key + 1
+    chunks = max(1, min(span, -(-int(estimated_rows or 0) // rows_per_chunk)))
+    step = -(-span // chunks)
+    return [(low, min(low + step, max_key + 1)) for low in range(min_key, max_key + 1, step)]
+
+
+def table_columns(cursor, db_name, table):
+    """Columns of a table from information_schema, in table order"""
+    cursor.execute("SELECT COLUMN_NAME, DATA_TYPE, COLUMN_TYPE, COLUMN_KEY, NUMERIC_PRECISION, NUMERIC_SCALE"
+        " FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION",
+        (db_name, table))
+    return [{"name": name, "data_type": data_type.lower(), "column_type": column_type, "key": key,
+            "precision": precision, "scale": scale}
+        for name, data_type, column_type, key, precision, scale in cursor.fetchall()]
+
+
+def list_tables(cursor, db_name, tables = None):
+    """Base tables of db_name (restricted to tables, if given) with their row estimates, largest first"""
+    cursor.execute("SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.TABLES"
+        " WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE'", (db_name,))
+    found = {name: rows or 0 for name, rows in cursor.fetchall()}
+    if tables:
+        missing = [table for table in tables if table not in found]
+        if missing:
+            raise ValueError("Tables not found in " + db_name + ": " + ", ".join(missing))
+        found = {table: found[table] for table in tables}
+    return sorted(found.items(), key = lambda item: item[1], reverse = True)
+
+
+def split_key(columns):
+    """The column to split a table on: its primary key, when that's a single integer column"""
+    primary = [column for column in columns if column["key"] == "PRI"]
+    if len(primary) == 1 and primary[0]["data_type"] in INTEGER_TYPES:
+        return primary[0]["name"]
+    return None
+
+
+class CsvPartWriter:
+    """gzip'd CSV, header first"""
+
+    extension = ".csv.gz"
+
+    def __init__(self, path, columns):
+        self.file = gzip.open(path, "wt", newline = "", compresslevel = 6)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([column["name"] for column in columns])
+
+    @staticmethod
+    def _value(value):
+        if value is None:
+            return NULL
+        if isinstance(value, (bytes, bytearray)):
+            return value.hex()
+        return value
+
+    def write(self, rows):
+        self.writer.writerows([[self._value(value) for value in row] for row in rows])
+
+    def close(self):
+        self.file.close()
+
+
+def arrow_type(column):
+    """The Parquet (pyarrow) type for a MySQL column"""
+    import pyarrow as pa
+    data_type = column["data_type"]
+    if data_type in INTEGER_TYPES or data_type == "year":
+        return pa.uint64() if "unsigned" in column["column_type"] else pa.int64()
+    if data_type == "decimal":
+        return pa.decimal128(int(column["precision"]), int(column["scale"]))
+    if data_type in ("float", "double", "real"):
+        return pa.float64()
+    if data_type == "date":
+        return pa.date32()
+    if data_type in ("datetime", "timestamp"):
+        return pa.timestamp("us")
+    if data_type == "time":
+        return pa.duration("us")
+    if data_type in BINARY_TYPES:
+        return pa.binary()
+    # char, varchar, text, enum, set, json, ...
+    return pa.string()
+
+
+class ParquetPartWriter:
+    """Parquet with zstd, one row group per batch"""
+
+    extension = ".parquet"
+
+    def __init__(self, path, columns):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet exports need pyarrow (build the image with --build-arg EXPORT_PARQUET=true)")
+        self.pa = pa
+        self.schema = pa.schema([(column["name"], arrow_type(column)) for column in columns])
+        self.writer = pq.ParquetWriter(path, self.schema, compression = "zstd")
+
+    def write(self, rows):
+        arrays = [self.pa.array([row[number] for row in rows], type = field.type) for number, field in enumerate(self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema = self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {"csv": CsvPartWriter, "parquet": ParquetPartWriter}
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(8 * 1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def open_snapshot(connect, threads, lock_tables = True):
+    """
+    Open `threads` connections sharing one consistent snapshot
+
+    connect, callable = returns a new pymysql connection
+    lock_tables, bool = take the global read lock, pointless when the connections go to different hosts
+
+    Response: (connections, snapshot info for the manifest)
+    """
+    import pymysql
+    snapshot = {"consistent": False, "binlog_file": None, "binlog_position": None}
+    lock = connect()
+    try:
+        try:
+            if lock_tables:
+                with lock.cursor() as cursor:
+                    cursor.execute("FLUSH TABLES WITH READ LOCK")
+                snapshot["consistent"] = True
+        except pymysql.MySQLError as e:
+            print("No global read lock (" + str(e) + "), snapshots will be opened back to back and may differ slightly")
+        connections = []
+        for _ in range(threads):
+            connection = connect()
+            with connection.cursor() as cursor:
+                cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+            connections.append(connection)
+        try:
+            with lock.cursor() as cursor:
+                cursor.execute("SHOW MASTER STATUS")
+                status = cursor.fetchone()
+            if status:
+                snapshot["binlog_file"], snapshot["binlog_position"] = status[0], int(status[1])
+        except pymysql.MySQLError:
+            pass
+        if snapshot["consistent"]:
+            with lock.cursor() as cursor:
+                cursor.execute("UNLOCK TABLES")
+    finally:
+        lock.close()
+    return connections, snapshot
+
+
+def export_range(connection, db_name, table, columns, key, low, high, path, writer_class, batch_rows):
+    """Stream one key range (or the whole table, when key is None) into a part file. Response: rows written"""
+    import pymysql.cursors
+    query = "SELECT " + ", ".join(quote(column["name"]) for column in columns) + " FROM " + quote(db_name) + "." + quote(table)
+    args = ()
+    if key is not None:
+        query += " WHERE " + quote(key) + " >= %s AND " + quote(key) + " < %s"
+        args = (low, high)
+    writer = writer_class(path, columns)
+    rows = 0
+    try:
+        # Unbuffered: rows come off the socket a batch at a time instead of the whole range in memory
+        with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(query, args)
+            while True:
+                batch = cursor.fetchmany(batch_rows)
+                if not batch:
+                    break
+                writer.write(batch)
+                rows += len(batch)
+    finally:
+        writer.close()
+    return rows
+
+
+def export_database(connect, db_name, s3, s3_bucket, s3_path, tables = None, fmt = "csv", threads = 4,
+        rows_per_chunk = 500000, batch_rows = 10000, work_dir = "/tmp/db_exports", metrics = None, gate = None, sources = None,
+        layout = None):
+    """
+    Export tables of db_name to s3://s3_bucket/s3_path/exports/<db>-<timestamp>/
+
+    connect, callable = returns a new pymysql connection to the database
+    tables, list = table names, all base tables when empty
+    gate, throttle.Gate = limits how many ranges export at once (load-aware throttling), all connections when None
+    sources, list = the hosts connect() spreads its connections over (see sources.py). With more than one, each
+                    connection has its own host's snapshot, so the export isn't one consistent point in time
+    layout, layout.KeyLayout = where parts land under s3_path, flat when None
+
+    Response: the manifest (also uploaded, last, as manifest.json)
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown export format " + str(fmt) + ", valid values are: " + ", ".join(FORMATS))
+    writer_class = WRITERS[fmt]
+    layout = layout or KeyLayout()
+    started = time.perf_counter()
+    name_prefix = "exports/" + db_name + "-" + time.strftime("%Y-%m-%d_%H-%M-%S")
+    prefix = s3_path.strip("/") + "/" + name_prefix
+    os.makedirs(work_dir, exist_ok = True)
+
+    spread = bool(sources) and len(sources) > 1
+    connections, snapshot = open_snapshot(connect, threads, lock_tables = not spread)
+    if sources:
+        snapshot["sources"] = list(sources)
+    try:
+        # Plan inside the snapshot, so the ranges match what the exports will see
+        plan = []
+        manifest_tables = {}
+        with connections[0].cursor() as cursor:
+            for table, estimated_rows in list_tables(cursor, db_name, tables):
+                columns = table_columns(cursor, db_name, table)
+                key = split_key(columns)
+                ranges = [(None, None)]
+                if key is not None:
+                    cursor.execute("SELECT MIN(" + quote(key) + "), MAX(" + quote(key) + ") FROM " + quote(db_name) + "." + quote(table))
+                    min_key, max_key = cursor.fetchone()
+                    ranges = plan_ranges(min_key, max_key, estimated_rows, rows_per_chunk) or [(None, None)]
+                    if ranges == [(None, None)]:
+                        key = None
+                manifest_tables[table] = {"columns": columns, "split_key": key, "parts": []}
+                for number, (low, high) in enumerate(ranges):
+                    plan.append((table, columns, key, low, high, number))
+
+        idle = queue.Queue()
+        for connection in connections:
+            idle.put(connection)
+        lock = threading.Lock()
+
+        def run(table, columns, key, low, high, number):
+            with gate or nullcontext():
+                connection = idle.get()
+                try:
+                    path = os.path.join(work_dir, db_name + "." + table + ".part-%05d" % number + writer_class.extension)
+                    rows = export_range(connection, db_name, table, columns, key, low, high, path, writer_class, batch_rows)
+                finally:
+                    idle.put(connection)
+            name = name_prefix + "/" + table + "/part-%05d" % number + writer_class.extension
+            part = {
+                "key": layout.physical(s3_path, name),
+                "name": name,
+                "range": [low, high] if key is not None else None,
+                "rows": rows,
+                "bytes": os.path.getsize(path),
+                "sha256": file_sha256(path),
+            }
+            s3.upload_file(path, s3_bucket, part["key"])
+            os.remove(path)
+            with lock:
+                manifest_tables[table]["parts"].append(part)
+            return part
+
+        # Every range needs a connection, so more threads than connections would only wait
+        with ThreadPoolExecutor(max_workers = len(connections)) as pool:
+            parts = list(pool.map(lambda job: run(*job), plan))
+    finally:
+        for connection in connections:
+            connection.close()
+
+    for table in manifest_tables.values():
+        table["parts"].sort(key = lambda part: part["name"])
+        table["rows"] = sum(part["rows"] for part in table["parts"])
+    manifest = {
+        "db_name": db_name,
+        "format": fmt,
+        "compression": "gzip" if fmt == "csv" else "zstd",
+        "created_at": time.time(),
+        "snapshot": snapshot,
+        "layout": layout.settings(),
+        "tables": manifest_tables,
+    }
+    s3.put_object(Bucket = s3_bucket, Key = prefix + "/manifest.json", Body = json.dumps(manifest, indent = 2, default = str).encode())
+    manifest["manifest_key"] = prefix + "/manifest.json"
+
+    if metrics:
+        metrics.put("ExportRows", sum(part["rows"] for part in parts), "Count")
+        metrics.put("ExportBytes", sum(part["bytes"] for part in parts), "Bytes")
+        metrics.put("ExportParts", len(parts), "Count")
+        metrics.put("ExportTime", round((time.perf_counter() - started) * 1000, 3), "Milliseconds")
+    return manifest
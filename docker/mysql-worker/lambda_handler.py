@@ -0,0 +1,88 @@
+import os
+
+import worker
+
+"""
+Lambda entry point for the mysql-worker image, for backups too small to be worth a Fargate task.
+
+The StepFunction runs the same image as a Lambda function (through awslambdaric, see the
+Dockerfile) in two steps:
+- {"action": "estimate", "job_options": {...}}: returns {"size_bytes": n}, the database's data +
+  index size from information_schema, which the state machine compares to the threshold in
+  settings.yml (tasks: fargate: mysql_worker: lambda_route:)
+- {"action": "backup", "task_token": ..., "job_name": "db_backup", "job_options": {...}}: runs
+  worker.py's db_backup (same db_backup.sh, upload, catalog and metrics code as the Fargate task),
+  which reports back to the StepFunction with the task token exactly like it does from Fargate
+
+Larger databases, and every other job, keep going to RunMySqlWorker on Fargate.
+
+job_options are the same as for the Fargate task: db_host/db_port/db_user/db_pass/s3_bucket/s3_path
+when passed in, otherwise looked up in Parameter Store with db_name and db_env.
+"""
+
+SETTINGS = ["db_host", "db_port", "db_user", "db_pass", "s3_bucket", "s3_path"]
+
+
+def job_settings(job_options):
+    """The db/S3 settings for a job, from its options or Parameter Store"""
+    if all(job_options.get(key) for key in SETTINGS):
+        return {key: job_options[key] for key in SETTINGS}
+    keybase = "/serverlessops/databases/" + job_options['db_name'] + "/" + job_options.get('db_env', 'none')
+    return worker.get_settings(keybase, SETTINGS)
+
+
+def estimate(job_options):
+    """Data + index size of the database, in bytes (an upper bound for what the dump compresses down from)"""
+    import pymysql
+    # A failed estimate sends the job to Fargate (the state machine catches it), nothing to report with a task token
+    worker.stepfunction_token = "localtest"
+    try:
+        settings = job_settings(job_options)
+    except SystemExit:
+        raise RuntimeError("Could not get the settings for " + job_options['db_name'] + " from Parameter Store")
+    conn = pymysql.connect(host=settings['db_host'], port=int(settings['db_port']), user=settings['db_user'],
+        passwd=settings['db_pass'], connect_timeout=5)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(SUM(DATA_LENGTH + INDEX_LENGTH), 0) FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s",
+                (job_options['db_name'],))
+            return {"size_bytes": int(cur.fetchone()[0])}
+    finally:
+        conn.close()
+
+
+def backup(event):
+    """Run worker.db_backup for the job, reporting back through the task token"""
+    job_options = event['job_options']
+    # worker.py's reporting functions use these module globals, set in its __main__ block on Fargate
+    worker.stepfunction_token = event['task_token']
+    worker.output = {
+        "status": "none yet",
+        "message": "output initialized, not populated"
+    }
+    # db_backup.sh is run relative to the worker's directory
+    os.chdir(os.path.dirname(os.path.abspath(worker.__file__)))
+    try:
+        settings = job_settings(job_options)
+        worker.run_profiled(worker.db_backup, settings['db_host'], settings['db_port'], settings['db_user'], settings['db_pass'],
+            job_options['db_name'], settings['s3_bucket'], settings['s3_path'], db_env=job_options.get('db_env', 'none'),
+            read_from=settings.get('read_from'), table_reuse=settings.get('table_reuse'),
+            name="db_backup-" + job_options['db_name'],
+            upload_to="s3://" + settings['s3_bucket'] + "/" + settings['s3_path'].strip("/") + "/profiles")
+    except SystemExit as e:
+        # send_error has already reported the failure to the StepFunction, don't let Lambda retry the job
+        return {"status": "FAILED", "exit_code": e.code}
+    return worker.output
+
+
+def handler(event, context):
+    # PROFILE comes in as a job option, the Fargate task gets it as an environment variable
+    if event.get('job_options', {}).get('profile'):
+        os.environ['PROFILE'] = event['job_options']['profile']
+    else:
+        os.environ.pop('PROFILE', None)
+    if event.get('action') == 'estimate':
+        return estimate(event['job_options'])
+    if event.get('action') == 'backup':
+        return backup(event)
+    raise ValueError("Unknown action " + str(event.get('action')) + ", expected estimate or backup")
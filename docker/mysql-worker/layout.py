@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import hashlib
+
+"""
+S3 key layout: where a job's objects land under s3://bucket/s3_path/.
+
+S3 scales request rates per key prefix (about 3,500 writes and 5,500 reads a second each) and
+answers 503 SlowDown past that. Everything under one flat s3_path/ shares one prefix, which is
+fine for a backup at a time but not for a fleet uploading per-table parts at once.
+
+Strategies (S3_LAYOUT, a JSON document, settings.yml: tasks: fargate: mysql_worker: key_layout:):
+- flat (default): s3_path/<name>, the original layout
+- hashed: s3_path/<shard>/<name>, the shard being the first prefix_chars hex characters of the
+  sha256 of the name (2: 256 prefixes, 3: 4096), so uploads spread evenly over prefixes
+
+Names stay the same (the logical name, i.e. classicmodels-2024-01-01-03.sql.gz.enc or
+exports/classicmodels-.../orders/part-00000.csv.gz), only the physical key changes. Since the
+shard can't be guessed by listing s3_path/, every hashed job writes a manifest mapping its
+logical names to physical keys at a fixed place:
+- db_backup: s3_path/manifests/<name>.layout.json, listed in the catalog with the backup
+- db_export: its manifest.json (which already lists every part's key) stays unsharded
+
+Readers resolve through the manifest (resolve(), `python layout.py resolve <bucket> <manifest key>`),
+so a later change of strategy doesn't strand older objects.
+"""
+
+STRATEGIES = ("flat", "hashed")
+DEFAULTS = {"strategy": "flat", "prefix_chars": 2}
+MANIFEST_PREFIX = "manifests/"
+MANIFEST_SUFFIX = ".layout.json"
+
+
+class KeyLayout:
+    """Maps logical names under s3_path to physical keys"""
+
+    def __init__(self, strategy = "flat", prefix_chars = 2):
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown key layout " + str(strategy) + ", valid values are: " + ", ".join(STRATEGIES))
+        if not 1 <= int(prefix_chars) <= 8:
+            raise ValueError("prefix_chars must be between 1 and 8")
+        self.strategy = strategy
+        self.prefix_chars = int(prefix_chars)
+
+    @classmethod
+    def from_settings(cls, settings):
+        settings = {**DEFAULTS, **(settings or {})}
+        return cls(settings["strategy"], settings["prefix_chars"])
+
+    @classmethod
+    def from_environment(cls):
+        return cls.from_settings(json.loads(os.environ.get('S3_LAYOUT') or "{}"))
+
+    @property
+    def hashed(self):
+        return self.strategy == "hashed"
+
+    def shard(self, name):
+        return hashlib.sha256(name.encode()).hexdigest()[:self.prefix_chars]
+
+    def physical(self, s3_path, name):
+        """The key for logical name under s3_path"""
+        root = s3_path.strip("/")
+        parts = [root] if root else []
+        if self.hashed:
+            parts.append(self.shard(name))
+        return "/".join(parts + [name.lstrip("/")])
+
+    def settings(self):
+        return {"strategy": self.strategy, "prefix_chars": self.prefix_chars}
+
+
+class Manifest:
+    """A job's logical name -> physical key map, written to s3_path/manifests/<name>.layout.json"""
+
+    def __init__(self, layout, s3_path, name):
+        self.layout = layout
+        self.s3_path = s3_path
+        self.key = KeyLayout().physical(s3_path, MANIFEST_PREFIX + name + MANIFEST_SUFFIX)
+        self.objects = {}
+
+    def place(self, name):
+        """The physical key for name, recorded"""
+        key = self.layout.physical(self.s3_path, name)
+        self.objects[name] = key
+        return key
+
+    def add(self, name, key):
+        self.objects[name] = key
+
+    def document(self):
+        return {"layout": self.layout.settings(), "s3_path": self.s3_path.strip("/"), "objects": dict(sorted(self.objects.items()))}
+
+    def write(self, s3, bucket):
+        s3.put_object(Bucket = bucket, Key = self.key, Body = json.dumps(self.document(), indent = 2).encode())
+        return self.key
+
+
+def read_manifest(s3, bucket, key):
+    return json.loads(s3.get_object(Bucket = bucket, Key = key)["Body"].read())
+
+
+def resolve(s3, bucket, key, name = None):
+    """
+    The physical key for key: itself, unless it's a layout manifest, then the key of name in it
+    (or of its one main object, the one without a suffix of another's name, when name is None)
+    """
+    if not key.endswith(MANIFEST_SUFFIX):
+        return key
+    objects = read_manifest(s3, bucket, key)["objects"]
+    if name is not None:
+        return objects[name]
+    main = [logical for logical in objects if not any(logical != other and logical.startswith(other) for other in objects)]
+    if len(main) != 1:
+        raise ValueError(key + " maps " + str(len(main)) + " objects, name the one to use: " + ", ".join(sorted(objects)))
+    return objects[main[0]]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5) or sys.argv[1] != "resolve":
+        sys.exit("Usage: python layout.py resolve <bucket> <manifest key> [name]")
+    import boto3
+    s3 = boto3.client('s3')
+    if len(sys.argv) == 5:
+        print(resolve(s3, sys.argv[2], sys.argv[3], sys.argv[4]))
+    else:
+        print(json.dumps(read_manifest(s3, sys.argv[2], sys.argv[3]), indent = 2))
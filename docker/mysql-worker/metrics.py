@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import socket
+from contextlib import contextmanager
+
+"""
+Per-stage performance metrics in CloudWatch Embedded Metric Format (EMF).
+
+EMF is a JSON log line that CloudWatch turns into metrics when it ingests it, so stage timings become
+chartable/alarmable metrics without any PutMetricData calls from the hot path. One document is
+emitted per job (flush()), carrying every metric recorded for it, with db, env and job dimensions.
+
+Sinks (where the EMF documents go):
+- StdoutSink: Lambda extracts EMF from stdout automatically
+- AgentSink: ECS/Fargate logs via the awslogs driver aren't extracted, so the worker sends to the
+  CloudWatch agent sidecar instead (AWS_EMF_AGENT_ENDPOINT, i.e. udp://127.0.0.1:25888)
+- ListSink: keeps the documents in memory, for tests and local runs
+
+Usage:
+    metrics = Metrics(dimensions={"db": "classicmodels", "env": "demo", "job": "db_backup"})
+    with metrics.timer("DumpTime"):
+        ...
+    metrics.put("DumpBytes", 12345, "Bytes")
+    metrics.flush()
+
+Note: lambda/mysql-users/ and lambda/mysql-diagnostics/ have copies of this file (the Lambdas and the container are
+packaged separately), keep the copies in sync.
+"""
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ServerlessOps')
+
+
+class StdoutSink:
+    def emit(self, document):
+        print(document, flush=True)
+
+
+class AgentSink:
+    """Send EMF documents to the CloudWatch agent (udp://host:port or tcp://host:port)"""
+
+    def __init__(self, endpoint):
+        scheme, address = endpoint.split("://", 1)
+        host, port = address.rsplit(":", 1)
+        self.scheme = scheme
+        self.address = (host, int(port))
+
+    def emit(self, document):
+        data = (document + "\n").encode()
+        try:
+            if self.scheme == "udp":
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.sendto(data, self.address)
+            else:
+                with socket.create_connection(self.address, timeout=1) as sock:
+                    sock.sendall(data)
+        except OSError as e:
+            # Metrics must never fail the job, fall back to the log
+            print("Could not reach the CloudWatch agent (" + str(e) + "), metrics follow")
+            print(document, flush=True)
+
+
+class ListSink:
+    """Keeps the emitted documents (parsed) in .documents"""
+
+    def __init__(self):
+        self.documents = []
+
+    def emit(self, document):
+        self.documents.append(json.loads(document))
+
+
+def default_sink():
+    endpoint = os.environ.get('AWS_EMF_AGENT_ENDPOINT')
+    return AgentSink(endpoint) if endpoint else StdoutSink()
+
+
+class Metrics:
+    """Collects metrics for one job and emits them as a single EMF document"""
+
+    def __init__(self, dimensions, namespace=NAMESPACE, sink=None):
+        self.dimensions = {key: str(value) for key, value in dimensions.items()}
+        self.namespace = namespace
+        self.sink = sink or default_sink()
+        self.values = {}
+        self.units = {}
+        self._stage = None
+
+    def put(self, name, value, unit="None"):
+        """Record a value (units: Milliseconds, Bytes, Megabytes/Second, Count, None, ...)"""
+        self.values[name] = value
+        self.units[name] = unit
+
+    @contextmanager
+    def timer(self, name):
+        """Time a block into <name> (milliseconds), also recorded when the block raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.put(name, round((time.perf_counter() - started) * 1000, 3), "Milliseconds")
+
+    def begin(self, name):
+        """
+        Start timing stage <name>, ending the previous one
+
+        For stages we only see as markers in a subprocess's output (db_backup.sh's "Dumping",
+        "Compressing", ...), where a with-block can't wrap them.
+        """
+        self.end()
+        self._stage = (name, time.perf_counter())
+
+    def end(self):
+        """End the stage started with begin(), if any"""
+        if self._stage:
+            name, started = self._stage
+            self.put(name, round((time.perf_counter() - started) * 1000, 3), "Milliseconds")
+            self._stage = None
+
+    def document(self):
+        """The EMF document for everything recorded so far"""
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [sorted(self.dimensions)],
+                    "Metrics": [{"Name": name, "Unit": self.units[name]} for name in sorted(self.values)]
+                }]
+            }
+        }
+        document.update(self.dimensions)
+        document.update(self.values)
+        return document
+
+    def flush(self):
+        """Emit the recorded metrics (if any) and start over"""
+        self.end()
+        if self.values:
+            self.sink.emit(json.dumps(self.document()))
+        self.values = {}
+        self.units = {}
@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import threading
+import subprocess
+import urllib.request
+
+"""
+Worker-pool mode: a long-running worker (an ECS service, not one RunTask per job) that pulls jobs
+from a queue and runs them, so bursts of jobs aren't paced by Fargate task launches (30-90s each,
+and RunTask's API rate limit).
+
+The StepFunction puts each job on an SQS queue with its task token (SqsSendMessage with
+WAIT_FOR_TASK_TOKEN) instead of starting a task. Each worker:
+- long-polls the queue for up to POOL_JOBS_PER_WORKER jobs at a time
+- runs each job as `python worker.py ecstask` with the same environment the StepFunction's
+  container overrides would set, so the job code and its success/failure reporting (with the
+  job's task token) are exactly the Fargate task's. A job that exits can't take the pool with it.
+- while a job runs, sends StepFunctions heartbeats for its token and keeps the message invisible,
+  and asks ECS to protect the task from scale-in (ECS task scale-in protection)
+- deletes the message once the job process has exited (it has normally reported by then; a job
+  that exits nonzero, i.e. an uncaught exception or OOM kill, gets a SendTaskFailure from the pool
+  in case it couldn't. A worker that dies mid-job leaves the message to be retried, and to the DLQ
+  after a few attempts)
+- on SIGTERM stops taking jobs and finishes the ones it has
+
+The ECS service scales on the queue's visible messages (see task_ecs_mysqlworker.py).
+
+Queues:
+- SqsQueue: the deployed queue (POOL_QUEUE_URL)
+- LocalQueue: in-memory stand-in for tests and local runs
+
+Run locally: POOL_QUEUE_URL=... python worker.py pool
+"""
+
+# job_options -> worker.py environment, as the StepFunction's container overrides pass them
+JOB_ENV = {
+    "db_name": "DB_NAME",
+    "db_env": "DB_ENV",
+    "db_host": "DB_HOST",
+    "db_port": "DB_PORT",
+    "db_user": "DB_USER",
+    "db_pass": "DB_PASS",
+    "s3_bucket": "S3_BUCKET",
+    "s3_path": "S3_PATH",
+    "profile": "PROFILE",
+    "export_format": "EXPORT_FORMAT",
+    "export_tables": "EXPORT_TABLES",
+}
+
+HEARTBEAT_SECONDS = 60
+
+
+def job_environment(job, base = None):
+    """The environment worker.py runs a queued job with"""
+    env = dict(os.environ if base is None else base)
+    env["TASK_TOKEN_ENV_VARIABLE"] = job["task_token"]
+    env["JOB_NAME"] = job["job_name"]
+    for option, variable in JOB_ENV.items():
+        value = job.get("job_options", {}).get(option)
+        # Unset options are left out so worker.py falls back to Parameter Store, like it does on Fargate
+        if value not in (None, ""):
+            env[variable] = str(value)
+        else:
+            env.pop(variable, None)
+    return env
+
+
+class LocalQueue:
+    """In-memory queue with the SqsQueue methods"""
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self.deleted = []
+
+    def send(self, job):
+        self.messages.put(json.dumps(job))
+
+    def receive(self, max_messages, wait_seconds):
+        received = []
+        try:
+            received.append(self.messages.get(timeout = wait_seconds))
+            while len(received) < max_messages:
+                received.append(self.messages.get_nowait())
+        except queue.Empty:
+            pass
+        return [(json.loads(body), body) for body in received]
+
+    def keep_invisible(self, handle, seconds):
+        pass
+
+    def delete(self, handle):
+        self.deleted.append(handle)
+
+
+class SqsQueue:
+    def __init__(self, url, client = None):
+        if client is None:
+            import boto3
+            client = boto3.client('sqs')
+        self.url = url
+        self.client = client
+
+    def receive(self, max_messages, wait_seconds):
+        response = self.client.receive_message(QueueUrl = self.url, MaxNumberOfMessages = min(max_messages, 10),
+            WaitTimeSeconds = wait_seconds)
+        return [(json.loads(message["Body"]), message["ReceiptHandle"]) for message in response.get("Messages", [])]
+
+    def keep_invisible(self, handle, seconds):
+        self.client.change_message_visibility(QueueUrl = self.url, ReceiptHandle = handle, VisibilityTimeout = seconds)
+
+    def delete(self, handle):
+        self.client.delete_message(QueueUrl = self.url, ReceiptHandle = handle)
+
+
+def set_scale_in_protection(enabled):
+    """Protect this ECS task from scale-in while it has jobs (no-op outside ECS)"""
+    agent = os.environ.get('ECS_AGENT_URI')
+    if not agent:
+        return
+    body = {"ProtectionEnabled": enabled}
+    if enabled:
+        body["ExpiresInMinutes"] = 24 * 60
+    request = urllib.request.Request(agent + "/task-protection/v1/state", data = json.dumps(body).encode(),
+        method = "PUT", headers = {"Content-Type": "application/json"})
+    try:
+        urllib.request.urlopen(request, timeout = 5).read()
+    except Exception as e:
+        print("Could not update scale-in protection: " + str(e))
+
+
+class Pool:
+    """Runs jobs from a queue, up to jobs_per_worker at a time"""
+
+    def __init__(self, job_queue, jobs_per_worker = 1, command = None, sfn = None, wait_seconds = 20,
+            heartbeat_seconds = HEARTBEAT_SECONDS, protect = set_scale_in_protection):
+        self.queue = job_queue
+        self.jobs_per_worker = jobs_per_worker
+        self.command = command or [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py"), "ecstask"]
+        self.sfn = sfn
+        self.wait_seconds = wait_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.protect = protect
+        self.running = {}
+        self.stopping = threading.Event()
+        self.completed = 0
+        self._lock = threading.Lock()
+
+    def _sfn(self):
+        if self.sfn is None:
+            import boto3
+            self.sfn = boto3.client('stepfunctions')
+        return self.sfn
+
+    def _run(self, job, handle):
+        try:
+            process = subprocess.Popen(self.command, env = job_environment(job))
+            while True:
+                try:
+                    process.wait(timeout = self.heartbeat_seconds)
+                    break
+                except subprocess.TimeoutExpired:
+                    # Still running: tell StepFunctions, and keep the message from going back on the queue
+                    self.heartbeat(job, handle)
+            print("Job " + job["job_name"] + " finished with exit code " + str(process.returncode))
+            if process.returncode != 0:
+                # Died without reporting (uncaught exception, OOM kill), or reported its failure and exited 1
+                self.report_failure(job, process.returncode)
+            # The job has reported success/failure with its token, it's done either way
+            self.queue.delete(handle)
+        finally:
+            with self._lock:
+                del self.running[handle]
+                self.completed += 1
+                idle = not self.running
+            if idle:
+                self.protect(False)
+
+    def report_failure(self, job, returncode):
+        """Fail the job's token, unless the job already answered it"""
+        try:
+            self._sfn().send_task_failure(taskToken = job["task_token"], error = "WorkerExited",
+                cause = "Job " + job["job_name"] + " exited with code " + str(returncode) + ", see the pool's logs")
+        except Exception as e:
+            code = getattr(e, "response", {}).get("Error", {}).get("Code", "")
+            if code not in ("TaskTimedOut", "InvalidToken"):
+                print("Could not report the failure of " + job["job_name"] + ": " + str(e))
+
+    def heartbeat(self, job, handle):
+        try:
+            self._sfn().send_task_heartbeat(taskToken = job["task_token"])
+            self.queue.keep_invisible(handle, self.heartbeat_seconds * 3)
+        except Exception as e:
+            print("Heartbeat failed for " + job["job_name"] + ": " + str(e))
+
+    def start(self, job, handle):
+        with self._lock:
+            first = not self.running
+            thread = threading.Thread(target = self._run, args = (job, handle), daemon = True)
+            self.running[handle] = thread
+        if first:
+            self.protect(True)
+        thread.start()
+        return thread
+
+    def poll(self):
+        """Take as many jobs as there are free slots. Response: the threads started"""
+        free = self.jobs_per_worker - len(self.running)
+        if free <= 0:
+            time.sleep(1)
+            return []
+        return [self.start(job, handle) for job, handle in self.queue.receive(free, self.wait_seconds)]
+
+    def run(self):
+        """Poll until stopped, then wait for the running jobs"""
+        while not self.stopping.is_set():
+            self.poll()
+        for thread in list(self.running.values()):
+            thread.join()
+
+    def stop(self, *args):
+        print("Stopping: no new jobs, finishing " + str(len(self.running)) + " running")
+        self.stopping.set()
+
+
+def run_pool():
+    """Entry point for `worker.py pool`"""
+    pool = Pool(SqsQueue(os.environ['POOL_QUEUE_URL']), jobs_per_worker = int(os.environ.get('POOL_JOBS_PER_WORKER', '1')))
+    # ECS sends SIGTERM on scale-in/deploys
+    signal.signal(signal.SIGTERM, pool.stop)
+    print("Worker pool polling " + os.environ['POOL_QUEUE_URL'])
+    pool.run()
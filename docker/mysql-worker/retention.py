@@ -0,0 +1,174 @@
+import json
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Catalog-driven retention: decide which backups to expire from the backup catalog (no S3 listings)
+and delete their objects with batched DeleteObjects calls.
+
+Policies are grandfather-father-son, set per db/env in settings.yml (parameters: databases: db: env:
+retention:) and read from Parameter Store along with the rest of the db/env settings:
+
+    retention:
+      daily: 7     # keep the newest backup of each of the 7 most recent days that have backups
+      weekly: 4    # ... of each of the 4 most recent ISO weeks
+      monthly: 12  # ... of each of the 12 most recent months
+      yearly: 3    # ... of each of the 3 most recent years
+
+A backup is kept if any tier keeps it, and the newest backup is always kept. A db/env without a
+policy keeps everything. Missing tiers count as 0.
+
+Deletes go out as DeleteObjects calls of up to 1000 keys (the API limit), with the batches for
+different prefixes running concurrently, so pruning hundreds of thousands of backups is a few
+hundred API calls instead of one call per object.
+"""
+
+# DeleteObjects accepts at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+
+TIERS = {
+    "daily": lambda when: when.strftime("%Y-%m-%d"),
+    "weekly": lambda when: "%d-W%02d" % when.isocalendar()[:2],
+    "monthly": lambda when: when.strftime("%Y-%m"),
+    "yearly": lambda when: when.strftime("%Y"),
+}
+
+
+def parse_policy(policy):
+    """Policies come from a JSON document, or a JSON string with the per-key parameter layout"""
+    if isinstance(policy, str):
+        policy = json.loads(policy)
+    if not policy:
+        return None
+    unknown = set(policy) - set(TIERS)
+    if unknown:
+        raise ValueError("Unknown retention tiers: " + ", ".join(sorted(unknown)))
+    return {tier: int(policy.get(tier, 0)) for tier in TIERS}
+
+
+def split_expired(entries, policy):
+    """
+    Apply a GFS policy to catalog entries
+
+    Response: (kept, expired), both lists of entries
+    """
+    if not entries or policy is None:
+        return list(entries), []
+    newest_first = sorted(entries, key=lambda entry: entry["created_at"], reverse=True)
+    keep = {id(newest_first[0])}
+    for tier, count in policy.items():
+        seen = set()
+        for entry in newest_first:
+            if len(seen) >= count:
+                break
+            bucket = TIERS[tier](datetime.fromtimestamp(entry["created_at"], tz=timezone.utc))
+            if bucket not in seen:
+                # Newest backup in this day/week/month/year
+                seen.add(bucket)
+                keep.add(id(entry))
+    kept = [entry for entry in newest_first if id(entry) in keep]
+    expired = [entry for entry in newest_first if id(entry) not in keep]
+    return kept, expired
+
+
+def _prefix(key):
+    return key.rsplit("/", 1)[0] if "/" in key else ""
+
+
+def delete_keys(s3, bucket, keys):
+    """
+    Delete keys with DeleteObjects, 1000 at a time
+
+    Response: list of (key, error message) for keys S3 refused to delete, or that were in a
+    batch whose call failed outright (throttled, access denied on the bucket, ...)
+    """
+    errors = []
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start:start + DELETE_BATCH_SIZE]
+        try:
+            response = s3.delete_objects(Bucket=bucket, Delete={
+                "Objects": [{"Key": key} for key in batch],
+                # Quiet: only failures come back, keeps the responses small
+                "Quiet": True
+            })
+        except Exception as e:
+            # Nothing says which of the batch went, count them all as failed, the rest of the batches still go
+            errors.extend((key, str(e)) for key in batch)
+            continue
+        for error in response.get("Errors", []):
+            errors.append((error["Key"], error.get("Code", "") + " " + error.get("Message", "")))
+    return errors
+
+
+def delete_concurrently(s3, keys_by_bucket, max_workers=8):
+    """
+    Delete keys grouped by bucket and prefix, one worker per prefix
+
+    keys_by_bucket, dict = bucket -> list of keys
+
+    Response: list of (bucket, key, error message)
+    """
+    jobs = {}
+    for bucket, keys in keys_by_bucket.items():
+        for key in keys:
+            jobs.setdefault((bucket, _prefix(key)), []).append(key)
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(delete_keys, s3, bucket, keys): (bucket, keys) for (bucket, prefix), keys in jobs.items()}
+        for future, (bucket, keys) in futures.items():
+            try:
+                errors.extend((bucket, key, message) for key, message in future.result())
+            except Exception as e:
+                errors.extend((bucket, key, str(e)) for key in keys)
+    return errors
+
+
+def apply_retention(catalog, s3, db_name, db_env, policy, dry_run=False, max_workers=8):
+    """
+    Expire the backups of one db/env that its policy no longer keeps
+
+    Objects are deleted first, catalog entries removed after, and only for backups whose objects
+    were all deleted, so the catalog never points at missing objects because of a partial failure.
+
+    Response: report dict (counts, bytes, and the keys that would be / were deleted)
+    """
+    policy = parse_policy(policy)
+    kept, expired = split_expired(catalog.entries(db_name, db_env), policy)
+    # Table backups (see tables.py) list the earlier objects they reuse, those stay while a kept backup lists them
+    shared = {(entry["s3_bucket"], key) for entry in kept for key in entry["object_keys"]}
+    keys_by_bucket = {}
+    for entry in expired:
+        keys = keys_by_bucket.setdefault(entry["s3_bucket"], [])
+        for key in entry["object_keys"]:
+            if (entry["s3_bucket"], key) not in shared and key not in keys:
+                keys.append(key)
+
+    report = {
+        "db_name": db_name,
+        "db_env": db_env,
+        "policy": policy,
+        "dry_run": dry_run,
+        "kept": len(kept),
+        "expired": len(expired),
+        "expired_bytes": sum(entry["size_bytes"] for entry in expired),
+        "objects": sum(len(keys) for keys in keys_by_bucket.values()),
+        "errors": [],
+    }
+    if dry_run:
+        report["would_delete"] = keys_by_bucket
+        return report
+    if not expired:
+        return report
+
+    started = time.time()
+    errors = delete_concurrently(s3, keys_by_bucket, max_workers=max_workers)
+    failed = {(bucket, key) for bucket, key, message in errors}
+    removable = [entry for entry in expired
+        if not any((entry["s3_bucket"], key) in failed for key in entry["object_keys"])]
+    catalog.remove_many(removable)
+    report["errors"] = [{"bucket": bucket, "key": key, "error": message} for bucket, key, message in errors]
+    report["removed_from_catalog"] = len(removable)
+    report["seconds"] = round(time.time() - started, 3)
+    return report
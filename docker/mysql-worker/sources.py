@@ -0,0 +1,164 @@
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from throttle import read_signals
+
+"""
+Source selection: which host a backup or export reads from, so the read load lands on readers or
+replicas instead of the primary.
+
+1. Candidates: the db/env's db_host is treated as the writer. Its readers are discovered from the
+   RDS API by the shape of the endpoint:
+   - Aurora cluster endpoint (<cluster>.cluster-<id>.<region>.rds.amazonaws.com): the cluster's
+     reader instances' endpoints
+   - RDS instance endpoint (<instance>.<id>.<region>.rds.amazonaws.com): its read replicas
+   plus any hosts listed in read_from: hosts: (self-managed replicas, other endpoints).
+2. Probe: every candidate reader is connected to (in parallel, short timeout) for its
+   Threads_running and its own replication lag.
+3. Pick: readers with lag at most max_lag_seconds, least loaded first. A broken replica
+   (replication stopped, lag NULL) or one that can't be reached is skipped.
+4. Fallback: the writer, only when there are no usable readers.
+
+The writer is the default: reading from readers is opted into per db/env with mode auto or hosts.
+A db_backup whose MYSQLDUMP_OPTS records binlog coordinates (--master-data/--source-data) always
+reads from the writer too. Aurora readers have no binlog, so the dump would fail, and an RDS
+replica would record its own binlog's coordinates, which are no use for the writer's point in time.
+
+Settings: read_from: in the db/env's settings (settings.yml parameters:), all optional:
+    mode: writer            # writer (default, always db_host), auto (discover readers), hosts (only the listed hosts)
+    hosts: []
+    max_lag_seconds: 30
+    spread: false           # db_export: true spreads its connections over the usable readers (no single snapshot)
+"""
+
+DEFAULTS = {"mode": "writer", "hosts": [], "max_lag_seconds": 30, "spread": False}
+
+# mysqldump options that write the server's binlog coordinates into the dump
+BINLOG_OPTIONS = re.compile(r"--(?:master|source)-data\b")
+
+AURORA_CLUSTER = re.compile(r"^([^.]+)\.cluster-(?:ro-)?([^.]+)\.([^.]+)\.rds\.amazonaws\.com$")
+RDS_INSTANCE = re.compile(r"^([^.]+)\.([^.]+)\.([^.]+)\.rds\.amazonaws\.com$")
+
+
+def read_from_settings(read_from):
+    # A dict from the documents layout, a JSON string from the keys layout or READ_FROM
+    if isinstance(read_from, str):
+        read_from = json.loads(read_from) if read_from.strip() else None
+    return {**DEFAULTS, **(read_from or {})}
+
+
+def records_binlog(dump_opts):
+    """Whether mysqldump options (MYSQLDUMP_OPTS) record binlog coordinates, which only the writer's are worth having"""
+    return bool(BINLOG_OPTIONS.search(dump_opts or ""))
+
+
+def discover_readers(db_host, rds):
+    """Reader/replica endpoints of db_host's cluster or instance, from the RDS API (empty when it's neither)"""
+    cluster = AURORA_CLUSTER.match(db_host)
+    if cluster:
+        members = rds.describe_db_clusters(DBClusterIdentifier=cluster.group(1))["DBClusters"][0]["DBClusterMembers"]
+        reader_ids = [member["DBInstanceIdentifier"] for member in members if not member["IsClusterWriter"]]
+    else:
+        instance = RDS_INSTANCE.match(db_host)
+        if not instance:
+            return []
+        reader_ids = rds.describe_db_instances(DBInstanceIdentifier=instance.group(1))["DBInstances"][0].get("ReadReplicaDBInstanceIdentifiers", [])
+    if not reader_ids:
+        return []
+    instances = rds.describe_db_instances(Filters=[{"Name": "db-instance-id", "Values": reader_ids}])["DBInstances"]
+    return sorted(instance["Endpoint"]["Address"] for instance in instances
+        if instance.get("DBInstanceStatus") == "available" and instance.get("Endpoint"))
+
+
+def own_lag(cursor):
+    """
+    This server's replication lag in seconds: 0 when it isn't a replica, None when it is one but
+    replication isn't running (no usable lag)
+    """
+    try:
+        # Aurora: every instance lists every reader's lag, this one's row is ours
+        cursor.execute("SELECT REPLICA_LAG_IN_MILLISECONDS FROM information_schema.REPLICA_HOST_STATUS WHERE SERVER_ID = @@aurora_server_id")
+        row = cursor.fetchone()
+        return float(row[0]) / 1000 if row and row[0] is not None else 0.0
+    except Exception:
+        pass
+    for query, column in (("SHOW REPLICA STATUS", "Seconds_Behind_Source"), ("SHOW SLAVE STATUS", "Seconds_Behind_Master")):
+        try:
+            cursor.execute(query)
+        except Exception:
+            continue
+        row = cursor.fetchone()
+        if row is None:
+            return 0.0
+        value = row[[description[0] for description in cursor.description].index(column)]
+        return float(value) if value is not None else None
+    return 0.0
+
+
+def probe(host, connect):
+    """Load and lag of one host. Response: dict with host, threads_running, lag (or error)"""
+    try:
+        connection = connect(host)
+        try:
+            with connection.cursor() as cursor:
+                signals = read_signals(cursor)
+                lag = own_lag(cursor)
+        finally:
+            connection.close()
+    except Exception as e:
+        return {"host": host, "error": str(e)}
+    return {"host": host, "threads_running": signals["threads_running"], "lag": lag}
+
+
+def choose_sources(db_host, read_from, connect, rds = None, count = 1, writer_only = None):
+    """
+    Pick up to count hosts to read from, least loaded usable reader first, db_host when there's none
+
+    connect, callable = connect(host) returns a pymysql connection to that host (short timeout)
+    rds, boto3 RDS client = for discovering readers (mode auto)
+    writer_only, string = why this job has to read from db_host whatever the settings say, if it does
+
+    Response: (hosts, report), the report says what was considered and why, for the logs
+    """
+    settings = read_from_settings(read_from)
+    report = {"writer": db_host, "mode": settings["mode"], "candidates": [], "fallback": None}
+    if settings["mode"] == "writer":
+        report["fallback"] = "mode is writer"
+        return [db_host], report
+    if writer_only:
+        report["fallback"] = writer_only
+        return [db_host], report
+
+    readers = list(settings["hosts"])
+    if settings["mode"] == "auto" and rds is not None:
+        try:
+            readers += discover_readers(db_host, rds)
+        except Exception as e:
+            report["discovery_error"] = str(e)
+    readers = [host for host in dict.fromkeys(readers) if host != db_host]
+    if not readers:
+        report["fallback"] = "no readers found"
+        return [db_host], report
+
+    with ThreadPoolExecutor(max_workers=min(8, len(readers))) as pool:
+        probes = list(pool.map(lambda host: probe(host, connect), readers))
+    report["candidates"] = probes
+    usable = [result for result in probes if "error" not in result and result["lag"] is not None
+        and result["lag"] <= settings["max_lag_seconds"]]
+    if not usable:
+        report["fallback"] = "no reader with lag under " + str(settings["max_lag_seconds"]) + "s"
+        return [db_host], report
+    usable.sort(key=lambda result: (result["threads_running"] or 0, result["lag"]))
+    if not settings["spread"]:
+        count = 1
+    return [result["host"] for result in usable[:max(1, count)]], report
+
+
+def describe(hosts, report):
+    """One log line for the choice"""
+    if report["fallback"]:
+        return "Reading from the writer " + hosts[0] + " (" + report["fallback"] + ")"
+    details = ", ".join(result["host"] + ": " + (result["error"] if "error" in result else
+        str(result["threads_running"]) + " running, " + str(result["lag"]) + "s lag") for result in report["candidates"])
+    return "Reading from " + ", ".join(hosts) + " (" + details + ")"
@@ -0,0 +1,288 @@
+import sys
+import json
+import time
+import zlib
+import hashlib
+
+from export import quote, split_key, table_columns
+
+"""
+Table-level change detection: full backups that don't dump tables that haven't changed.
+
+With table_reuse enabled for a db/env, db_backup:
+1. Fingerprints every base table with the cheapest signal its engine has:
+   - MyISAM/Aria: CHECKSUM TABLE ... QUICK (the live checksum, for tables created with
+     CHECKSUM=1), else UPDATE_TIME (the data file's modification time)
+   - InnoDB, tables up to checksum_max_mb: CHECKSUM TABLE (exact, reads the table)
+   - InnoDB, larger: UPDATE_TIME when the server has one (InnoDB keeps it in memory, since the
+     last restart; MySQL 8.0 caches it for information_schema_stats_expiry, so that's set to 0
+     for the session first), else, for tables listed in append_only, row count + MAX() of a
+     single integer primary key. These two are only compared on the same server since the same
+     restart, so a restart or a different reader/replica means a dump. Count + max key can't see
+     UPDATEs or DELETE-then-INSERT, which is why it's only used for tables declared append-only.
+   - Anything else (no signal, no usable key, not append-only): always dumped.
+   Every fingerprint also carries a hash of the table's columns (information_schema.COLUMNS), so an
+   ALTER TABLE, even an instant one that leaves the data alone, means a dump: older data objects'
+   INSERTs only match the columns they were dumped with.
+2. Compares them with the previous backup's table manifest (the latest backup in the catalog).
+3. Dumps the whole schema (always, without triggers), the data of only the tables whose
+   fingerprint changed, in one mysqldump so the changed tables are consistent with each other, and
+   the triggers on their own.
+4. Writes a table manifest, <name>.tables.json, saying which object holds each table's data: the
+   new data object, or an earlier backup's. Those earlier objects are listed in the new backup's
+   catalog entry too, so retention keeps them as long as any backup uses them.
+
+Every full_every_days (and whenever there's no previous table backup), every table is dumped, so
+a missed change can't live on in the backups forever.
+
+Restore (`python tables.py restore <bucket> <tables.json key> <output .sql.gz>`): the schema, then
+every table's data from whichever object holds it, then the triggers (last, so they don't fire on
+the restored rows), as one SQL script. Data objects are split on
+mysqldump's per-table comments ("-- Dumping data for table `x`"), so a table that changed since an
+older data object was written is only taken from the newer one.
+
+Settings: table_reuse: in the db/env's settings (settings.yml parameters:), or TABLE_REUSE (JSON):
+    enabled: true
+    full_every_days: 7
+    checksum_max_mb: 64
+    append_only: [audit_log]   # large tables only ever INSERTed into, compared by row count + max key
+Streamed (encrypted) backups don't support it yet, those stay full dumps.
+"""
+
+DEFAULTS = {"enabled": False, "full_every_days": 7, "checksum_max_mb": 64, "append_only": []}
+CODEC = "tables+gzip"
+MANIFEST_SUFFIX = ".tables.json"
+
+# mysqldump's comment before each table's data
+DATA_MARKER = b"-- Dumping data for table `"
+# ... and the start of its trailer, after the last table
+TRAILER_MARKERS = (b"/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;", b"-- Dump completed")
+
+
+def reuse_settings(table_reuse):
+    """The table_reuse settings with defaults, or None when it's off"""
+    if isinstance(table_reuse, str):
+        table_reuse = json.loads(table_reuse) if table_reuse.strip() else None
+    settings = {**DEFAULTS, **(table_reuse or {})}
+    return settings if settings.get("enabled") else None
+
+
+def server_identity(cursor):
+    """Which server, since which (rounded) start, for signals that only hold on one server between restarts"""
+    cursor.execute("SELECT @@hostname, @@server_id, UNIX_TIMESTAMP()")
+    hostname, server_id, now = cursor.fetchone()
+    cursor.execute("SHOW GLOBAL STATUS LIKE 'Uptime'")
+    uptime = int(cursor.fetchone()[1])
+    return {"server": str(hostname) + ":" + str(server_id), "started": int(round((int(now) - uptime) / 60.0)) * 60}
+
+
+def fresh_statistics(cursor):
+    """
+    Make information_schema.TABLES current for this session: MySQL 8.0 (Aurora MySQL 3) caches
+    UPDATE_TIME for information_schema_stats_expiry (a day by default), a table written since then
+    would look unchanged. Older servers and MariaDB don't cache it (or have the variable).
+    """
+    try:
+        cursor.execute("SET SESSION information_schema_stats_expiry = 0")
+    except Exception as e:
+        if "information_schema_stats_expiry" not in str(e):
+            raise
+
+
+def table_definitions(cursor, db_name):
+    """Response: dict of table -> sha256 of its columns (names, types, order, defaults, nullability)"""
+    cursor.execute("SELECT TABLE_NAME, COLUMN_NAME, ORDINAL_POSITION, COLUMN_TYPE, IS_NULLABLE, COLUMN_DEFAULT, EXTRA"
+        " FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s ORDER BY TABLE_NAME, ORDINAL_POSITION", (db_name,))
+    columns = {}
+    for table, *column in cursor.fetchall():
+        columns.setdefault(table, []).append([str(value) for value in column])
+    return {table: hashlib.sha256(json.dumps(rows).encode()).hexdigest() for table, rows in columns.items()}
+
+
+def table_status(cursor, db_name):
+    cursor.execute("SELECT TABLE_NAME, ENGINE, UPDATE_TIME, DATA_LENGTH + INDEX_LENGTH FROM information_schema.TABLES"
+        " WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE'", (db_name,))
+    return [{"table": table, "engine": (engine or "").lower(), "update_time": update_time, "bytes": int(size or 0)}
+        for table, engine, update_time, size in cursor.fetchall()]
+
+
+def fingerprint(cursor, db_name, status, settings, server):
+    """A table's change signal (see the module notes), None when there's no usable one"""
+    name = quote(db_name) + "." + quote(status["table"])
+    update_time = str(status["update_time"]) if status["update_time"] is not None else None
+    if status["engine"] in ("myisam", "aria"):
+        cursor.execute("CHECKSUM TABLE " + name + " QUICK")
+        row = cursor.fetchone()
+        if row and row[1] is not None:
+            return {"method": "live_checksum", "value": str(row[1])}
+        return {"method": "update_time", "value": update_time} if update_time else None
+    if status["bytes"] <= settings["checksum_max_mb"] * 1024 * 1024:
+        cursor.execute("CHECKSUM TABLE " + name)
+        row = cursor.fetchone()
+        if row and row[1] is not None:
+            return {"method": "checksum", "value": str(row[1])}
+    if update_time:
+        return {"method": "update_time", "value": update_time, **server}
+    if status["table"] not in settings.get("append_only", []):
+        return None
+    key = split_key(table_columns(cursor, db_name, status["table"]))
+    if key is None:
+        return None
+    cursor.execute("SELECT COUNT(*), MAX(" + quote(key) + ") FROM " + name)
+    count, max_key = cursor.fetchone()
+    return {"method": "rows_max_pk", "value": [int(count), None if max_key is None else int(max_key)], **server}
+
+
+def fingerprint_tables(cursor, db_name, settings):
+    """Response: dict of table -> fingerprint (or None), each with its columns' hash"""
+    server = server_identity(cursor)
+    fresh_statistics(cursor)
+    definitions = table_definitions(cursor, db_name)
+    fingerprints = {}
+    for status in table_status(cursor, db_name):
+        current = fingerprint(cursor, db_name, status, settings, server)
+        if current is not None:
+            current["columns"] = definitions.get(status["table"])
+        fingerprints[status["table"]] = current
+    return fingerprints
+
+
+def plan(fingerprints, previous, settings, now = None):
+    """
+    Which tables to dump, which to take from the previous backup
+
+    previous, dict = the previous backup's table manifest, or None
+
+    Response: dict with dump (sorted table names), reuse (table -> the previous manifest's entry) and full
+    """
+    now = time.time() if now is None else now
+    full = previous is None or now - previous.get("full_at", 0) >= settings["full_every_days"] * 86400
+    reuse = {}
+    if not full:
+        for table, current in fingerprints.items():
+            before = previous["tables"].get(table)
+            if current is not None and before and before.get("object") and before.get("fingerprint") == current:
+                reuse[table] = before
+    return {"dump": sorted(table for table in fingerprints if table not in reuse), "reuse": reuse, "full": full}
+
+
+def build_manifest(db_name, name, backup_plan, fingerprints, schema, data, previous, now = None, triggers = None):
+    """
+    The new backup's table manifest
+
+    schema, dict = {"key", "sha256", "bytes"} of the schema object
+    data, dict = the same for the new data object, None when no table was dumped
+    triggers, dict = the same for the triggers object, None for backups whose schema has them
+    """
+    now = time.time() if now is None else now
+    objects = {}
+    tables = {}
+    if data:
+        objects[data["key"]] = {"sha256": data["sha256"], "bytes": data["bytes"], "backup": name}
+    for table, current in sorted(fingerprints.items()):
+        if table in backup_plan["reuse"]:
+            entry = backup_plan["reuse"][table]
+            objects[entry["object"]] = previous["objects"][entry["object"]]
+            tables[table] = {"fingerprint": current, "object": entry["object"], "reused": True}
+        else:
+            tables[table] = {"fingerprint": current, "object": data["key"] if data else None, "reused": False}
+    return {
+        "db_name": db_name,
+        "backup": name,
+        "created_at": now,
+        "full_at": now if backup_plan["full"] else previous.get("full_at", now),
+        "schema": schema,
+        "triggers": triggers,
+        "objects": objects,
+        "tables": tables,
+    }
+
+
+def previous_manifest(catalog, s3, db_name, db_env):
+    """The table manifest of the latest backup, if that was a table backup"""
+    latest = catalog.latest(db_name, db_env) if catalog else None
+    if not latest or latest.get("codec") != CODEC:
+        return None
+    keys = [key for key in latest["object_keys"] if key.endswith(MANIFEST_SUFFIX)]
+    if not keys:
+        return None
+    return json.loads(s3.get_object(Bucket = latest["s3_bucket"], Key = keys[0])["Body"].read())
+
+
+def gunzip_lines(read, size = 1024 * 1024):
+    """Lines of a gzip stream read with read(size)"""
+    decompressor = zlib.decompressobj(wbits = 31)
+    pending = b""
+    while True:
+        chunk = read(size)
+        if not chunk:
+            break
+        pending += decompressor.decompress(chunk)
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line + b"\n"
+    pending += decompressor.flush()
+    if pending:
+        yield pending
+
+
+def select_tables(lines, tables):
+    """
+    Only the given tables' sections of a mysqldump --no-create-info script, plus its header and
+    trailer (the session settings it saves and restores)
+    """
+    current = None
+    for line in lines:
+        if line.startswith(DATA_MARKER):
+            current = line[len(DATA_MARKER):].split(b"`")[0].decode()
+        elif line.startswith(TRAILER_MARKERS):
+            current = None
+        # Each table's section opens with a "--" line just before its marker, passing it on is harmless
+        if current is None or current in tables:
+            yield line
+
+
+def combine(manifest, open_object, write):
+    """
+    Write the backup as one SQL script: the schema, then every table's data from the object holding it,
+    then the triggers, so restoring the rows doesn't fire them
+
+    open_object, callable = open_object(key) returns a file object of that (gzip) object
+    write, callable = takes the script's bytes
+
+    Response: dict of object key -> the tables taken from it
+    """
+    for line in gunzip_lines(open_object(manifest["schema"]["key"]).read):
+        write(line)
+    by_object = {}
+    for table, entry in manifest["tables"].items():
+        if entry["object"]:
+            by_object.setdefault(entry["object"], set()).add(table)
+    for key in sorted(by_object, key = lambda key: manifest["objects"][key].get("backup", "")):
+        # The data dumps name tables without their database
+        write(b"USE " + quote(manifest["db_name"]).encode() + b";\n")
+        for line in select_tables(gunzip_lines(open_object(key).read), by_object[key]):
+            write(line)
+    if manifest.get("triggers"):
+        write(b"USE " + quote(manifest["db_name"]).encode() + b";\n")
+        for line in gunzip_lines(open_object(manifest["triggers"]["key"]).read):
+            write(line)
+    return by_object
+
+
+def restore_from_s3(s3, bucket, manifest_key, output_path):
+    """Combine a table backup into one gzip'd SQL script at output_path. Response: the manifest"""
+    import gzip
+    manifest = json.loads(s3.get_object(Bucket = bucket, Key = manifest_key)["Body"].read())
+    with gzip.open(output_path, "wb") as output:
+        combine(manifest, lambda key: s3.get_object(Bucket = bucket, Key = key)["Body"], output.write)
+    return manifest
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5 or sys.argv[1] != "restore":
+        sys.exit("Usage: python tables.py restore <bucket> <tables.json key> <output .sql.gz>")
+    import boto3
+    manifest = restore_from_s3(boto3.client('s3'), sys.argv[2], sys.argv[3], sys.argv[4])
+    reused = sum(1 for entry in manifest["tables"].values() if entry["reused"])
+    print("Restored " + str(len(manifest["tables"])) + " tables (" + str(reused) + " from earlier backups) to " + sys.argv[4])
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import threading
+
+"""
+Load-aware throttling of backups and exports, so they take what the database can spare instead
+of running flat out during business hours.
+
+- Monitor: samples the server every interval_seconds on its own connection: Threads_running, the
+  InnoDB row-read rate (Innodb_rows_read per second) and replica lag (Aurora readers' lag from the
+  writer, or this host's own lag when it is a replica).
+- Controller: keeps a level between min_rate_mb/max_rate_mb and 1. Any signal over its threshold
+  multiplies the level by `decrease`, a sample with every signal under adds `increase` back (AIMD,
+  like TCP: quick to back off, careful to speed up). It starts at start_level and ramps up.
+- The level is applied as:
+  - db_backup: a read rate of level * max_rate_mb MB/s. mysqldump streams rows (--quick), so a
+    relay between it and the rest of the pipeline (`python throttle.py relay <rate file>`, see
+    db_backup.sh) that only passes that many bytes a second slows the server's reads as well.
+  - db_export: the number of ranges exported at once (level * EXPORT_THREADS, at least one), via
+    Gate.
+  It never drops below min_rate_mb / one range, so a backup always finishes.
+
+Settings: the THROTTLE environment variable, a JSON document (settings.yml: tasks: fargate:
+mysql_worker: throttle:, set by the CDK). Unset or "enabled": false leaves jobs unthrottled.
+Watching replica lag needs the REPLICATION CLIENT privilege, without it lag isn't watched.
+"""
+
+DEFAULTS = {
+    "interval_seconds": 5,
+    "max_threads_running": 24,
+    "max_replica_lag_seconds": 30,
+    "max_rows_read_per_second": 0,  # 0: not watched
+    "max_rate_mb": 256,
+    "min_rate_mb": 1,
+    "start_level": 0.25,
+    "increase": 0.1,
+    "decrease": 0.5,
+}
+
+# How often the relay re-reads its rate file, and the most it lets through in one burst
+RELAY_REFRESH_SECONDS = 1
+RELAY_BLOCK = 64 * 1024
+
+
+def settings_from_environment():
+    """The THROTTLE settings with defaults filled in, or None when throttling is off"""
+    settings = json.loads(os.environ.get('THROTTLE') or "{}")
+    if not settings.get('enabled'):
+        return None
+    return {**DEFAULTS, **settings}
+
+
+def replica_lag(cursor):
+    """Seconds of replica lag, or None when there are no replicas to watch (or no rights to look)"""
+    queries = [
+        # Aurora MySQL: the writer sees every reader's lag
+        ("SELECT MAX(REPLICA_LAG_IN_MILLISECONDS) / 1000 FROM information_schema.REPLICA_HOST_STATUS WHERE SESSION_ID <> 'MASTER_SESSION_ID'", None),
+        # A MySQL/MariaDB replica: its own lag
+        ("SHOW REPLICA STATUS", "Seconds_Behind_Source"),
+        ("SHOW SLAVE STATUS", "Seconds_Behind_Master"),
+    ]
+    for query, column in queries:
+        try:
+            cursor.execute(query)
+        except Exception:
+            continue
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        value = row[0] if column is None else row[[description[0] for description in cursor.description].index(column)]
+        return float(value) if value is not None else None
+    return None
+
+
+def read_signals(cursor):
+    cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN ('Threads_running', 'Innodb_rows_read')")
+    status = {name.lower(): int(value) for name, value in cursor.fetchall()}
+    return {
+        "threads_running": status.get("threads_running"),
+        "rows_read": status.get("innodb_rows_read"),
+        "replica_lag": replica_lag(cursor),
+    }
+
+
+class Controller:
+    """AIMD on a level in [min level, 1] from the server's signals"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.min_level = min(1, settings["min_rate_mb"] / settings["max_rate_mb"])
+        self.level = max(self.min_level, settings["start_level"])
+        self.last_rows = None
+
+    def update(self, signals, now):
+        """Take a sample, adjust the level. Response: the signals that were over their thresholds"""
+        rows_per_second = None
+        if signals.get("rows_read") is not None:
+            if self.last_rows is not None and now > self.last_rows[1]:
+                rows_per_second = (signals["rows_read"] - self.last_rows[0]) / (now - self.last_rows[1])
+            self.last_rows = (signals["rows_read"], now)
+        signals["rows_read_per_second"] = rows_per_second
+        checks = [
+            ("threads_running", signals.get("threads_running"), self.settings["max_threads_running"]),
+            ("replica_lag", signals.get("replica_lag"), self.settings["max_replica_lag_seconds"]),
+            ("rows_read_per_second", rows_per_second, self.settings["max_rows_read_per_second"]),
+        ]
+        over = [name for name, value, limit in checks if limit and value is not None and value > limit]
+        if over:
+            self.level = max(self.min_level, self.level * self.settings["decrease"])
+        else:
+            self.level = min(1.0, self.level + self.settings["increase"])
+        return over
+
+    def rate(self):
+        """Bytes a second the dump may read"""
+        return int(self.level * self.settings["max_rate_mb"] * 1024 * 1024)
+
+    def concurrency(self, threads):
+        return max(1, min(threads, round(self.level * threads)))
+
+
+class Gate:
+    """A semaphore whose limit can change while it's held"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def __exit__(self, *args):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+
+def write_rate(path, rate):
+    # Replace, don't rewrite in place, so the relay never reads a half-written number
+    with open(path + ".tmp", "w") as file:
+        file.write(str(rate))
+    os.replace(path + ".tmp", path)
+
+
+class Monitor:
+    """
+    Samples the server on a thread and applies the controller's level
+
+    connect, callable = returns a new pymysql connection (the monitor's own)
+    rate_file, string = where the relay reads its rate (db_backup)
+    gate, Gate = whose limit follows the level (db_export), threads = the most it allows
+    """
+
+    def __init__(self, connect, settings, rate_file = None, gate = None, threads = 1, metrics = None, clock = time.monotonic):
+        self.connect = connect
+        self.settings = settings
+        self.controller = Controller(settings)
+        self.rate_file = rate_file
+        self.gate = gate
+        self.threads = threads
+        self.metrics = metrics
+        self.clock = clock
+        self.stopping = threading.Event()
+        self.thread = None
+        self.samples = 0
+        self.backoffs = 0
+        self.lowest_level = self.controller.level
+        self.peaks = {}
+        self._apply()
+
+    def _apply(self):
+        if self.rate_file:
+            write_rate(self.rate_file, self.controller.rate())
+        if self.gate:
+            self.gate.set_limit(self.controller.concurrency(self.threads))
+
+    def sample(self, cursor):
+        """One sample and adjustment (the thread's loop body)"""
+        signals = read_signals(cursor)
+        over = self.controller.update(signals, self.clock())
+        self.samples += 1
+        for name in ("threads_running", "replica_lag", "rows_read_per_second"):
+            if signals.get(name) is not None:
+                self.peaks[name] = max(self.peaks.get(name, 0), signals[name])
+        if over:
+            self.backoffs += 1
+            print("Throttling to " + str(round(self.controller.level * 100)) + "%, over threshold: " + ", ".join(over))
+        self.lowest_level = min(self.lowest_level, self.controller.level)
+        self._apply()
+        return over
+
+    def _run(self):
+        connection = None
+        while not self.stopping.is_set():
+            try:
+                if connection is None:
+                    connection = self.connect()
+                with connection.cursor() as cursor:
+                    self.sample(cursor)
+            except Exception as e:
+                # Can't see the server's load: hold the current level rather than speed up blind
+                print("Load sample failed, holding the current rate: " + str(e))
+                connection = None
+            self.stopping.wait(self.settings["interval_seconds"])
+        if connection is not None:
+            connection.close()
+
+    def start(self):
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+        if self.metrics:
+            self.metrics.put("ThrottleSamples", self.samples, "Count")
+            self.metrics.put("ThrottleBackoffs", self.backoffs, "Count")
+            self.metrics.put("ThrottleLowestLevel", round(self.lowest_level * 100, 1), "Percent")
+            for name, metric in (("threads_running", "PeakThreadsRunning"), ("replica_lag", "PeakReplicaLag"),
+                    ("rows_read_per_second", "PeakRowsReadPerSecond")):
+                if name in self.peaks:
+                    self.metrics.put(metric, round(self.peaks[name], 3))
+
+
+def read_rate(path, default):
+    try:
+        with open(path) as file:
+            return max(1, int(file.read().strip()))
+    except (OSError, ValueError):
+        return default
+
+
+def relay(rate_file, source = None, sink = None, clock = time.monotonic, sleep = time.sleep):
+    """
+    Copy source to sink at no more than the rate (bytes a second) in rate_file, re-read every second
+
+    A token bucket holding at most one second's worth, so a raised rate takes effect at once and a
+    pause doesn't turn into a burst.
+    """
+    source = source or sys.stdin.buffer
+    sink = sink or sys.stdout.buffer
+    rate = read_rate(rate_file, RELAY_BLOCK)
+    refreshed = last = clock()
+    tokens = 0.0
+    copied = 0
+    while True:
+        block = source.read1(RELAY_BLOCK) if hasattr(source, "read1") else source.read(RELAY_BLOCK)
+        if not block:
+            break
+        while True:
+            now = clock()
+            if now - refreshed >= RELAY_REFRESH_SECONDS:
+                rate = read_rate(rate_file, rate)
+                refreshed = now
+            tokens = min(float(max(rate, len(block))), tokens + (now - last) * rate)
+            last = now
+            if tokens >= len(block):
+                break
+            sleep(min(RELAY_REFRESH_SECONDS, max(0.001, (len(block) - tokens) / rate)))
+        tokens -= len(block)
+        sink.write(block)
+        copied += len(block)
+    sink.flush()
+    return copied
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "relay":
+        sys.exit("Usage: python throttle.py relay <rate file>")
+    relay(sys.argv[2])
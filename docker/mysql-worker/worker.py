@@ -1,10 +1,25 @@
-from webbrowser import get
 import boto3
 import os
-import subprocess
 import time
 import json
 import sys
+import re
+import zlib
+import hashlib
+import threading
+import itertools
+
+from catalog import open_catalog, make_entry
+from retention import apply_retention, parse_policy
+from metrics import Metrics
+from profiling import run_profiled
+from capture import run_captured, truncate, ERROR_LIMIT, CAUSE_LIMIT
+from export import export_database
+from envelope import stream_to_s3, SUMS_SUFFIX
+from throttle import settings_from_environment, Monitor, Gate
+from sources import choose_sources, describe, records_binlog
+from layout import KeyLayout, Manifest
+from tables import reuse_settings, fingerprint_tables, previous_manifest, plan as plan_tables, build_manifest, CODEC as TABLES_CODEC, MANIFEST_SUFFIX as TABLES_SUFFIX
 
 """
 Demo wrapper script to show working with AWS StepFunctions and AWS ECS/Fargate tasks 
@@ -40,18 +55,25 @@ Best practices changes:
 """
 
 
+# Where db_backup.sh leaves the compressed dumps before they're uploaded
+BACKUP_DIR = os.environ.get('BACKUP_DIR', '/tmp/db_backups')
+
 
 def send_error(error_cause, error_msg):
     """Send error back to calling StepFunction"""
 
      # see https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/stepfunctions.html#SFN.Client.send_task_failure
+    # SendTaskFailure rejects oversized payloads, so cut them to its limits (the cause keeps its end,
+    # where the actual error usually is, see capture.py)
+    error_msg = truncate(error_msg, ERROR_LIMIT)  # Since passing in "e" for debugging of the exception, truncate() also makes these strings
+    error_cause = truncate(error_cause, CAUSE_LIMIT, keep_end=True)
     if stepfunction_token != "localtest":
         print("Sending error to StepFunction")
         client = boto3.client('stepfunctions')
         response = client.send_task_failure(
             taskToken=stepfunction_token,
-            error=str(error_msg),  # Since passing in "e" for debugging of the exception, ensure these are strings
-            cause=str(error_cause)
+            error=error_msg,
+            cause=error_cause
         )
         print(f"Error has occured, aborting. Cause: {error_cause}, message: {error_msg}")
         sys.exit(1)
@@ -93,34 +115,366 @@ def get_parameter(keyname):
         send_error(e, "Error trying to retrieve parameter " + keyname + " from Parameter Store")
 
 
-def db_backup(db_host, db_port, db_user, db_pass, db_name, s3_bucket, s3_path):
-    """Perform MySQL backup"""
-    errors = ""
+def get_settings(keybase, keys):
+    """
+    Get the settings for a db/env from Parameter Store in as few calls as possible
+
+    keybase, string = /serverlessops/databases/dbname/env
+    keys, list = the setting names needed, i.e. ["db_host", "db_port"]
+
+    Response: dict of key -> value
+
+    Prefers the one-document layout (a JSON document at keybase holding all the keys, see
+    parameter_layout in settings.yml), one call for everything. Falls back to one parameter
+    per key (keybase/db_host, ...) when the value at keybase isn't a JSON document.
+    """
+    document = get_parameter(keybase)
+    try:
+        values = json.loads(document)
+    except ValueError:
+        values = None
+    if isinstance(values, dict):
+        missing = [key for key in keys if key not in values]
+        if missing:
+            send_error("Missing keys " + ", ".join(missing), "Parameter Store document " + keybase + " is incomplete")
+        return values
+    return {key: get_parameter(keybase + "/" + key) for key in keys}
+
+
+def upload_file(file_path, s3_bucket, s3_path, manifest=None):
+    """
+    Upload a finished dump to s3://s3_bucket/s3_path/ and remove the local copy
+
+    Replaces the `aws s3 cp` the bash script used to do, so the image doesn't need the AWS CLI.
+    boto3's managed transfer does multipart uploads in parallel threads for large files.
+    manifest, layout.Manifest = places (and records) the key for a non-flat key layout
+    """
+    name = os.path.basename(file_path)
+    key = manifest.place(name) if manifest else s3_path.strip("/") + "/" + name
+    print("Uploading " + file_path + " to s3://" + s3_bucket + "/" + key)
+    try:
+        boto3.client('s3').upload_file(file_path, s3_bucket, key)
+    except Exception as e:
+        send_error(e, "Error uploading " + file_path + " to s3://" + s3_bucket + "/" + key)
+    os.remove(file_path)
+    return key
+
+
+def index_backup(catalog, entry):
+    """
+    Add a backup to the catalog (see catalog.py)
+
+    The objects are already in S3 by now, so failing the job would only have it retried into a second
+    copy. A failure is logged and listed under the output's catalog_warnings instead, the task still succeeds.
+    """
+    try:
+        catalog.put(entry)
+    except Exception as e:
+        warning = "Backup " + entry["object_keys"][0] + " isn't in the catalog, retention and restores won't see it: " + str(e)
+        print("WARNING: " + warning)
+        output.setdefault('catalog_warnings', []).append(warning)
+
+
+def write_manifest(manifest, s3_bucket):
+    """Write a backup's layout manifest (see layout.py), response: its key"""
+    try:
+        return manifest.write(boto3.client('s3'), s3_bucket)
+    except Exception as e:
+        send_error(e, "Error writing the key manifest to s3://" + s3_bucket + "/" + manifest.key)
+
+
+def file_checksum(file_path):
+    """sha256 of a file, read in chunks so large dumps don't need to fit in memory"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(8 * 1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dump_binlog(chunk):
+    """Binlog coordinates from the start of a gzip'd dump (mysqldump --master-data=2 writes them near the top)"""
+    try:
+        head = zlib.decompressobj(wbits=31).decompress(chunk, 256 * 1024)
+    except zlib.error:
+        return {}
+    match = re.search(rb"MASTER_LOG_FILE='([^']*)', MASTER_LOG_POS=([0-9]+)", head)
+    if not match:
+        return {}
+    return {"binlog_file": match.group(1).decode(), "binlog_position": match.group(2).decode()}
+
+
+def start_stream(fifo, name, s3_bucket, s3_path, kms_key_id, script_ok, metrics, manifest=None):
+    """
+    Upload what db_backup.sh streams into fifo to s3://s3_bucket/s3_path/name, through the
+    encryption/checksum stage in envelope.py, on a thread
+
+    script_ok, callable = waits for the script and says whether it succeeded, the upload is only
+                          completed if it did
+    manifest, layout.Manifest = places (and records) the keys for a non-flat key layout
+
+    Response: dict the thread fills in (key, sums, binlog, or error), plus the thread
+    """
+    name = name + (".enc" if kms_key_id else "")
+    key = manifest.place(name) if manifest else s3_path.strip("/") + "/" + name
+    if manifest:
+        # The sums file sits next to its object (restores look for key + SUMS_SUFFIX)
+        manifest.add(name + SUMS_SUFFIX, key + SUMS_SUFFIX)
+    stream = {"key": key, "binlog": {}, "manifest": manifest}
+
+    def peek(chunk):
+        if "peeked" not in stream:
+            stream["peeked"] = True
+            stream["binlog"] = dump_binlog(chunk)
+
+    def run():
+        print("Streaming to s3://" + s3_bucket + "/" + stream["key"] + (" (encrypted)" if kms_key_id else ""))
+        try:
+            # Opening the FIFO is what lets the script's redirect into it go ahead
+            with open(fifo, 'rb') as source:
+                stream["sums"] = stream_to_s3(source, boto3.client('s3'), s3_bucket, stream["key"],
+                    kms=boto3.client('kms') if kms_key_id else None, kms_key_id=kms_key_id or None,
+                    threads=int(os.environ.get('BACKUP_STREAM_THREADS', '4')), on_chunk=peek, ready=script_ok, metrics=metrics)
+        except Exception as e:
+            stream["error"] = e
+
+    stream["thread"] = threading.Thread(target=run, daemon=True)
+    stream["thread"].start()
+    return stream
+
+
+def upload_table_backup(name, table_artifacts, table_plan, fingerprints, previous, db_name, s3_bucket, s3_path, metrics, manifest=None):
+    """
+    Upload a table-level backup's schema/data/triggers dumps and its table manifest (see tables.py)
+
+    Response: (object keys for the catalog, bytes uploaded, sha256 of the table manifest, binlog coordinates)
+    """
+    uploaded = {}
+    binlog = {}
+    for kind in ("schema", "data", "triggers"):
+        if kind not in table_artifacts:
+            continue
+        path = table_artifacts[kind]
+        info = {"bytes": os.path.getsize(path), "sha256": file_checksum(path)}
+        if kind != "triggers":
+            with open(path, 'rb') as file:
+                # The data dump's coordinates when there is one, they're the ones the data matches
+                binlog = dump_binlog(file.read(256 * 1024)) or binlog
+        with metrics.timer("UploadTime"):
+            info["key"] = upload_file(path, s3_bucket, s3_path, manifest=manifest)
+        uploaded[kind] = info
+    tables_manifest = build_manifest(db_name, name, table_plan, fingerprints, uploaded["schema"], uploaded.get("data"), previous,
+        triggers=uploaded.get("triggers"))
+    body = json.dumps(tables_manifest, indent=2, default=str).encode()
+    manifest_name = name + TABLES_SUFFIX
+    manifest_key = manifest.place(manifest_name) if manifest else s3_path.strip("/") + "/" + manifest_name
+    try:
+        boto3.client('s3').put_object(Bucket=s3_bucket, Key=manifest_key, Body=body)
+    except Exception as e:
+        send_error(e, "Error uploading the table manifest to s3://" + s3_bucket + "/" + manifest_key)
+
+    # Earlier backups' data objects this one uses are listed with it too, so retention keeps them while it's kept
+    keys = [info["key"] for info in uploaded.values()] + [manifest_key]
+    keys += [key for key in tables_manifest["objects"] if key not in keys]
+    reused = [table for table, entry in tables_manifest["tables"].items() if entry["reused"]]
+    metrics.put("TablesDumped", len(tables_manifest["tables"]) - len(reused), "Count")
+    metrics.put("TablesReused", len(reused), "Count")
+    return keys, sum(info["bytes"] for info in uploaded.values()), hashlib.sha256(body).hexdigest(), binlog
+
+
+def db_backup(db_host, db_port, db_user, db_pass, db_name, s3_bucket, s3_path, db_env="none", read_from=None, table_reuse=None):
+    """
+    Perform MySQL backup
+
+    read_from: the db/env's reader/replica selection settings, see sources.py
+    table_reuse: the db/env's table-level change detection settings, see tables.py
+    """
     timestamp = time.strftime('%Y-%m-%d-%I')
 
 
     if db_host != "dummy-dryrun":
         """
         In this example, the ops team is re-using existing scripts, for which Python is just a wrapper.
-        Calling a subprocess for the bash script and polling for it to end
+        Calling a subprocess for the bash script and reading its stdout until it ends, stderr on its own thread (see capture.run_captured)
         For errorhandling to work, ensure the bash script properly exits zero/nonzero
         """
-        process = subprocess.Popen(['bash', './db_backup.sh', db_host, db_port, db_user, db_pass, db_name, s3_bucket, s3_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        while True:
-            outs = process.stdout.readline()
-            errs = process.stderr.readline()
-            if outs:
-                print(outs.strip())
-            if errs:
-                print(errs.strip())
-                errors = errors + errs.strip()
-
-            result = process.poll()
-            if result is not None:
-                break
-        if process.returncode != 0:
-            send_error("db_backup script encounter errors", errors)
+        artifacts = []
+        binlog = {}
+        metrics = Metrics(dimensions={"db": db_name, "env": db_env, "job": "db_backup"})
+        started = time.perf_counter()
+
+        # With read_from mode auto/hosts, dump from the least loaded reader/replica with acceptable lag, the writer
+        # when there's none or when the dump records binlog coordinates (see sources.py)
+        import pymysql
+        connect_to = lambda host: pymysql.connect(host=host, port=int(db_port), user=db_user, passwd=db_pass, connect_timeout=3)
+        writer_only = "MYSQLDUMP_OPTS records binlog coordinates" if records_binlog(os.environ.get('MYSQLDUMP_OPTS')) else None
+        hosts, report = choose_sources(db_host, read_from, connect_to, rds=boto3.client('rds'), writer_only=writer_only)
+        print(describe(hosts, report))
+        metrics.put("ReadFromReplica", 0 if report["fallback"] else 1, "Count")
+        db_host = hosts[0]
+
+        command = ['bash', './db_backup.sh', db_host, db_port, db_user, db_pass, db_name, BACKUP_DIR]
+
+        # Streaming: with a KMS key (or BACKUP_STREAM=true for checksums only) the script streams the compressed
+        # dump through a FIFO and it's encrypted, checksummed and uploaded as it's produced (see envelope.py),
+        # instead of being written to disk, archived and then uploaded
+        kms_key_id = os.environ.get('BACKUP_KMS_KEY_ID', '')
+        # Where the objects land under s3_path (S3_LAYOUT, see layout.py), hashed layouts get a manifest per backup
+        layout = KeyLayout.from_environment()
+        manifest_for = lambda name: Manifest(layout, s3_path, name) if layout.hashed else None
+        streams = []
+        script_done = threading.Event()
+        script_result = {}
+        fifo = None
+        if kms_key_id or os.environ.get('BACKUP_STREAM', 'false').lower() == 'true':
+            fifo = os.path.join(BACKUP_DIR, db_name + ".stream")
+            os.makedirs(BACKUP_DIR, exist_ok=True)
+            if os.path.exists(fifo):
+                os.remove(fifo)
+            os.mkfifo(fifo)
+            command.append(fifo)
+
+        # Table-level change detection (see tables.py): only the tables that changed since the last backup are dumped
+        table_settings = reuse_settings(table_reuse)
+        table_plan = None
+        table_artifacts = {}
+        script_extra = {}
+        if table_settings and fifo:
+            print("table_reuse doesn't apply to streamed backups, dumping every table")
+        elif table_settings:
+            try:
+                connection = connect_to(db_host)
+                try:
+                    with connection.cursor() as cursor:
+                        fingerprints = fingerprint_tables(cursor, db_name, table_settings)
+                finally:
+                    connection.close()
+            except Exception as e:
+                send_error(e, "Error reading the table checksums of " + db_name + " on " + db_host)
+            try:
+                previous = previous_manifest(open_catalog(), boto3.client('s3'), db_name, db_env)
+            except Exception as e:
+                send_error(e, "Error reading the previous table backup of " + db_name + "/" + db_env)
+            table_plan = plan_tables(fingerprints, previous, table_settings)
+            print("Table backup: dumping " + str(len(table_plan["dump"])) + " of " + str(len(fingerprints)) + " tables"
+                + (" (full)" if table_plan["full"] else ", " + str(len(table_plan["reuse"])) + " unchanged since " + previous["backup"]))
+            script_extra = {"TABLE_BACKUP": "1", "DUMP_TABLES": " ".join(table_plan["dump"])}
+        script_ok = lambda: script_done.wait() and script_result.get("returncode") == 0
+        def handle_output(outs):
+            # (logging is done by run_captured, see capture.py)
+            # The script announces its stages, which is how we time them
+            if outs.startswith("Dumping database:"):
+                metrics.begin("DumpTime")
+            elif outs.startswith("Compressing database:"):
+                metrics.begin("CompressTime")
+            elif outs.startswith("DUMP_BYTES "):
+                metrics.put("DumpBytes", int(outs.split()[1]), "Bytes")
+            # The script lists each compressed dump it leaves behind for us to upload,
+            # preceded by the dump's binlog coordinates when mysqldump recorded them
+            elif outs.startswith("BINLOG "):
+                binlog_file, binlog_position = outs.split()[1:3]
+                binlog.update(binlog_file=binlog_file, binlog_position=binlog_position)
+            elif outs.startswith("ARTIFACT "):
+                metrics.end()
+                artifacts.append((outs[len("ARTIFACT "):].strip(), dict(binlog)))
+                binlog.clear()
+            elif outs.startswith("STREAMING "):
+                name = outs.split()[1]
+                streams.append(start_stream(fifo, name, s3_bucket, s3_path, kms_key_id, script_ok, metrics, manifest=manifest_for(name)))
+            elif outs.startswith("STREAMED "):
+                metrics.end()
+            elif outs.startswith("TABLE_ARTIFACT "):
+                kind, path = outs.split()[1:3]
+                table_artifacts[kind] = path
+            elif outs.startswith("TABLES_DONE "):
+                metrics.end()
+                table_artifacts["name"] = outs.split()[1]
+
+        # Output is logged through a rate limiter and only the last CAPTURE_TAIL_LINES stderr lines are
+        # kept for the failure report, so a chatty or failing script can't flood the logs or the payload
+        # Load-aware throttling (THROTTLE, see throttle.py): mysqldump's output goes through a relay whose rate
+        # follows the server's Threads_running, replica lag and row reads, sampled on a connection of its own
+        throttle_settings = settings_from_environment()
+        monitor = None
+        script_env = dict(os.environ, **script_extra) if script_extra else None
+        if throttle_settings:
+            rate_file = os.path.join(BACKUP_DIR, db_name + ".rate")
+            os.makedirs(BACKUP_DIR, exist_ok=True)
+            monitor = Monitor(lambda: pymysql.connect(host=db_host, port=int(db_port), user=db_user, passwd=db_pass, connect_timeout=5),
+                throttle_settings, rate_file=rate_file, metrics=metrics).start()
+            script_env = dict(script_env or os.environ, THROTTLE_RATE_FILE=rate_file)
+
+        returncode, stderr_tail, log = run_captured(command, on_stdout=handle_output, env=script_env)
+        if monitor:
+            monitor.stop()
+            os.remove(rate_file)
+        metrics.put("LogLinesSuppressed", log.suppressed_total, "Count")
+        # Let the stream threads complete their uploads (or abort them, if the script failed)
+        script_result["returncode"] = returncode
+        script_done.set()
+        for stream in streams:
+            stream["thread"].join()
+        if fifo:
+            os.remove(fifo)
+        failed_streams = [stream for stream in streams if "error" in stream]
+        if returncode == 0 and failed_streams:
+            metrics.put("Failed", 1, "Count")
+            metrics.flush()
+            send_error(failed_streams[0]["error"], "Streaming upload to s3://" + s3_bucket + "/" + failed_streams[0]["key"] + " failed")
+        if returncode != 0:
+            metrics.put("Failed", 1, "Count")
+            metrics.flush()
+            send_error(stderr_tail.text(), "db_backup script exited with code " + str(returncode))
         else:
+            catalog = open_catalog()
+            for artifact, artifact_binlog in artifacts:
+                size_bytes = os.path.getsize(artifact)
+                checksum = file_checksum(artifact)
+                manifest = manifest_for(os.path.basename(artifact))
+                with metrics.timer("UploadTime"):
+                    key = upload_file(artifact, s3_bucket, s3_path, manifest=manifest)
+                keys = [key]
+                if manifest:
+                    # Listed with the backup, so retention deletes it too
+                    keys.append(write_manifest(manifest, s3_bucket))
+                metrics.put("BackupBytes", size_bytes, "Bytes")
+                upload_seconds = metrics.values["UploadTime"] / 1000
+                if upload_seconds > 0:
+                    metrics.put("UploadThroughput", round(size_bytes / 1024 / 1024 / upload_seconds, 3), "Megabytes/Second")
+                if size_bytes and metrics.values.get("DumpBytes"):
+                    metrics.put("CompressionRatio", round(metrics.values["DumpBytes"] / size_bytes, 3))
+                if catalog:
+                    # Index the backup so restores/reports can find it without listing S3 (see catalog.py)
+                    index_backup(catalog, make_entry(db_name, db_env, s3_bucket, keys, size_bytes, checksum,
+                        codec="tar+gzip", **artifact_binlog))
+            if table_artifacts:
+                name = table_artifacts.pop("name")
+                manifest = manifest_for(name)
+                keys, size_bytes, checksum, table_binlog = upload_table_backup(name, table_artifacts, table_plan, fingerprints,
+                    previous, db_name, s3_bucket, s3_path, metrics, manifest=manifest)
+                if manifest:
+                    keys.append(write_manifest(manifest, s3_bucket))
+                metrics.put("BackupBytes", size_bytes, "Bytes")
+                if catalog:
+                    # The checksum is the table manifest's, the objects' own are in it
+                    index_backup(catalog, make_entry(db_name, db_env, s3_bucket, keys, size_bytes, checksum,
+                        codec=TABLES_CODEC, **table_binlog))
+            for stream in streams:
+                sums = stream["sums"]
+                keys = [stream["key"], stream["key"] + SUMS_SUFFIX]
+                if stream["manifest"]:
+                    keys.append(write_manifest(stream["manifest"], s3_bucket))
+                metrics.put("BackupBytes", sums["size"], "Bytes")
+                stream_seconds = metrics.values["StreamTime"] / 1000
+                if stream_seconds > 0:
+                    metrics.put("UploadThroughput", round(sums["size"] / 1024 / 1024 / stream_seconds, 3), "Megabytes/Second")
+                if catalog:
+                    # The sums file is part of the backup: restores need it, and retention deletes it with the object
+                    index_backup(catalog, make_entry(db_name, db_env, s3_bucket, keys, sums["size"],
+                        sums["sha256"], codec="gzip+aes-256-gcm" if sums["encryption"] else "gzip", **stream["binlog"]))
+            metrics.put("TotalTime", round((time.perf_counter() - started) * 1000, 3), "Milliseconds")
+            metrics.put("Failed", 0, "Count")
+            metrics.flush()
             output['status']="job complete"
             output['message']="Database " + db_name + " from host " + db_host + " backed up on " + timestamp
             send_success(output)
@@ -129,6 +483,62 @@ def db_backup(db_host, db_port, db_user, db_pass, db_name, s3_bucket, s3_path):
         output['message']="Dry run flag passed, no backup performed."
         send_success(output)
 
+def db_export(db_host, db_port, db_user, db_pass, db_name, s3_bucket, s3_path, db_env="none", read_from=None):
+    """
+    Export tables to compressed CSV or Parquet parts plus a manifest in S3 (see export.py)
+
+    EXPORT_FORMAT (csv or parquet), EXPORT_TABLES (comma separated, all tables if empty), EXPORT_THREADS,
+    EXPORT_ROWS_PER_CHUNK and EXPORT_BATCH_ROWS tune it. read_from: reader/replica selection, see sources.py.
+    """
+    import pymysql
+    metrics = Metrics(dimensions={"db": db_name, "env": db_env, "job": "db_export"})
+    threads = int(os.environ.get('EXPORT_THREADS', '4'))
+
+    def connect_to(host, timeout=10):
+        return pymysql.connect(host=host, port=int(db_port), user=db_user, passwd=db_pass, db=db_name, connect_timeout=timeout)
+
+    # Read from the least loaded usable readers/replicas, one per connection in turn when there are several
+    hosts, report = choose_sources(db_host, read_from, lambda host: connect_to(host, 3), rds=boto3.client('rds'), count=threads)
+    print(describe(hosts, report))
+    metrics.put("ReadFromReplica", 0 if report["fallback"] else 1, "Count")
+    metrics.put("SourceHosts", len(hosts), "Count")
+    next_host = itertools.cycle(hosts)
+
+    def connect():
+        return connect_to(next(next_host))
+
+    tables = [table.strip() for table in os.environ.get('EXPORT_TABLES', '').split(',') if table.strip()]
+    # Load-aware throttling (THROTTLE, see throttle.py): how many ranges export at once follows the server's load
+    throttle_settings = settings_from_environment()
+    gate = Gate(threads) if throttle_settings else None
+    # (the throttle watches the busiest-to-be source, the first one)
+    monitor = Monitor(lambda: connect_to(hosts[0]), throttle_settings, gate=gate, threads=threads, metrics=metrics).start() if throttle_settings else None
+    try:
+        manifest = export_database(connect, db_name, boto3.client('s3'), s3_bucket, s3_path,
+            tables=tables,
+            fmt=os.environ.get('EXPORT_FORMAT', 'csv').lower() or 'csv',
+            threads=threads,
+            rows_per_chunk=int(os.environ.get('EXPORT_ROWS_PER_CHUNK', '500000')),
+            batch_rows=int(os.environ.get('EXPORT_BATCH_ROWS', '10000')),
+            metrics=metrics,
+            gate=gate,
+            sources=hosts,
+            layout=KeyLayout.from_environment())
+    except Exception as e:
+        metrics.put("Failed", 1, "Count")
+        metrics.flush()
+        send_error(e, "Export of " + db_name + " failed")
+    finally:
+        if monitor:
+            monitor.stop()
+    metrics.put("Failed", 0, "Count")
+    metrics.flush()
+    if not manifest['snapshot']['consistent']:
+        print("Note: tables were exported from per-connection snapshots, not one global snapshot")
+    output['status']="job complete"
+    output['message']="Database " + db_name + " from host " + db_host + " exported to s3://" + s3_bucket + "/" + manifest['manifest_key']
+    send_success(output)
+
 # Main logic when called
 if __name__=="__main__":
     """
@@ -148,6 +558,12 @@ if __name__=="__main__":
     - S3_BUCKET: the S3 bucket to store the backup (demo assumes you've granted the Fargate Task Role rights)
     - S3_PATH: the prefix for where on the S3 bucket to store the backup
     """
+    if len(sys.argv) > 1 and sys.argv[1] == "pool":
+        # Worker-pool mode (ECS service): pull jobs from the queue and run each with this script, see pool.py
+        from pool import run_pool
+        run_pool()
+        sys.exit(0)
+
     try:
         stepfunction_token = os.environ['TASK_TOKEN_ENV_VARIABLE']
     except:
@@ -170,7 +586,12 @@ if __name__=="__main__":
     }
 
     # Parse job name and branch appropriately
-    if job_name.lower() == 'db_backup':
+    # (db_export needs the same database/S3 settings as db_backup, so they share the lookup)
+    if job_name.lower() in ('db_backup', 'db_export'):
+        # Where to read from (readers/replicas, see sources.py): the db/env's read_from setting, or READ_FROM (JSON)
+        read_from = json.loads(os.environ.get('READ_FROM') or 'null')
+        # Table-level change detection for db_backup (see tables.py): the db/env's table_reuse setting, or TABLE_REUSE (JSON)
+        table_reuse = json.loads(os.environ.get('TABLE_REUSE') or 'null')
         try: # get required env vars
             db_name = os.environ['DB_NAME'] 
 
@@ -203,20 +624,30 @@ if __name__=="__main__":
                 # /databasename/env as the path holding the rest of the values. Assumption is dbname/env should be unique.
                 keybase = "/serverlessops/databases/" + db_name + "/" + db_env 
                 
-                db_host = get_parameter(keybase + "/db_host")
-                db_port = get_parameter(keybase + "/db_port")
-                db_user = get_parameter(keybase + "/db_user")
-                db_pass = get_parameter(keybase + "/db_pass")
-                s3_bucket = get_parameter(keybase + "/s3_bucket")
-                s3_path = get_parameter(keybase +  "/s3_path")
+                db_settings = get_settings(keybase, ["db_host", "db_port", "db_user", "db_pass", "s3_bucket", "s3_path"])
+                db_host = db_settings["db_host"]
+                db_port = db_settings["db_port"]
+                db_user = db_settings["db_user"]
+                db_pass = db_settings["db_pass"]
+                s3_bucket = db_settings["s3_bucket"]
+                s3_path = db_settings["s3_path"]
+                read_from = db_settings.get("read_from", read_from)
+                table_reuse = db_settings.get("table_reuse", table_reuse)
 
             except Exception as e:
                 print("issue using parameter store")
                 send_error(e, "Error trying to get Parameter Store entries")
 
-        # Do the backup
-        print("Calling db backup logic")
-        db_backup(db_host, db_port, db_user, db_pass, db_name, s3_bucket, s3_path)
+        if job_name.lower() == 'db_export':
+            print("Calling db export logic")
+            run_profiled(db_export, db_host, db_port, db_user, db_pass, db_name, s3_bucket, s3_path, db_env=os.environ.get('DB_ENV', 'none'),
+                read_from=read_from, name="db_export-" + db_name, upload_to="s3://" + s3_bucket + "/" + s3_path.strip("/") + "/profiles")
+        else:
+            # Do the backup
+            print("Calling db backup logic")
+            # PROFILE=cpu,memory,stacks profiles the backup and uploads the results next to it (see profiling.py)
+            run_profiled(db_backup, db_host, db_port, db_user, db_pass, db_name, s3_bucket, s3_path, db_env=os.environ.get('DB_ENV', 'none'),
+                read_from=read_from, table_reuse=table_reuse, name="db_backup-" + db_name, upload_to="s3://" + s3_bucket + "/" + s3_path.strip("/") + "/profiles")
     
     elif job_name.lower() == 'db_restore':
         """
@@ -226,7 +657,40 @@ if __name__=="__main__":
         """
         print("asked to restore but this isn't coded yet")
         send_error("Unwritten function called", "Not implemented")
+    elif job_name.lower() == 'db_retention':
+        """
+        Expire old backups of DB_NAME/DB_ENV per the db/env's retention policy (see retention.py).
+        Set DRY_RUN=true to only report what would be deleted.
+        """
+        try:
+            db_name = os.environ['DB_NAME']
+            db_env = os.environ['DB_ENV']
+        except Exception as e:
+            send_error(e, "Required parameters (DB_NAME, DB_ENV) were not set, task aborted")
+        catalog = open_catalog()
+        if catalog is None:
+            send_error("No backup catalog configured", "Set CATALOG_TABLE (or CATALOG_SQLITE) for retention")
+        # Asked for by name: with the per-key layout only the keys asked for are read
+        db_settings = get_settings("/serverlessops/databases/" + db_name + "/" + db_env, ["retention"])
+        try:
+            policy = parse_policy(db_settings['retention'])
+        except Exception as e:
+            send_error(e, "The retention policy for " + db_name + "/" + db_env + " isn't valid, nothing was deleted")
+        if policy is None:
+            # An empty policy would keep everything, most likely not what whoever scheduled this wanted
+            send_error("No retention policy for " + db_name + "/" + db_env, "Set daily/weekly/monthly/yearly counts under retention: in its settings, nothing was deleted")
+        try:
+            report = apply_retention(catalog, boto3.client('s3'), db_name, db_env, policy,
+                dry_run=os.environ.get('DRY_RUN', 'false').lower() == 'true')
+        except Exception as e:
+            send_error(e, "Retention failed for " + db_name + "/" + db_env)
+        print(json.dumps(report, indent=2))
+        if report['errors']:
+            send_error(json.dumps(report['errors'][:10]), str(len(report['errors'])) + " objects could not be deleted")
+        output['status']="job complete"
+        output['message']="Retention for " + db_name + "/" + db_env + ": " + str(report['expired']) + " backups expired" + (" (dry run)" if report['dry_run'] else "")
+        send_success(output)
     else:
         # abort logic and send error to SF
         print("no valid job mentioned")
-        send_error("Invalid job name", "A required JOB_NAME env variable was not set, valid values are: db_backup, db_restore")
+        send_error("Invalid job name", "A required JOB_NAME env variable was not set, valid values are: db_backup, db_export, db_restore, db_retention")
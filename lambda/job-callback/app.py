@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import hmac
+import random
+import hashlib
+import logging
+import urllib.error
+import urllib.parse
+import urllib.request
+import boto3
+
+
+"""
+Lambda Function that pushes a job's final result to the callback its submission asked for, so
+clients don't have to poll /db/backup/status until the execution finishes.
+
+A submission names its callback next to the job (POST /db/backup, or StartExecution's input):
+
+    {
+      "job_name": "db_backup",
+      "job_options": {"db_name": "classicmodels", "db_env": "demo"},
+      "callback": {"type": "webhook", "url": "https://ops.example.com/hooks/backups"}
+    }
+
+    "callback": {"type": "sqs", "queue_url": "https://sqs.us-east-1.amazonaws.com/123456789012/backup-results"}
+
+The state machine's success and fail states invoke this function once each execution, only when
+there's a callback. The message:
+
+    {
+      "delivery_id": "<sha256 of execution ARN + status>",
+      "execution_arn": "arn:aws:states:...",
+      "status": "SUCCEEDED" | "FAILED",
+      "job_name": "db_backup", "db_name": "classicmodels", "db_env": "demo",
+      "result": {...the worker's output, or the error...},
+      "sent_at": 1700000000
+    }
+
+Only those job fields are sent, never the rest of job_options (which can hold credentials).
+
+Signing: every delivery carries an HMAC-SHA256 of "<timestamp>.<body>" with the stack's callback
+signing secret (Secrets Manager, CALLBACK_SECRET_ARN):
+- webhook: X-ServerlessOps-Signature: t=<timestamp>,v1=<hex> and X-ServerlessOps-Delivery: <delivery_id>
+- sqs: the same values as message attributes (signature, timestamp, delivery_id)
+Receivers check it with verify() (or the same few lines), and reject old timestamps.
+
+Retries: a delivery is tried up to CALLBACK_MAX_ATTEMPTS times with exponential backoff and jitter,
+on connection errors, timeouts, 429 and 5xx (other 4xx answers are final). A delivery that still
+fails is logged and recorded in the execution's output; it never fails the job itself. Retries,
+and StepFunctions retrying this function, can deliver twice: receivers dedupe on delivery_id (FIFO
+queues do it for us, it's the deduplication id).
+
+Webhooks must be https (CALLBACK_ALLOW_HTTP=true for testing) and on one of CALLBACK_ALLOWED_HOSTS;
+with none listed, no webhook is delivered. Redirects aren't followed, a 3xx answer fails the
+delivery, so a listed host can't bounce it somewhere else. SQS deliveries only reach the queues
+the function's role may send to. This function isn't in the VPC, so it can't reach private endpoints.
+
+For tests, deliver() takes its transports as an argument; MemoryTransport keeps deliveries in a
+list instead of sending them.
+"""
+
+# Set up logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SIGNATURE_HEADER = "X-ServerlessOps-Signature"
+DELIVERY_HEADER = "X-ServerlessOps-Delivery"
+# The job fields that go out with a delivery (job_options can hold credentials, the rest stays)
+JOB_FIELDS = ("db_name", "db_env")
+
+MAX_ATTEMPTS = int(os.environ.get('CALLBACK_MAX_ATTEMPTS', '5'))
+ATTEMPT_TIMEOUT_SECONDS = 10
+
+
+class DeliveryError(Exception):
+    """A delivery attempt failed. retryable: whether trying again can help"""
+
+    def __init__(self, message, retryable = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def sign(secret, body, timestamp):
+    """Response: the signature header value for body at timestamp"""
+    digest = hmac.new(secret.encode(), str(int(timestamp)).encode() + b"." + body, hashlib.sha256).hexdigest()
+    return "t=" + str(int(timestamp)) + ",v1=" + digest
+
+
+def verify(secret, body, signature, tolerance_seconds = 300, now = None):
+    """For receivers: whether signature (the header value) is body's, signed within tolerance_seconds"""
+    try:
+        fields = dict(part.split("=", 1) for part in signature.split(","))
+        timestamp = int(fields["t"])
+    except (ValueError, KeyError):
+        return False
+    now = time.time() if now is None else now
+    if abs(now - timestamp) > tolerance_seconds:
+        return False
+    return hmac.compare_digest(sign(secret, body, timestamp), signature)
+
+
+def build_message(event, now = None):
+    """The delivery for a state machine's notify event"""
+    execution_input = event.get('execution_input') or {}
+    job_options = execution_input.get('job_options') or {}
+    status = event['status']
+    return {
+        "delivery_id": hashlib.sha256((event['execution_arn'] + ":" + status).encode()).hexdigest(),
+        "execution_arn": event['execution_arn'],
+        "status": status,
+        "job_name": execution_input.get('job_name'),
+        **{field: job_options.get(field) for field in JOB_FIELDS},
+        "result": event.get('result'),
+        "sent_at": int(time.time() if now is None else now),
+    }
+
+
+def check_callback(callback, allowed_hosts = (), allow_http = False):
+    """Raise DeliveryError (not retryable) for a webhook/queue that can't or mustn't be delivered to"""
+    kind = (callback or {}).get('type')
+    if kind == "webhook":
+        url = urllib.parse.urlparse(callback.get('url') or "")
+        if url.scheme != "https" and not (allow_http and url.scheme == "http"):
+            raise DeliveryError("webhook callbacks must be https URLs", retryable = False)
+        host = url.hostname or ""
+        # Anyone who can submit a job picks the URL, so only listed hosts, and none when nothing is listed
+        if not any(host == allowed or (allowed.startswith(".") and host.endswith(allowed)) for allowed in allowed_hosts):
+            raise DeliveryError("webhook host " + host + " isn't in CALLBACK_ALLOWED_HOSTS", retryable = False)
+    elif kind == "sqs":
+        if not callback.get('queue_url'):
+            raise DeliveryError("sqs callbacks need a queue_url", retryable = False)
+
+
+class NoRedirects(urllib.request.HTTPRedirectHandler):
+    """3xx answers come back as HTTPErrors instead of being followed past check_callback"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class WebhookTransport:
+    def __init__(self):
+        self.opener = urllib.request.build_opener(NoRedirects)
+
+    def __call__(self, callback, body, signature, delivery_id):
+        request = urllib.request.Request(callback['url'], data = body, method = "POST", headers = {
+            "Content-Type": "application/json",
+            SIGNATURE_HEADER: signature,
+            DELIVERY_HEADER: delivery_id,
+        })
+        try:
+            with self.opener.open(request, timeout = ATTEMPT_TIMEOUT_SECONDS) as response:
+                return {"status_code": response.status}
+        except urllib.error.HTTPError as e:
+            if 300 <= e.code < 400:
+                raise DeliveryError("webhook answered " + str(e.code) + ", redirects aren't followed", retryable = False)
+            raise DeliveryError("webhook answered " + str(e.code), retryable = e.code == 429 or e.code >= 500)
+        except (urllib.error.URLError, OSError) as e:
+            raise DeliveryError("webhook unreachable: " + str(e))
+
+
+class SqsTransport:
+    def __init__(self, client = None):
+        self.client = client
+
+    def __call__(self, callback, body, signature, delivery_id):
+        self.client = self.client or boto3.client('sqs')
+        timestamp = signature.split(",")[0][2:]
+        message = {
+            "QueueUrl": callback['queue_url'],
+            "MessageBody": body.decode(),
+            "MessageAttributes": {
+                "signature": {"DataType": "String", "StringValue": signature},
+                "timestamp": {"DataType": "Number", "StringValue": timestamp},
+                "delivery_id": {"DataType": "String", "StringValue": delivery_id},
+            },
+        }
+        if callback['queue_url'].endswith(".fifo"):
+            message["MessageGroupId"] = callback.get('message_group_id') or "serverlessops-jobs"
+            message["MessageDeduplicationId"] = delivery_id
+        try:
+            return {"message_id": self.client.send_message(**message)["MessageId"]}
+        except Exception as e:
+            code = getattr(e, "response", {}).get("Error", {}).get("Code", "")
+            raise DeliveryError("sqs send failed: " + str(e), retryable = code not in ("AWS.SimpleQueueService.NonExistentQueue",
+                "AccessDenied", "AccessDeniedException", "InvalidParameterValue"))
+
+
+class MemoryTransport:
+    """The in-memory stand-in: keeps deliveries, optionally failing the first fail_times attempts"""
+
+    def __init__(self, fail_times = 0, retryable = True):
+        self.deliveries = []
+        self.attempts = 0
+        self.fail_times = fail_times
+        self.retryable = retryable
+
+    def __call__(self, callback, body, signature, delivery_id):
+        self.attempts += 1
+        if self.attempts <= self.fail_times:
+            raise DeliveryError("memory transport failing on purpose", retryable = self.retryable)
+        self.deliveries.append({"callback": callback, "body": body, "signature": signature, "delivery_id": delivery_id})
+        return {"delivered": len(self.deliveries)}
+
+
+def deliver(callback, message, secret, transports, max_attempts = MAX_ATTEMPTS, base_delay = 1.0, max_delay = 20.0,
+        sleep = time.sleep, allowed_hosts = (), allow_http = False):
+    """
+    Send message to callback, retrying with backoff
+
+    transports, dict = callback type -> transport(callback, body, signature, delivery_id)
+
+    Response: dict with delivered, attempts, and the last error or the transport's answer
+    """
+    if (callback or {}).get('type') not in transports:
+        raise DeliveryError("unknown callback type " + str((callback or {}).get('type')) + ", expected one of: "
+            + ", ".join(sorted(transports)), retryable = False)
+    check_callback(callback, allowed_hosts, allow_http)
+    body = json.dumps(message, default = str, sort_keys = True).encode()
+    error = None
+    for attempt in range(1, max_attempts + 1):
+        # Signed per attempt, so a slow retry still carries a fresh timestamp
+        signature = sign(secret, body, time.time())
+        try:
+            answer = transports[callback['type']](callback, body, signature, message['delivery_id'])
+            return {"delivered": True, "attempts": attempt, "answer": answer}
+        except DeliveryError as e:
+            error = e
+            logger.warning("Callback attempt " + str(attempt) + " failed: " + str(e))
+            if not e.retryable or attempt == max_attempts:
+                break
+            # Full jitter, so callbacks failing together don't retry together
+            sleep(random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1))))
+    return {"delivered": False, "attempts": attempt, "error": str(error)}
+
+
+_secret = None
+
+
+def signing_secret():
+    """The signing secret, read once per execution environment"""
+    global _secret
+    if _secret is None:
+        _secret = boto3.client('secretsmanager').get_secret_value(SecretId=os.environ['CALLBACK_SECRET_ARN'])['SecretString']
+    return _secret
+
+
+def handler(event, context):
+    """
+    Main handler, entry point for Lambda Function (invoked by the state machine's notify states)
+
+    Payload: {"status", "execution_arn", "execution_input" (the execution's input, with "callback"), "result"}
+    """
+    callback = (event.get('execution_input') or {}).get('callback')
+    if not callback:
+        return {"delivered": False, "error": "no callback"}
+    message = build_message(event)
+    allowed_hosts = json.loads(os.environ.get('CALLBACK_ALLOWED_HOSTS') or '[]')
+    try:
+        outcome = deliver(callback, message, signing_secret(), {"webhook": WebhookTransport(), "sqs": SqsTransport()},
+            allowed_hosts=allowed_hosts, allow_http=os.environ.get('CALLBACK_ALLOW_HTTP', 'false').lower() == 'true')
+    except DeliveryError as e:
+        outcome = {"delivered": False, "attempts": 0, "error": str(e)}
+    outcome["delivery_id"] = message['delivery_id']
+    logger.info("Callback for " + event['execution_arn'] + " (" + event['status'] + "): " + json.dumps(outcome, default=str))
+    if not outcome["delivered"]:
+        # Raised so the execution's history shows it, the state machine catches it and finishes the job anyway
+        raise RuntimeError("Callback not delivered: " + outcome["error"])
+    return outcome
@@ -0,0 +1,259 @@
+import os
+import re
+import json
+import math
+import time
+import hashlib
+import logging
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+"""
+Lambda Function that sits in front of StepFunctions StartExecution and coalesces
+duplicate job submissions.
+
+Without this, every POST to /db/backup starts its own execution (and so its own
+Fargate task). A retrying client plus a cron job asking for the same backup a few
+seconds apart means two dumps of the same database. Instead, this function:
+
+1. Derives a job key from (job_name, db_name, db_env, window), where "window" is
+   the submission time bucketed into COALESCE_WINDOW_SECONDS chunks. Values with
+   characters an execution name can't hold get a hash of the original, so "demo-2",
+   "demo_2" and "demo.2" stay different jobs.
+2. If an execution for the same job_name/db_name/db_env from an earlier window is
+   still RUNNING, or SUCCEEDED within the last FRESHNESS_SECONDS, returns that
+   execution's ARN instead of starting another.
+3. Otherwise starts a new execution, named after the job key (and handed back the
+   same way when this window already has a running or fresh one).
+
+Nothing is listed: execution names are deterministic (job key + "-<attempt>"), so
+step 2 describes the first names of the earlier windows that can still matter
+(the previous one, or as many as FRESHNESS_SECONDS spans, at most
+MAX_LOOKBACK_WINDOWS), stopping at a window's first name that was never used. A
+new job costs one DescribeExecution per window looked back plus its
+StartExecution, however many executions the state machine has. ListExecutions'
+quota is far smaller and every call would have to page through all of them. A job
+still running from further back than that isn't found, and a second one starts.
+
+Naming the execution after the job key is what closes the race between two callers
+that both find nothing in steps 2/3: StepFunctions treats a StartExecution with the
+name and input of a running execution as a no-op and returns the same ARN, and a
+name clash with different input raises ExecutionAlreadyExists, which we resolve by
+describing the existing execution. Names are unique per state machine (even after
+the execution ends), so a trailing attempt counter is bumped when an earlier
+execution in the same window failed. The job prefix (job_name-db_name-db_env) holds
+a hash of the full values when they're too long to fit, so long names coalesce like
+short ones.
+
+Payload (same as the direct StartExecution integration, this is passed as the
+execution input untouched):
+
+    {
+      "job_name": "db_backup",
+      "job_options": {
+        "db_name": "yourdbname",
+        "db_env": "yourdbenv"
+      }
+    }
+
+Response (StartExecution's response plus a flag saying whether it was coalesced):
+
+    {
+      "executionArn": "arn:aws:states:...",
+      "startDate": 1672531200.0,
+      "coalesced": true
+    }
+
+A submission that can't be placed gets a 429 (too many failed executions of the job
+in this window) or a 503 (StepFunctions throttled or unreachable), with a message
+and Retry-After, instead of API Gateway's bare 502.
+"""
+
+# Set up logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Created once per execution environment, re-used on warm invocations
+sfn = boto3.client('stepfunctions')
+
+# StepFunctions execution names are limited to 80 characters
+MAX_EXECUTION_NAME = 80
+# Room the job prefix leaves for "-<window>-<attempt>" (a 10 digit window, a 1 digit attempt)
+PREFIX_LIMIT = MAX_EXECUTION_NAME - len("-9999999999-9")
+# How many attempt suffixes to try in one window before giving up
+MAX_ATTEMPTS = 10
+# How many earlier windows are looked at for a running or fresh execution
+MAX_LOOKBACK_WINDOWS = 4
+
+
+def _clean(value):
+    """
+    Make a value safe for an execution name. Dashes are reserved as the separator.
+
+    A value that needed characters replaced gets a hash of the original added, so "demo-2",
+    "demo_2" and "demo.2" stay different jobs while plain names read as they are.
+    """
+    value = str(value)
+    cleaned = re.sub(r'[^A-Za-z0-9_]', '_', value) or "none"
+    if cleaned != value:
+        cleaned += "_" + hashlib.sha1(value.encode()).hexdigest()[:8]
+    return cleaned
+
+
+def job_prefix(job_name, db_name, db_env):
+    """
+    The part of the job key that identifies the work itself (no time component)
+
+    If it gets too long for an execution name, it's shortened and a hash of the full prefix
+    added, so every name for the job still starts with the same prefix and different jobs
+    don't collide.
+    """
+    prefix = "-".join([_clean(job_name), _clean(db_name), _clean(db_env)])
+    if len(prefix) > PREFIX_LIMIT:
+        digest = hashlib.sha1(prefix.encode()).hexdigest()[:12]
+        prefix = prefix[:PREFIX_LIMIT - len(digest) - 1] + "_" + digest
+    return prefix
+
+
+def job_key(job_name, db_name, db_env, window):
+    """Job key for coalescing: job_name-db_name-db_env-window (execution names add "-<attempt>")"""
+    return job_prefix(job_name, db_name, db_env) + "-" + str(window)
+
+
+def window_index(now, window_seconds):
+    """Bucket a timestamp (epoch seconds) into a coalescing window"""
+    return int(now // window_seconds)
+
+
+def _epoch(value):
+    """boto3 returns datetimes, the tests use plain floats, accept both"""
+    if value is None:
+        return None
+    if hasattr(value, 'timestamp'):
+        return value.timestamp()
+    return float(value)
+
+
+def _response(execution, coalesced):
+    return {
+        "executionArn": execution['executionArn'],
+        "startDate": _epoch(execution.get('startDate')),
+        "coalesced": coalesced
+    }
+
+
+def _reusable(execution, now, freshness_seconds):
+    """Whether a described execution can be handed back instead of starting a new one"""
+    if execution['status'] == 'RUNNING':
+        return True
+    if execution['status'] == 'SUCCEEDED':
+        stop_date = _epoch(execution.get('stopDate'))
+        return stop_date is not None and now - stop_date <= freshness_seconds
+    return False
+
+
+def _execution_arn(state_machine_arn, name):
+    return state_machine_arn.replace(":stateMachine:", ":execution:") + ":" + name
+
+
+def find_reusable(client, state_machine_arn, key, now, freshness_seconds):
+    """
+    A running or fresh execution among key's names (key-0, key-1, ...), if there is one
+
+    Attempt numbers are taken in order, so the first name that doesn't exist ends the search.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            execution = client.describe_execution(executionArn=_execution_arn(state_machine_arn, key + "-" + str(attempt)))
+        except client.exceptions.ExecutionDoesNotExist:
+            return None
+        if _reusable(execution, now, freshness_seconds):
+            return execution
+    return None
+
+
+def lookback_windows(window_seconds, freshness_seconds):
+    """Earlier windows that can hold a running or fresh execution: the previous one, or as many as freshness spans"""
+    return min(MAX_LOOKBACK_WINDOWS, max(1, math.ceil(freshness_seconds / window_seconds)))
+
+
+def submit(client, state_machine_arn, job, now, window_seconds, freshness_seconds):
+    """
+    Start the job, or return the ARN of a matching running/recently completed execution
+
+    job, dict = the execution input ({"job_name": ..., "job_options": {...}})
+    """
+    job_name = job['job_name']
+    options = job.get('job_options') or {}
+    window = window_index(now, window_seconds)
+
+    # Most recent window first
+    for earlier in range(window - 1, window - 1 - lookback_windows(window_seconds, freshness_seconds), -1):
+        existing = find_reusable(client, state_machine_arn, job_key(job_name, options.get('db_name'), options.get('db_env'), earlier),
+            now, freshness_seconds)
+        if existing:
+            logger.info("Coalescing into " + existing['status'].lower() + " execution " + existing['executionArn'])
+            return _response(existing, True)
+
+    key = job_key(job_name, options.get('db_name'), options.get('db_env'), window)
+    job_input = json.dumps(job)
+    for attempt in range(MAX_ATTEMPTS):
+        name = key + "-" + str(attempt)
+        try:
+            started = client.start_execution(stateMachineArn=state_machine_arn, name=name, input=job_input)
+            logger.info("Started execution " + started['executionArn'])
+            return _response(started, False)
+        except client.exceptions.ExecutionAlreadyExists:
+            # Someone else got there first, or an earlier attempt in this window finished
+            execution_arn = _execution_arn(state_machine_arn, name)
+            existing = client.describe_execution(executionArn=execution_arn)
+            if _reusable(existing, now, freshness_seconds):
+                logger.info("Coalescing into existing execution " + execution_arn)
+                return _response(existing, True)
+            # Failed/aborted/stale, try the next attempt number
+    raise RuntimeError("Too many executions for job key " + key + " in this window")
+
+
+def _error(status_code, message, retry_after):
+    return {
+        "statusCode": status_code,
+        "headers": {"Retry-After": str(int(retry_after))},
+        "body": json.dumps({"message": message})
+    }
+
+
+def handler(event, context):
+    """
+    Main handler, entry point for Lambda Function (API Gateway proxy integration)
+    """
+    try:
+        job = json.loads(event.get('body') or "{}")
+        job['job_name']
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error("ERROR: Expected a JSON body with at least 'job_name'.")
+        logger.error(e)
+        return {"statusCode": 400, "body": json.dumps({"message": "Expected a JSON body with at least 'job_name'"})}
+    if not isinstance(job.get('job_options') or {}, dict):
+        logger.error("ERROR: 'job_options' isn't an object: " + repr(job.get('job_options')))
+        return {"statusCode": 400, "body": json.dumps({"message": "Expected 'job_options' to be an object"})}
+
+    now = time.time()
+    window_seconds = int(os.environ.get('COALESCE_WINDOW_SECONDS', '900'))
+    try:
+        result = submit(sfn,
+            state_machine_arn = os.environ['STATE_MACHINE_ARN'],
+            job = job,
+            now = now,
+            window_seconds = window_seconds,
+            freshness_seconds = int(os.environ.get('FRESHNESS_SECONDS', '0'))
+        )
+    except RuntimeError as e:
+        # Every execution name in this window is taken by a failed run of the job, the next window has fresh ones
+        logger.error(e)
+        return _error(429, str(e) + ", try again in the next window", window_seconds - now % window_seconds)
+    except (ClientError, BotoCoreError) as e:
+        # Throttled past the SDK's retries, or StepFunctions unreachable. Resubmitting is safe, duplicates coalesce
+        logger.error(e)
+        return _error(503, "Could not submit the job to StepFunctions, try again: " + str(e), 5)
+    return {"statusCode": 200, "body": json.dumps(result)}
@@ -0,0 +1,154 @@
+import os
+import json
+import logging
+import boto3
+from metrics import Metrics
+import diagnostics
+
+
+"""
+Lambda Function serving read-only MySQL diagnostics (processlist, table sizes, replication status,
+...) through the API, so nobody needs a jumpbox to see what a database is doing.
+
+    GET /diagnostics?db_name=classicmodels&db_env=demo                        the queries allowed there
+    GET /diagnostics?db_name=classicmodels&db_env=demo&query=processlist      one query's result
+
+or invoked directly with {"db_name": ..., "db_env": ..., "query": ...}. Only the named queries in
+diagnostics.py can run, see there for the list, the per db/env settings and the cache.
+
+What stays between warm invocations (everything outside "def handler"):
+- the results cache: a dashboard refreshing every few seconds reads the cache until the query's
+  TTL runs out. Each warm execution environment has its own cache, so max_concurrency (settings.yml)
+  also caps how many times a query can run per TTL.
+- the connection pool: the first request for a db/env connects, later ones reuse that connection
+  (after a ping) instead of paying for a new connection and TLS handshake each time.
+- the db/env settings from Parameter Store, for SETTINGS_TTL_SECONDS (default 300).
+
+Responses carry Cache-Control: max-age set to what's left of the TTL, so dashboards and browsers
+needn't even ask again before then.
+
+Connections are opened read only (SET SESSION TRANSACTION READ ONLY) with MAX_EXECUTION_MS
+(default 5000) as the statement time limit (MySQL 5.7.8+, ignored where unsupported). Give the
+db/env a diagnostics_user/diagnostics_pass (PROCESS, REPLICATION CLIENT, SELECT on sys) to not use
+the admin account.
+"""
+
+# Set up logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Created once per execution environment, re-used on warm invocations
+ssm = boto3.client('ssm')
+
+SETTINGS_TTL_SECONDS = int(os.environ.get('SETTINGS_TTL_SECONDS', '300'))
+MAX_EXECUTION_MS = int(os.environ.get('MAX_EXECUTION_MS', '5000'))
+
+
+def connect(settings):
+    """A new read-only connection for a db/env's settings"""
+    # Imported on first use, like the mysql-users function, to keep it out of the cold start
+    import pymysql
+    connection = pymysql.connect(host=settings["db_host"], port=int(settings["db_port"]),
+        user=settings.get("diagnostics_user") or settings["db_user"], passwd=settings.get("diagnostics_pass") or settings["db_pass"],
+        connect_timeout=5, read_timeout=max(10, MAX_EXECUTION_MS // 1000 + 5), autocommit=True)
+    with connection.cursor() as cursor:
+        cursor.execute("SET SESSION TRANSACTION READ ONLY")
+        try:
+            cursor.execute("SET SESSION MAX_EXECUTION_TIME = %s", (MAX_EXECUTION_MS,))
+        except pymysql.MySQLError:
+            pass
+    return connection
+
+
+cache = diagnostics.TtlCache()
+pool = diagnostics.ConnectionPool(connect)
+
+
+def get_parameter(keyname):
+    """Get a value from Parameter Store"""
+    response = ssm.get_parameter(Name=keyname, WithDecryption=True)
+    return response['Parameter']['Value']
+
+
+def get_settings(keybase, keys, optional=()):
+    """
+    Get the settings for a db/env from Parameter Store: the one JSON document at keybase (parameter_layout:
+    documents), or one parameter per key at keybase/key
+
+    optional, list = keys read too in the keys layout, left out when there's no parameter for them
+    """
+    document = get_parameter(keybase)
+    try:
+        values = json.loads(document)
+    except ValueError:
+        values = None
+    if isinstance(values, dict):
+        return values
+    values = {key: get_parameter(keybase + "/" + key) for key in keys}
+    for key in optional:
+        try:
+            values[key] = get_parameter(keybase + "/" + key)
+        except ssm.exceptions.ParameterNotFound:
+            pass
+    return values
+
+
+def db_settings(db_name, db_env):
+    keybase = "/serverlessops/databases/" + db_name + "/" + db_env
+    settings, age, cached = cache.get(("settings", keybase), SETTINGS_TTL_SECONDS,
+        lambda: get_settings(keybase, ["db_host", "db_port", "db_user", "db_pass"],
+            optional=["diagnostics", "diagnostics_user", "diagnostics_pass"]))
+    return settings
+
+
+def request_of(event):
+    """The request's db_name/db_env/query, from API Gateway's query string or a direct invocation"""
+    if 'httpMethod' in event:
+        return event.get('queryStringParameters') or {}
+    return event
+
+
+def response(status_code, body, max_age=0):
+    headers = {"Content-Type": "application/json", "Cache-Control": ("max-age=" + str(max_age)) if max_age else "no-store"}
+    return {"statusCode": status_code, "headers": headers, "body": json.dumps(body, default=str)}
+
+
+def handler(event, context):
+    """
+    Main handler, entry point for Lambda Function
+
+    Response: API Gateway proxy response, with the query's result (see diagnostics.diagnose) as its body
+    """
+    request = request_of(event)
+    db_name = request.get('db_name')
+    db_env = request.get('db_env')
+    name = request.get('query')
+    if not db_name or not db_env:
+        return response(400, {"message": "Expected 'db_name' and 'db_env'"})
+    metrics = Metrics(dimensions={"db": db_name, "env": db_env, "job": "mysql_diagnostics"})
+    try:
+        with metrics.timer("ParameterLookupTime"):
+            settings = db_settings(db_name, db_env)
+    except Exception as e:
+        logger.error("ERROR: Could not read the settings of " + db_name + "/" + db_env + ": " + str(e))
+        return response(404, {"message": "No settings for " + db_name + "/" + db_env})
+
+    if not name:
+        allowed = diagnostics.allowed_queries(settings)
+        return response(200, {"db_name": db_name, "db_env": db_env, "queries": {query: {
+            "ttl_seconds": ttl, "description": diagnostics.QUERIES[query]["description"]} for query, ttl in allowed.items()}})
+
+    try:
+        opened = pool.stats["opened"]
+        with metrics.timer("HandlerTime"):
+            result = diagnostics.diagnose(cache, pool, db_name, db_env, settings, name)
+        metrics.put("CacheHit", 1 if result["cached"] else 0, "Count")
+        metrics.put("ConnectionsOpened", pool.stats["opened"] - opened, "Count")
+        return response(200, result, max_age=max(0, int(result["ttl_seconds"] - result["age_seconds"])))
+    except diagnostics.UnknownQuery as e:
+        return response(400, {"message": str(e)})
+    except Exception as e:
+        logger.error("ERROR: " + name + " on " + db_name + "/" + db_env + " failed: " + str(e))
+        return response(502, {"message": name + " failed: " + str(e)})
+    finally:
+        metrics.flush()
@@ -0,0 +1,251 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+"""
+Read-only diagnostics: the queries ops engineers used to run from a jumpbox, by name.
+
+Only the named queries in QUERIES can run, there's no way to pass SQL in. Each db/env can narrow
+the list and change the cache times in its settings (Parameter Store document, settings.yml
+parameters:):
+
+    diagnostics:
+      queries: [processlist, table_sizes, replication_status]   # default: all of QUERIES
+      ttl_seconds:
+        table_sizes: 600
+
+Results are cached per (db, env, query) for the query's TTL (TtlCache), so any number of
+dashboard refreshes within the TTL cost one database query. Concurrent requests for the same key
+wait for the one load in flight instead of each running the query.
+
+Connections come from a ConnectionPool that outlives the invocation (the Lambda keeps it between
+warm invocations), each one set to read only, with a per-statement time limit, when it's opened.
+"""
+
+# name -> sql (%(db_name)s is the db/env's database, the only parameter), default TTL, description
+QUERIES = {
+    "processlist": {
+        "sql": "SELECT ID, USER, HOST, DB, COMMAND, TIME, STATE, LEFT(INFO, 300) AS INFO FROM information_schema.PROCESSLIST"
+            " WHERE COMMAND <> 'Sleep' ORDER BY TIME DESC LIMIT 200",
+        "ttl_seconds": 5,
+        "description": "Running (non-sleeping) connections, longest running first",
+    },
+    "table_sizes": {
+        "sql": "SELECT TABLE_NAME, ENGINE, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH, DATA_FREE,"
+            " DATA_LENGTH + INDEX_LENGTH AS TOTAL_LENGTH FROM information_schema.TABLES"
+            " WHERE TABLE_SCHEMA = %(db_name)s AND TABLE_TYPE = 'BASE TABLE' ORDER BY TOTAL_LENGTH DESC LIMIT 200",
+        "ttl_seconds": 300,
+        "description": "The database's tables by size (estimates from information_schema)",
+    },
+    "replication_status": {
+        "statements": ["SHOW REPLICA STATUS", "SHOW SLAVE STATUS"],
+        "ttl_seconds": 10,
+        "description": "This server's replication status, empty when it isn't a replica",
+    },
+    "aurora_replicas": {
+        "sql": "SELECT SERVER_ID, SESSION_ID, REPLICA_LAG_IN_MILLISECONDS, LAST_UPDATE_TIMESTAMP"
+            " FROM information_schema.REPLICA_HOST_STATUS",
+        "ttl_seconds": 10,
+        "description": "Aurora: every instance in the cluster and its replica lag",
+    },
+    "long_transactions": {
+        "sql": "SELECT trx_id, trx_state, trx_started, TIMESTAMPDIFF(SECOND, trx_started, NOW()) AS seconds,"
+            " trx_mysql_thread_id, trx_rows_locked, trx_rows_modified, LEFT(trx_query, 300) AS trx_query"
+            " FROM information_schema.INNODB_TRX ORDER BY trx_started LIMIT 100",
+        "ttl_seconds": 10,
+        "description": "Open InnoDB transactions, oldest first",
+    },
+    "lock_waits": {
+        "sql": "SELECT wait_started, wait_age_secs, locked_table, waiting_pid, LEFT(waiting_query, 300) AS waiting_query,"
+            " blocking_pid, LEFT(blocking_query, 300) AS blocking_query FROM sys.innodb_lock_waits LIMIT 100",
+        "ttl_seconds": 5,
+        "description": "Sessions waiting on InnoDB row locks and who holds them",
+    },
+    "status_counters": {
+        "sql": "SHOW GLOBAL STATUS WHERE Variable_name IN ('Threads_connected', 'Threads_running', 'Uptime', 'Questions',"
+            " 'Slow_queries', 'Aborted_connects', 'Innodb_row_lock_waits', 'Innodb_buffer_pool_reads',"
+            " 'Innodb_buffer_pool_read_requests', 'Created_tmp_disk_tables')",
+        "ttl_seconds": 10,
+        "description": "A handful of global status counters",
+    },
+}
+
+
+class UnknownQuery(Exception):
+    """A query name that isn't in QUERIES or isn't allowed for the db/env"""
+
+
+def allowed_queries(db_settings):
+    """The query name -> effective TTL map for a db/env's diagnostics: settings"""
+    settings = (db_settings or {}).get("diagnostics") or {}
+    if isinstance(settings, str):
+        # The keys parameter layout stores nested settings as JSON strings
+        settings = json.loads(settings)
+    names = settings.get("queries") or list(QUERIES)
+    ttls = settings.get("ttl_seconds") or {}
+    return {name: int(ttls.get(name, QUERIES[name]["ttl_seconds"])) for name in names if name in QUERIES}
+
+
+class TtlCache:
+    """
+    Values kept for a TTL each, with one load at a time per key
+
+    clock, callable = time source (time.monotonic), replaceable for tests
+    max_entries, int = past this, the oldest entries are dropped
+    """
+
+    def __init__(self, clock = time.monotonic, max_entries = 256):
+        self.clock = clock
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.loading = {}
+
+    def get(self, key, ttl_seconds, load):
+        """
+        The cached value for key, or load()'s, cached for ttl_seconds
+
+        Response: (value, age in seconds, whether it came from the cache)
+        """
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                now = self.clock()
+                if entry and now - entry[0] < ttl_seconds:
+                    return entry[1], now - entry[0], True
+                waiting = self.loading.get(key)
+                if waiting is None:
+                    self.loading[key] = threading.Event()
+                    break
+            # Someone else is loading it, use theirs (or load it ourselves if theirs failed)
+            waiting.wait()
+        try:
+            value = load()
+            with self.lock:
+                self.entries[key] = (self.clock(), value)
+                self.trim()
+            return value, 0.0, False
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def trim(self):
+        if len(self.entries) <= self.max_entries:
+            return
+        for key, (stored, value) in sorted(self.entries.items(), key = lambda item: item[1][0]):
+            if len(self.entries) <= self.max_entries:
+                break
+            del self.entries[key]
+
+
+class ConnectionPool:
+    """
+    Idle connections per (host, port, user), reused until max_age_seconds
+
+    connect, callable = connect(settings) returns a new connection for those settings
+    """
+
+    def __init__(self, connect, max_idle = 2, max_age_seconds = 300, clock = time.monotonic):
+        self.connect = connect
+        self.max_idle = max_idle
+        self.max_age_seconds = max_age_seconds
+        self.clock = clock
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.stats = {"opened": 0, "reused": 0, "discarded": 0}
+
+    def take_idle(self, key):
+        with self.lock:
+            while self.idle.get(key):
+                opened, connection = self.idle[key].pop()
+                if self.clock() - opened < self.max_age_seconds:
+                    return opened, connection
+                self.discard(connection)
+        return None, None
+
+    def discard(self, connection):
+        self.stats["discarded"] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self, settings):
+        """A live connection for settings (db_host, db_port, db_user, ...), back to the pool afterwards"""
+        key = (settings["db_host"], str(settings["db_port"]), settings.get("diagnostics_user") or settings["db_user"])
+        opened, connection = self.take_idle(key)
+        if connection is not None:
+            try:
+                # Idle connections can be closed by the server (wait_timeout) while the Lambda is frozen
+                connection.ping(reconnect = False)
+                self.stats["reused"] += 1
+            except Exception:
+                self.discard(connection)
+                connection = None
+        if connection is None:
+            connection = self.connect(settings)
+            opened = self.clock()
+            self.stats["opened"] += 1
+        try:
+            yield connection
+        except Exception:
+            self.discard(connection)
+            raise
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((opened, connection))
+                return
+        self.discard(connection)
+
+
+def rows_of(cursor):
+    columns = [description[0] for description in cursor.description or []]
+    return columns, [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def run_query(connection, name, db_name):
+    """Run one named query. Response: dict with columns and rows"""
+    query = QUERIES[name]
+    with connection.cursor() as cursor:
+        if "sql" in query:
+            cursor.execute(query["sql"], {"db_name": db_name} if "%(db_name)s" in query["sql"] else None)
+            columns, rows = rows_of(cursor)
+        else:
+            # Alternatives for different server versions, the first one the server accepts
+            error = None
+            for statement in query["statements"]:
+                try:
+                    cursor.execute(statement)
+                except Exception as e:
+                    error = e
+                    continue
+                columns, rows = rows_of(cursor)
+                break
+            else:
+                raise error
+    return {"columns": columns, "rows": rows}
+
+
+def diagnose(cache, pool, db_name, db_env, db_settings, name):
+    """
+    A named query's result for db/env, from the cache when it's fresh enough
+
+    Response: dict with the query, its columns and rows, and how fresh they are
+    """
+    allowed = allowed_queries(db_settings)
+    if name not in allowed:
+        raise UnknownQuery(name + " isn't one of the diagnostics for " + db_name + "/" + db_env + ": " + ", ".join(sorted(allowed)))
+    ttl_seconds = allowed[name]
+
+    def load():
+        with pool.connection(db_settings) as connection:
+            result = run_query(connection, name, db_name)
+        result["fetched_at"] = time.time()
+        return result
+
+    result, age, cached = cache.get((db_name, db_env, name), ttl_seconds, load)
+    return {"query": name, "db_name": db_name, "db_env": db_env, "cached": cached, "age_seconds": round(age, 3),
+        "ttl_seconds": ttl_seconds, **result}
@@ -4,7 +4,9 @@ import boto3
 import json
 import sys
 import logging
-import pymysql
+from metrics import Metrics
+from profiling import run_profiled
+import reconcile
 
 
 """
@@ -22,6 +24,11 @@ Requires:
 - IAM role with rights (AWSLambdaVPCExecution managed policy and rights to read 
   the Parameter Store entries)
   
+Modes:
+- default: create one user (CREATE USER + GRANT ALL on the database), payload below
+- "mode": "reconcile": make the host's users and grants match a desired list, sending only the
+  CREATE/ALTER/GRANT/REVOKE statements needed. See reconcile.py for the payload.
+
 Usage:
 - Ensure Lambda timeout is appropriate (default of 3 seconds is likely too short)
 - Pass in the following payload with appropriate values (first two should be in 
@@ -51,6 +58,10 @@ Usage:
 
 Deviations from best practices:
 On Purpose:
+- pymysql isn't imported at the top of the file: it's imported by mysql() the first time a
+  database call needs it, which keeps it out of the cold start's init phase (and out of
+  invocations that fail before reaching the database). See benchmarks/bench_lambda_cold_start.py
+  for the init/first-call numbers.
 - The PyMySQL connection should usually be outside the handler function so that 
   it can be resued on future invocations (Lambda retains the execution environment
   for reuse, which is anything outside "def handler"). In this example, the Function
@@ -96,6 +107,19 @@ logger.setLevel(logging.INFO)
 
 logger.info("Function initializing.")
 
+# AWS clients are created once per execution environment, during init, and reused by every
+# invocation on it (creating one per lookup costs tens of milliseconds each time)
+ssm = boto3.client('ssm')
+
+def mysql():
+    """
+    The pymysql module, imported on first use
+
+    Response: the pymysql module (Python caches it after the first import, so later calls are free)
+    """
+    import pymysql
+    return pymysql
+
 def get_parameter(keyname):
     """
     Get a value from Parameter Store
@@ -105,7 +129,6 @@ def get_parameter(keyname):
     Response: value received querying keyname
     """
     logger.info("Asked to get the value of " + keyname) # Potentially remove this, as the keynames will be saved in Cloudwatch Logs
-    ssm = boto3.client('ssm')
     try:
         response = ssm.get_parameter(Name=keyname,WithDecryption=True)
         # logger.info("Got back value " + response['Parameter']['Value']) # Uncomment only for debugging
@@ -115,11 +138,52 @@ def get_parameter(keyname):
         logger.error(e)
         sys.exit()
 
+def get_settings(keybase, keys):
+    """
+    Get the settings for a db/env from Parameter Store in as few calls as possible
+
+    keybase, string = /serverlessops/databases/dbname/env
+    keys, list = the setting names needed
+
+    Response: dict of key -> value
+
+    Prefers one JSON document at keybase holding all the keys (parameter_layout: documents in
+    settings.yml), falling back to one parameter per key at keybase/key.
+    """
+    document = get_parameter(keybase)
+    try:
+        values = json.loads(document)
+    except ValueError:
+        values = None
+    if isinstance(values, dict):
+        missing = [key for key in keys if key not in values]
+        if missing:
+            logger.error("ERROR: Parameter Store document " + keybase + " is missing " + ", ".join(missing))
+            sys.exit()
+        return values
+    return {key: get_parameter(keybase + "/" + key) for key in keys}
+
 def handler(event, context):
     """
     Main handler, entry point for Lambda Function
+
+    Times each step (see metrics.py) and emits the timings as one EMF line per invocation
     """
     logger.info("Lambda handler function invoked")
+    metrics = Metrics(dimensions={"db": event.get('db_name', 'none'), "env": event.get('db_env', 'none'), "job": "mysql_users"})
+    try:
+        with metrics.timer("HandlerTime"):
+            # PROFILE=cpu,memory,stacks (function environment) profiles the invocation, see profiling.py.
+            # Set PROFILE_S3_URI (and grant the function s3:PutObject there) to collect the results.
+            job = reconcile_users if event.get('mode') == 'reconcile' else add_user
+            return run_profiled(job, event, metrics, name="mysql_users-" + str(event.get('db_name')))
+    finally:
+        metrics.flush()
+
+def add_user(event, metrics):
+    """
+    Create a user and grant it rights on the database
+    """
     
     # From below, the handler will build /serverlessops/databases/... path to keys
     logger.info("Setting variables.")
@@ -146,18 +210,16 @@ def handler(event, context):
     logger.info("Building the Parameter Store paths")
     paramstore_base_path = "/serverlessops/databases"
     paramstore_path = paramstore_base_path + "/" + db_name + "/" + db_env
-    paramstore_db_host = paramstore_path + "/db_host"
-    paramstore_db_port = paramstore_path + "/db_port"
-    paramstore_db_user = paramstore_path + "/db_user"
-    paramstore_db_pass = paramstore_path + "/db_pass"
     
     # Get the parameters
     # If you'd like to avoid using Parameter Store, comment out this section and uncomment the subsequent one
-    logger.info("Calling the get_parameter function to retrieve values from Parameter Store")
-    db_host = get_parameter(paramstore_db_host)
-    db_port = get_parameter(paramstore_db_port)
-    db_user = get_parameter(paramstore_db_user)
-    db_pass = get_parameter(paramstore_db_pass)
+    logger.info("Calling the get_settings function to retrieve values from Parameter Store")
+    with metrics.timer("ParameterLookupTime"):
+        db_settings = get_settings(paramstore_path, ["db_host", "db_port", "db_user", "db_pass"])
+    db_host = db_settings["db_host"]
+    db_port = db_settings["db_port"]
+    db_user = db_settings["db_user"]
+    db_pass = db_settings["db_pass"]
 
     # If you'd like to avoid using Parameter Store, uncomment below (and comment out the above)
     # db_host = event['db_host']
@@ -173,8 +235,11 @@ def handler(event, context):
     
     # Connect to MySQL
     logger.info("Beginning MySQL work.")
+    with metrics.timer("DriverImportTime"):
+        pymysql = mysql()
     try:
-        conn = pymysql.connect(host=db_host, port=int(db_port), user=db_user, passwd=db_pass, db=db_name, connect_timeout=5)
+        with metrics.timer("ConnectTime"):
+            conn = pymysql.connect(host=db_host, port=int(db_port), user=db_user, passwd=db_pass, db=db_name, connect_timeout=5)
         logger.info("Connection to RDS MySQL instance succeeded")
     except pymysql.MySQLError as e:
         logger.error("ERROR: Unexpected error: Could not connect to MySQL instance.")
@@ -182,7 +247,7 @@ def handler(event, context):
         sys.exit()
     
     try:
-        with conn.cursor() as cur:
+        with metrics.timer("QueryTime"), conn.cursor() as cur:
             cur.execute(add_user_string)
             cur.execute(grant_user_string)
             cur.execute("FLUSH PRIVILEGES;")
@@ -193,4 +258,58 @@ def handler(event, context):
         logger.error(e)
         sys.exit()
 
-    return "Added user " + update_user + " to database " + db_name + " on host " + db_host
\ No newline at end of file
+    return "Added user " + update_user + " to database " + db_name + " on host " + db_host
+
+def reconcile_users(event, metrics):
+    """
+    Make the host's users and grants match event['users'] (see reconcile.py)
+
+    One snapshot query, an in-memory diff, then only the needed statements in one batch.
+    Response: dict with the statement count (and the statements, passwords masked, for dry runs)
+    """
+    try:
+        db_name = event['db_name']
+        db_env = event['db_env']
+        users = event['users']
+    except Exception as e:
+        logger.error("ERROR: Expected 'db_name', 'db_env' and 'users' for reconcile mode.")
+        logger.error(e)
+        sys.exit()
+
+    with metrics.timer("ParameterLookupTime"):
+        db_settings = get_settings("/serverlessops/databases/" + db_name + "/" + db_env, ["db_host", "db_port", "db_user", "db_pass"])
+
+    with metrics.timer("DriverImportTime"):
+        pymysql = mysql()
+    from pymysql.constants import CLIENT
+    try:
+        with metrics.timer("ConnectTime"):
+            # MULTI_STATEMENTS: the changes go out as one batch, one round trip
+            conn = pymysql.connect(host=db_settings["db_host"], port=int(db_settings["db_port"]), user=db_settings["db_user"],
+                passwd=db_settings["db_pass"], connect_timeout=5, client_flag=CLIENT.MULTI_STATEMENTS)
+    except pymysql.MySQLError as e:
+        logger.error("ERROR: Unexpected error: Could not connect to MySQL instance.")
+        logger.error(e)
+        sys.exit()
+
+    try:
+        with metrics.timer("SnapshotTime"), conn.cursor() as cur:
+            current = reconcile.read_state(cur)
+        statements = reconcile.plan(current, users,
+            drop_unlisted=event.get('drop_unlisted', False),
+            # Never touch the account this function connects as
+            protected=[db_settings["db_user"]])
+        metrics.put("Accounts", len(current), "Count")
+        metrics.put("Statements", len(statements), "Count")
+        if event.get('dry_run'):
+            return {"dry_run": True, "statements": reconcile.describe(statements)}
+        with metrics.timer("QueryTime"):
+            applied = reconcile.apply(conn, statements)
+        logger.info("Reconciled " + str(len(users)) + " users with " + str(applied) + " statements")
+        return {"dry_run": False, "accounts": len(current), "statements": applied}
+    except pymysql.MySQLError as e:
+        logger.error("ERROR: Unexpected error: Reconcile failed.")
+        logger.error(e)
+        sys.exit()
+    finally:
+        conn.close()
@@ -0,0 +1,155 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+"""
+Opt-in profiling for one job (worker.py) or one invocation (the Lambda handler).
+
+Switched on with the PROFILE environment variable, a comma separated list of:
+  cpu     cProfile of the whole job: cpu.prof (load with pstats/snakeviz) and cpu.txt (top functions)
+  memory  tracemalloc: memory.txt (top allocation sites, peak traced memory)
+  stacks  sampled wall-clock stacks of the job's thread every PROFILE_INTERVAL_MS (default 10):
+          stacks.folded, one "frame;frame;frame count" line per stack (flamegraph.pl / speedscope input).
+          Shows time spent waiting (subprocesses, network), which cProfile doesn't attribute well.
+  all     all of the above
+
+For the Fargate task, PROFILE is passed through the StepFunction's container overrides from the job's
+"profile" option ({"job_name": "db_backup", "job_options": {..., "profile": "cpu,stacks"}}).
+
+Artefacts are uploaded to PROFILE_S3_URI (s3://bucket/prefix) if set, otherwise to the location the
+caller passes (the worker uses profiles/ next to the backup), under <name>-<timestamp>/.
+
+With PROFILE unset, run_profiled() is a plain function call: no profiler, no tracer, no thread, and
+the profiler modules aren't even imported (this module is loaded during the Lambda's cold start).
+
+Note: this is a copy of docker/mysql-worker/profiling.py (the Lambda and the container are
+packaged separately), keep the two in sync.
+"""
+
+MODES = ("cpu", "memory", "stacks")
+
+
+def profile_modes():
+    """The profiling modes switched on by PROFILE, empty when profiling is off"""
+    requested = {mode.strip().lower() for mode in os.environ.get('PROFILE', '').split(',') if mode.strip()}
+    if "all" in requested:
+        return set(MODES)
+    return requested & set(MODES)
+
+
+class StackSampler:
+    """Samples one thread's stack on an interval from a background thread"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(frame.f_lineno) + ")")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self):
+        return "".join(stack + " " + str(count) + "\n" for stack, count in self.samples.most_common())
+
+
+def _upload(directory, s3_uri):
+    """Upload every file in directory to s3://bucket/prefix/"""
+    import boto3
+    bucket, _, prefix = s3_uri[len("s3://"):].partition("/")
+    s3 = boto3.client('s3')
+    keys = []
+    for name in sorted(os.listdir(directory)):
+        key = prefix.strip("/") + "/" + name if prefix.strip("/") else name
+        s3.upload_file(os.path.join(directory, name), bucket, key)
+        keys.append(key)
+    return keys
+
+
+def run_profiled(func, *args, name="job", upload_to=None, **kwargs):
+    """
+    Call func(*args, **kwargs), profiled per PROFILE
+
+    name, string = used in the artefact prefix, i.e. "db_backup-classicmodels"
+    upload_to, string = s3://bucket/prefix used when PROFILE_S3_URI isn't set. Without either,
+                        artefacts stay in a local temp directory (printed), handy when running locally.
+
+    The artefacts are written even when func raises or exits (the worker's send_error calls sys.exit).
+    """
+    modes = profile_modes()
+    if not modes:
+        return func(*args, **kwargs)
+
+    import io
+    import pstats
+    import cProfile
+    import tempfile
+    import tracemalloc
+
+    print("Profiling " + name + ": " + ",".join(sorted(modes)))
+    profiler = sampler = None
+    if "memory" in modes:
+        tracemalloc.start()
+    if "stacks" in modes:
+        sampler = StackSampler(threading.get_ident(), int(os.environ.get('PROFILE_INTERVAL_MS', '10')) / 1000)
+        sampler.start()
+    if "cpu" in modes:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    started = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - started
+        directory = tempfile.mkdtemp(prefix="profile-")
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(directory, "cpu.prof"))
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(40)
+            with open(os.path.join(directory, "cpu.txt"), "w") as file:
+                file.write(summary.getvalue())
+        if sampler:
+            sampler.stop()
+            with open(os.path.join(directory, "stacks.folded"), "w") as file:
+                file.write(sampler.folded())
+        if "memory" in modes:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(os.path.join(directory, "memory.txt"), "w") as file:
+                file.write("current " + str(current) + " bytes, peak " + str(peak) + " bytes\n\n")
+                for stat in snapshot.statistics("lineno")[:30]:
+                    file.write(str(stat) + "\n")
+        with open(os.path.join(directory, "summary.txt"), "w") as file:
+            file.write(name + " ran for " + str(round(elapsed, 3)) + " s, profiled: " + ",".join(sorted(modes)) + "\n")
+
+        target = os.environ.get('PROFILE_S3_URI') or upload_to
+        if target:
+            target = target.rstrip("/") + "/" + name + "-" + time.strftime('%Y-%m-%d_%H-%M-%S')
+            try:
+                _upload(directory, target)
+                print("Profile uploaded to " + target)
+            except Exception as e:
+                # Profiling must never fail the job
+                print("Could not upload profile to " + target + ": " + str(e) + ", left in " + directory)
+        else:
+            print("Profile written to " + directory)
@@ -0,0 +1,180 @@
+import hashlib
+
+"""
+Declarative user reconciliation: make a MySQL host's users and grants match a desired list.
+
+    {
+      "mode": "reconcile",
+      "db_name": "classicmodels", "db_env": "demo",
+      "users": [
+        {"user": "app", "host": "%", "password": "...",
+         "grants": [{"on": "classicmodels.*", "privileges": ["SELECT", "INSERT", "UPDATE", "DELETE"]},
+                    {"on": "classicmodels.orders", "privileges": ["ALL"]}]},
+        {"user": "reports", "password": "...", "grants": [{"on": "classicmodels.*", "privileges": ["SELECT"]}]}
+      ],
+      "drop_unlisted": false,
+      "dry_run": false
+    }
+
+How:
+1. One query reads every account (mysql.user) and every grant (information_schema's USER_, SCHEMA_ and
+   TABLE_PRIVILEGES) on the host, so the cost doesn't grow with the number of users.
+2. The desired list is diffed against that snapshot in memory.
+3. Only the differences are sent, as one multi-statement batch: CREATE USER for missing accounts,
+   ALTER USER for changed passwords, GRANT/REVOKE per user and level for privilege differences,
+   and DROP USER for unlisted accounts when drop_unlisted is set.
+
+Notes:
+- MySQL commits account statements (CREATE/ALTER/DROP USER, GRANT, REVOKE) implicitly, one by one, so
+  the batch can't be one transaction. Each statement is atomic, and the batch stops at the first
+  error; re-running converges, since only what's still different is sent again.
+- Passwords can only be compared for mysql_native_password accounts (the hash is unsalted). For other
+  plugins (caching_sha2_password, MySQL 8's default) the password is set on CREATE, and changed only
+  when the entry has "reset_password": true.
+- "ALL" is expanded to the database/table level privilege list; it isn't accepted on *.*, where the
+  list depends on the server version and plugins. GRANT OPTION isn't managed.
+- Accounts in PROTECTED (and the account the Lambda connects as) are never touched.
+"""
+
+PROTECTED = {"root", "rdsadmin", "mysql.sys", "mysql.session", "mysql.infoschema", "mysql.rdsadmin"}
+
+DATABASE_ALL = ["SELECT", "INSERT", "UPDATE", "DELETE", "CREATE", "DROP", "REFERENCES", "INDEX", "ALTER",
+    "CREATE TEMPORARY TABLES", "LOCK TABLES", "EXECUTE", "CREATE VIEW", "SHOW VIEW", "CREATE ROUTINE",
+    "ALTER ROUTINE", "EVENT", "TRIGGER"]
+TABLE_ALL = ["SELECT", "INSERT", "UPDATE", "DELETE", "CREATE", "DROP", "REFERENCES", "INDEX", "ALTER",
+    "CREATE VIEW", "SHOW VIEW", "TRIGGER"]
+
+# Every account and every grant on the host, in one round trip
+SNAPSHOT_QUERY = """
+SELECT 'account', User, Host, plugin, authentication_string FROM mysql.user
+UNION ALL
+SELECT 'grant', GRANTEE, '*.*', PRIVILEGE_TYPE, NULL FROM information_schema.USER_PRIVILEGES
+UNION ALL
+SELECT 'grant', GRANTEE, CONCAT(TABLE_SCHEMA, '.*'), PRIVILEGE_TYPE, NULL FROM information_schema.SCHEMA_PRIVILEGES
+UNION ALL
+SELECT 'grant', GRANTEE, CONCAT(TABLE_SCHEMA, '.', TABLE_NAME), PRIVILEGE_TYPE, NULL FROM information_schema.TABLE_PRIVILEGES
+"""
+
+
+def native_password_hash(password):
+    """mysql_native_password's stored hash: * + hex(SHA1(SHA1(password)))"""
+    return "*" + hashlib.sha1(hashlib.sha1(password.encode()).digest()).hexdigest().upper()
+
+
+def parse_grantee(grantee):
+    """'user'@'host' (information_schema's GRANTEE) -> (user, host)"""
+    user, _, host = grantee.rpartition("@")
+    return user.strip("'").replace("''", "'"), host.strip("'").replace("''", "'")
+
+
+def quote_level(level):
+    """classicmodels.* -> `classicmodels`.*"""
+    if level == "*.*":
+        return level
+    schema, _, table = level.partition(".")
+    quote = lambda name: name if name == "*" else "`" + name.replace("`", "``") + "`"
+    return quote(schema) + "." + quote(table or "*")
+
+
+def desired_grants(entry):
+    """The (level, privilege) pairs an entry asks for"""
+    grants = set()
+    for grant in entry.get("grants", []):
+        level = grant["on"] if "." in grant["on"] else grant["on"] + ".*"
+        privileges = [privilege.upper().strip() for privilege in grant["privileges"]]
+        if "ALL" in privileges or "ALL PRIVILEGES" in privileges:
+            if level == "*.*":
+                raise ValueError("ALL on *.* isn't supported, list the privileges for " + entry["user"])
+            privileges = DATABASE_ALL if level.endswith(".*") else TABLE_ALL
+        grants.update((level, privilege) for privilege in privileges)
+    return grants
+
+
+def read_state(cursor):
+    """
+    Snapshot the host's accounts and grants
+
+    Response: dict of (user, host) -> {"plugin", "auth", "grants": set of (level, privilege)}
+    """
+    cursor.execute(SNAPSHOT_QUERY)
+    accounts = {}
+    grants = []
+    for kind, name, level_or_host, value, auth in cursor.fetchall():
+        if kind == "account":
+            accounts[(name, level_or_host)] = {"plugin": value, "auth": auth, "grants": set()}
+        elif value != "USAGE":
+            grants.append((parse_grantee(name), level_or_host, value))
+    for account, level, privilege in grants:
+        if account in accounts:
+            accounts[account]["grants"].add((level, privilege))
+    return accounts
+
+
+def plan(current, users, drop_unlisted = False, protected = ()):
+    """
+    The statements that take current (read_state) to users (the desired list)
+
+    Response: list of (sql, args) in the order to run them
+    """
+    protected = set(PROTECTED) | set(protected)
+    statements = []
+    wanted = set()
+    for entry in users:
+        account = (entry["user"], entry.get("host", "%"))
+        if account[0] in protected:
+            raise ValueError("Refusing to manage protected account " + account[0])
+        wanted.add(account)
+        grants = desired_grants(entry)
+        existing = current.get(account)
+        if existing is None:
+            statements.append(("CREATE USER %s@%s IDENTIFIED BY %s", account + (entry["password"],)))
+            have = set()
+        else:
+            have = existing["grants"]
+            if "password" in entry:
+                if existing["plugin"] == "mysql_native_password":
+                    changed = existing["auth"] != native_password_hash(entry["password"])
+                else:
+                    changed = bool(entry.get("reset_password"))
+                if changed:
+                    statements.append(("ALTER USER %s@%s IDENTIFIED BY %s", account + (entry["password"],)))
+
+        for verb, pairs, direction in (("REVOKE", have - grants, "FROM"), ("GRANT", grants - have, "TO")):
+            by_level = {}
+            for level, privilege in pairs:
+                by_level.setdefault(level, []).append(privilege)
+            for level in sorted(by_level):
+                # The statement is a %-format template (mogrify, describe), a wildcard level like app_%.* needs its % doubled
+                clause = (verb + " " + ", ".join(sorted(by_level[level])) + " ON " + quote_level(level)).replace("%", "%%")
+                statements.append((clause + " " + direction + " %s@%s", account))
+
+    if drop_unlisted:
+        for account in sorted(set(current) - wanted):
+            if account[0] not in protected and not account[0].startswith("mysql."):
+                statements.append(("DROP USER %s@%s", account))
+    return statements
+
+
+def describe(statements):
+    """Readable statements for logs and dry runs, passwords masked"""
+    described = []
+    for sql, args in statements:
+        sql = sql.replace("IDENTIFIED BY %s", "IDENTIFIED BY '***'")
+        described.append(sql % tuple("'" + arg + "'" for arg in args[:sql.count("%s")]))
+    return described
+
+
+def apply(connection, statements):
+    """
+    Send the statements as one multi-statement batch
+
+    The connection needs CLIENT.MULTI_STATEMENTS (see app.py). Response: number of statements run
+    """
+    if not statements:
+        return 0
+    with connection.cursor() as cursor:
+        batch = ";\n".join(cursor.mogrify(sql, args) for sql, args in statements)
+        cursor.execute(batch)
+        while cursor.nextset():
+            pass
+    return len(statements)
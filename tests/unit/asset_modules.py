@@ -0,0 +1,28 @@
+import importlib.util
+import os
+import sys
+
+# Lambda and Docker asset folders (lambda/mysql-users, docker/mysql-worker, ...) aren't Python
+# packages, so tests load their modules by path instead of importing them.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_asset_module(relative_path, module_name):
+    """
+    Load a module from an asset folder under a unique name
+
+    relative_path, string = path from the repo root, i.e. "lambda/job-submit/app.py"
+    module_name, string = name to register it under, i.e. "job_submit_app"
+    """
+    # boto3 clients created at import time need a region, even though tests never call AWS
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    path = os.path.join(REPO_ROOT, relative_path)
+    # Let the module import its siblings (worker.py importing its helper modules, etc.)
+    asset_dir = os.path.dirname(path)
+    if asset_dir not in sys.path:
+        sys.path.insert(0, asset_dir)
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,41 @@
+import os
+
+from aws_serverless_ops import asset_cache
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, "w") as file:
+        file.write(text)
+
+
+def test_input_hash_follows_sources_not_caches(tmp_path, monkeypatch):
+    monkeypatch.setattr(asset_cache, "_hashes", {})
+    write(str(tmp_path / "app.py"), "def handler(event, context): pass\n")
+    first = asset_cache.input_hash(str(tmp_path), extra = ["python3.9"])
+    write(str(tmp_path / "__pycache__" / "app.cpython-311.pyc"), "bytecode")
+    write(str(tmp_path / ".pytest_cache" / "v" / "lastfailed"), "{}")
+    monkeypatch.setattr(asset_cache, "_hashes", {})
+    assert asset_cache.input_hash(str(tmp_path), extra = ["python3.9"]) == first
+    assert asset_cache.input_hash(str(tmp_path), extra = ["python3.12"]) != first
+    write(str(tmp_path / "requirements.txt"), "PyMySQL==1.1.1\n")
+    monkeypatch.setattr(asset_cache, "_hashes", {})
+    assert asset_cache.input_hash(str(tmp_path), extra = ["python3.9"]) != first
+
+
+def test_local_bundling_reuses_the_cached_build(tmp_path, monkeypatch):
+    source, cache = tmp_path / "function", tmp_path / "cache"
+    write(str(source / "app.py"), "def handler(event, context): pass\n")
+    write(str(source / "__pycache__" / "app.pyc"), "bytecode")
+    monkeypatch.setattr(asset_cache, "CACHE_DIR", str(cache))
+    monkeypatch.setattr(asset_cache, "timings", [])
+    bundler = asset_cache.LocalPythonBundling(str(source), "3.9", "abc123")
+    builds = []
+    build = bundler.build
+    monkeypatch.setattr(bundler, "build", lambda target: builds.append(target) or build(target))
+
+    for output in ("out1", "out2"):
+        assert bundler.try_bundle(str(tmp_path / output), None)
+        assert sorted(os.listdir(str(tmp_path / output))) == ["app.py"]
+    assert len(builds) == 1
+    assert [detail.split()[0:2] for label, seconds, detail in asset_cache.timings] == [["built", "abc123"], ["cache", "hit"]]
@@ -0,0 +1,37 @@
+from tests.unit.asset_modules import load_asset_module
+
+catalog = load_asset_module("docker/mysql-worker/catalog.py", "backup_catalog")
+
+
+def backup(created_at, size_bytes, db_env = "demo", status = catalog.STATUS_COMPLETE):
+    return catalog.make_entry("classicmodels", db_env, "bucket", ["backups/classicmodels-" + str(created_at) + ".tgz"],
+        size_bytes, "sha", "tar+gzip", binlog_file = "mysql-bin.000001", binlog_position = created_at,
+        created_at = created_at, status = status)
+
+
+def filled_catalog():
+    store = catalog.SqliteCatalog(":memory:")
+    for created_at, size_bytes in [(100, 10), (200, 20), (300, 30)]:
+        store.put(backup(created_at, size_bytes))
+    store.put(backup(400, 40, status = "failed"))
+    store.put(backup(500, 50, db_env = "prod"))
+    return store
+
+
+def test_latest_skips_failed_and_other_envs():
+    latest = filled_catalog().latest("classicmodels", "demo")
+    assert latest["created_at"] == 300
+    assert latest["object_keys"] == ["backups/classicmodels-300.tgz"]
+    assert latest["binlog_position"] == 300
+
+
+def test_point_in_time():
+    store = filled_catalog()
+    assert store.latest("classicmodels", "demo", before = 250)["created_at"] == 200
+    assert store.latest("classicmodels", "demo", before = 50) is None
+
+
+def test_size_history():
+    store = filled_catalog()
+    assert store.size_history("classicmodels", "demo") == [(100, 10), (200, 20), (300, 30)]
+    assert store.size_history("classicmodels", "demo", since = 150, until = 250) == [(200, 20)]
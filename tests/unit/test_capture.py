@@ -0,0 +1,59 @@
+import sys
+
+from tests.unit.asset_modules import load_asset_module
+
+capture = load_asset_module("docker/mysql-worker/capture.py", "worker_capture")
+
+
+def test_failure_payloads_fit_send_task_failure():
+    error = capture.truncate("x" * 1000, capture.ERROR_LIMIT)
+    cause = capture.truncate("a" * 40000 + "the real error", capture.CAUSE_LIMIT, keep_end = True)
+    assert len(error) == 256 and error.endswith(capture.TRUNCATED)
+    assert len(cause) == 32768 and cause.endswith("the real error")
+    assert capture.truncate("short", 256) == "short"
+
+
+def test_tail_keeps_only_the_last_lines():
+    tail = capture.Tail(lines = 3)
+    for number in range(10):
+        tail.add("line " + str(number) + "\n")
+    assert tail.text() == "[last 3 of 10 lines]\nline 7\nline 8\nline 9"
+
+
+def test_limiter_collapses_repeats_and_caps_rate():
+    written = []
+    now = [0.0]
+    log = capture.LogLimiter(lines_per_second = 3, write = written.append, clock = lambda: now[0])
+    for number in range(1000):
+        log.line("Warning: row " + str(number) + " truncated")
+    for name in "abcde":
+        log.line("table " + name + " done")
+    now[0] = 5.0
+    log.line("finished")
+    log.close()
+    assert written == ["Warning: row 0 truncated", "[999 more lines like the previous one]", "table a done",
+        "[4 lines suppressed]", "finished"]
+    assert log.suppressed_total == 4
+
+
+def test_run_captured_bounds_stderr():
+    seen = []
+    script = "import sys\nfor n in range(5000): print('err', n, file=sys.stderr)\nprint('ARTIFACT /tmp/x.tgz')\nsys.exit(2)"
+    returncode, tail, log = capture.run_captured([sys.executable, "-c", script], on_stdout = seen.append,
+        tail = capture.Tail(lines = 5), log = capture.LogLimiter(write = lambda line: None))
+    assert returncode == 2
+    assert seen == ["ARTIFACT /tmp/x.tgz\n"]
+    assert tail.text().splitlines()[-1] == "err 4999" and len(tail.lines) == 5
+
+
+def test_run_captured_reads_stdout_to_the_end():
+    # db_backup.sh's markers come on stdout while stderr stays quiet (or has closed), and the last
+    # ones (ARTIFACT) right before it exits; a reader waiting on stderr between stdout lines dropped them
+    seen = []
+    script = ("import sys, time\nprint('BINLOG mysql-bin.000001 4', flush=True)\nprint('warming up', file=sys.stderr, flush=True)\n"
+        "sys.stderr.close()\ntime.sleep(0.2)\nfor n in range(200): print('TABLE_ARTIFACT data /tmp/t' + str(n))\nprint('ARTIFACT /tmp/x.tgz')")
+    returncode, tail, log = capture.run_captured([sys.executable, "-c", script], on_stdout = seen.append,
+        log = capture.LogLimiter(write = lambda line: None))
+    assert returncode == 0
+    assert len(seen) == 202 and seen[0].startswith("BINLOG") and seen[-1] == "ARTIFACT /tmp/x.tgz\n"
+    assert tail.text() == "warming up"
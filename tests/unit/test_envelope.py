@@ -0,0 +1,111 @@
+import io
+import json
+import os
+
+import pytest
+
+from tests.unit.asset_modules import load_asset_module
+
+envelope = load_asset_module("docker/mysql-worker/envelope.py", "worker_envelope")
+
+
+class LocalKms:
+    """Wraps data keys by reversing them, enough to check what gets stored and unwrapped"""
+
+    def generate_data_key(self, KeyId, KeySpec):
+        key = os.urandom(32)
+        return {"Plaintext": key, "CiphertextBlob": key[::-1], "KeyId": KeyId}
+
+    def decrypt(self, CiphertextBlob):
+        return {"Plaintext": CiphertextBlob[::-1]}
+
+
+def backup(data, kms_key_id = "alias/backups", **kwargs):
+    s3 = envelope.LocalS3()
+    sums = envelope.stream_to_s3(io.BytesIO(data), s3, "bucket", "db.sql.gz", kms = LocalKms(), kms_key_id = kms_key_id,
+        threads = 3, part_size = 1000, chunk_size = 64, **kwargs)
+    return s3, sums
+
+
+def restore(s3, sums = None, stored = None):
+    if sums is None:
+        sums = json.loads(s3.objects[("bucket", "db.sql.gz" + envelope.SUMS_SUFFIX)])
+    body = io.BytesIO(s3.objects[("bucket", "db.sql.gz")] if stored is None else stored)
+    out = io.BytesIO()
+    envelope.restore_stream(body, sums, out.write, kms = LocalKms(), threads = 3)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("size", [0, 64, 1000, 4321])
+def test_encrypted_round_trip(size):
+    data = os.urandom(size)
+    s3, sums = backup(data)
+    stored = s3.objects[("bucket", "db.sql.gz")]
+    assert data not in stored or size == 0
+    assert sums["encryption"]["kms_key_id"] == "alias/backups"
+    assert sums["size"] == len(stored) and len(sums["parts"]) == max(1, -(-len(stored) // 1000))
+    assert restore(s3) == data
+
+
+def test_checksum_only_round_trip():
+    data = os.urandom(2500)
+    s3, sums = backup(data, kms_key_id = None)
+    assert s3.objects[("bucket", "db.sql.gz")] == data and sums["encryption"] is None
+    assert restore(s3) == data
+
+
+def test_restore_rejects_a_changed_part_before_using_it():
+    s3, sums = backup(os.urandom(4321))
+    stored = bytearray(s3.objects[("bucket", "db.sql.gz")])
+    stored[2500] ^= 1
+    with pytest.raises(envelope.ChecksumError, match = "Part 3"):
+        restore(s3, stored = bytes(stored))
+    with pytest.raises(envelope.ChecksumError, match = "ended"):
+        restore(s3, stored = s3.objects[("bucket", "db.sql.gz")][:2000])
+
+
+def test_chunks_are_bound_to_their_position():
+    # Even with sums that match (say, both rewritten), dropping the last chunk fails the GCM check
+    s3, sums = backup(os.urandom(640))
+    record = 64 + envelope.TAG_SIZE
+    truncated = s3.objects[("bucket", "db.sql.gz")][:-record]
+    forged = envelope.LocalS3()
+    forged_sums = envelope.stream_to_s3(io.BytesIO(truncated), forged, "bucket", "x", part_size = 1000, chunk_size = 64)
+    forged_sums["encryption"] = sums["encryption"]
+    with pytest.raises(envelope.ChecksumError, match = "authentication"):
+        restore(s3, sums = forged_sums, stored = truncated)
+
+
+def test_failed_source_aborts_the_upload():
+    with pytest.raises(RuntimeError, match = "aborted"):
+        backup(os.urandom(500), ready = lambda: False)
+
+
+def test_parts_grow_so_big_dumps_fit_in_s3s_part_limit():
+    # 16MB parts alone stop at ~156GB; growing, S3's 10,000 parts cover more than its 5TB object limit
+    assert envelope.upload_capacity(growth = 0) < 160 * 1024 ** 3
+    assert envelope.upload_capacity() > 5 * 1024 ** 4
+
+    data = os.urandom(9000)
+    s3 = envelope.LocalS3()
+    upload = envelope.MultipartUpload(s3, "bucket", "big", part_size = 1000, threads = 2, growth = 2, max_parts = 5)
+    upload.write(data)
+    sums = upload.close()
+    # 1000, 1000, 2000, 2000, 3000 (the rest): fixed 1000 byte parts would have needed 9
+    assert len(sums["parts"]) == 5 and s3.objects[("bucket", "big")] == data
+    out = io.BytesIO()
+    envelope.restore_stream(io.BytesIO(s3.objects[("bucket", "big")]), sums, out.write)
+    assert out.getvalue() == data
+
+    # Under a 2500 byte cap, a 1000 byte part waits while the next one goes, the 2000 byte parts go one at a time
+    capped = envelope.MultipartUpload(envelope.LocalS3(), "bucket", "capped", part_size = 1000, threads = 2, growth = 2, max_parts = 5,
+        max_in_flight = 2500)
+    windows = []
+    send = capped._send
+    capped._send = lambda body: (send(body), windows.append((len(body), len(capped.pending))))
+    capped.write(data)
+    assert windows[:4] == [(1000, 1), (1000, 1), (2000, 0), (2000, 0)]
+
+    full = envelope.MultipartUpload(envelope.LocalS3(), "bucket", "too big", part_size = 1000, threads = 2, growth = 2, max_parts = 5)
+    with pytest.raises(RuntimeError, match = "past S3.s 5 parts"):
+        full.write(os.urandom(20000))
@@ -0,0 +1,55 @@
+import csv
+import gzip
+import os
+import tempfile
+
+import pytest
+
+from tests.unit.asset_modules import load_asset_module
+
+export = load_asset_module("docker/mysql-worker/export.py", "worker_export")
+
+
+def test_ranges_cover_every_key_once():
+    ranges = export.plan_ranges(1, 1000, 1000, 300)
+    assert ranges == [(1, 251), (251, 501), (501, 751), (751, 1001)]
+    assert export.plan_ranges(5, 5, 1, 300) == [(5, 6)]
+    # A sparse key never makes more ranges than keys
+    assert len(export.plan_ranges(1, 3, 1000000, 10)) == 3
+    assert export.plan_ranges(None, None, 0, 10) == []
+
+
+def test_only_single_integer_keys_are_split():
+    column = lambda name, data_type, key: {"name": name, "data_type": data_type, "key": key}
+    assert export.split_key([column("id", "bigint", "PRI"), column("name", "varchar", "")]) == "id"
+    assert export.split_key([column("code", "varchar", "PRI")]) is None
+    assert export.split_key([column("a", "int", "PRI"), column("b", "int", "PRI")]) is None
+
+
+def test_csv_parts_mark_nulls_and_hex_binary():
+    columns = [{"name": "id"}, {"name": "note"}, {"name": "blob"}]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "part" + export.CsvPartWriter.extension)
+        writer = export.CsvPartWriter(path, columns)
+        writer.write([(1, None, b"\x00\xff"), (2, "", None)])
+        writer.close()
+        with gzip.open(path, "rt", newline = "") as file:
+            rows = list(csv.reader(file))
+    assert rows == [["id", "note", "blob"], ["1", "\\N", "00ff"], ["2", "", "\\N"]]
+
+
+def test_parquet_parts_use_mysql_types():
+    pq = pytest.importorskip("pyarrow.parquet")
+    columns = [
+        {"name": "id", "data_type": "int", "column_type": "int unsigned", "key": "PRI", "precision": 10, "scale": 0},
+        {"name": "price", "data_type": "decimal", "column_type": "decimal(10,2)", "key": "", "precision": 10, "scale": 2},
+    ]
+    from decimal import Decimal
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "part.parquet")
+        writer = export.ParquetPartWriter(path, columns)
+        writer.write([(1, Decimal("9.99")), (2, None)])
+        writer.close()
+        table = pq.read_table(path)
+    assert str(table.schema.field("id").type) == "uint64"
+    assert table.column("price").to_pylist() == [Decimal("9.99"), None]
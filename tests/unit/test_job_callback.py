@@ -0,0 +1,92 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from tests.unit.asset_modules import load_asset_module
+
+app = load_asset_module("lambda/job-callback/app.py", "job_callback_app")
+
+EVENT = {
+    "status": "SUCCEEDED",
+    "execution_arn": "arn:aws:states:us-east-1:123456789012:execution:MySqlWorker:db_backup-classicmodels-demo-1",
+    "execution_input": {"job_name": "db_backup", "job_options": {"db_name": "classicmodels", "db_env": "demo", "db_pass": "secret"},
+        "callback": {"type": "memory"}},
+    "result": {"status": "job complete", "message": "Database classicmodels backed up"},
+}
+
+
+def test_deliveries_are_signed_and_leave_credentials_out():
+    memory = app.MemoryTransport()
+    message = app.build_message(EVENT, now = 1700000000)
+    outcome = app.deliver({"type": "memory"}, message, "key", {"memory": memory})
+    assert outcome["delivered"] and outcome["attempts"] == 1
+    delivery = memory.deliveries[0]
+    body = json.loads(delivery["body"])
+    assert body["db_name"] == "classicmodels" and body["result"]["status"] == "job complete"
+    assert "secret" not in delivery["body"].decode()
+    assert app.verify("key", delivery["body"], delivery["signature"])
+    assert not app.verify("other key", delivery["body"], delivery["signature"])
+    assert not app.verify("key", delivery["body"] + b" ", delivery["signature"])
+    assert not app.verify("key", delivery["body"], delivery["signature"], now = 1)
+    # The same execution and status always get the same id, so receivers can drop repeats
+    assert delivery["delivery_id"] == app.build_message(EVENT)["delivery_id"]
+
+
+def test_retries_back_off_then_give_up():
+    sleeps = []
+    flaky = app.MemoryTransport(fail_times = 2)
+    outcome = app.deliver({"type": "memory"}, app.build_message(EVENT), "key", {"memory": flaky}, sleep = sleeps.append)
+    assert outcome["delivered"] and outcome["attempts"] == 3 and len(sleeps) == 2
+    assert sleeps[0] <= 1.0 and sleeps[1] <= 2.0
+
+    down = app.MemoryTransport(fail_times = 10)
+    outcome = app.deliver({"type": "memory"}, app.build_message(EVENT), "key", {"memory": down}, max_attempts = 4, sleep = lambda s: None)
+    assert not outcome["delivered"] and down.attempts == 4
+
+    rejected = app.MemoryTransport(fail_times = 10, retryable = False)
+    app.deliver({"type": "memory"}, app.build_message(EVENT), "key", {"memory": rejected}, sleep = lambda s: None)
+    assert rejected.attempts == 1
+
+
+def test_callbacks_are_checked_before_sending():
+    transports = {"webhook": app.MemoryTransport(), "memory": app.MemoryTransport()}
+    message = app.build_message(EVENT)
+    with pytest.raises(app.DeliveryError):
+        app.deliver({"type": "webhook", "url": "http://ops.example.com/hook"}, message, "key", transports)
+    with pytest.raises(app.DeliveryError):
+        app.deliver({"type": "webhook", "url": "https://elsewhere.net/hook"}, message, "key", transports, allowed_hosts = [".example.com"])
+    with pytest.raises(app.DeliveryError):
+        # No allowed_hosts: no webhooks at all
+        app.deliver({"type": "webhook", "url": "https://ops.example.com/hook"}, message, "key", transports)
+    with pytest.raises(app.DeliveryError):
+        app.deliver({"type": "ftp"}, message, "key", transports)
+    assert app.deliver({"type": "webhook", "url": "https://ops.example.com/hook"}, message, "key", transports,
+        allowed_hosts = [".example.com"])["delivered"]
+    assert app.handler({**EVENT, "execution_input": {"job_name": "db_backup"}}, None) == {"delivered": False, "error": "no callback"}
+
+
+def test_webhook_redirects_are_not_followed():
+    hits = []
+
+    class Redirecting(BaseHTTPRequestHandler):
+        def do_POST(self):
+            hits.append(self.path)
+            self.send_response(302)
+            self.send_header("Location", "/elsewhere")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Redirecting)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    try:
+        outcome = app.deliver({"type": "webhook", "url": "http://127.0.0.1:" + str(server.server_port) + "/hook"},
+            app.build_message(EVENT), "key", {"webhook": app.WebhookTransport()}, sleep = lambda s: None,
+            allowed_hosts = ["127.0.0.1"], allow_http = True)
+    finally:
+        server.shutdown()
+    assert not outcome["delivered"] and outcome["attempts"] == 1 and "302" in outcome["error"]
+    assert hits == ["/hook"]
@@ -0,0 +1,175 @@
+import json
+
+from botocore.exceptions import ClientError
+
+from tests.unit.asset_modules import load_asset_module
+
+job_submit = load_asset_module("lambda/job-submit/app.py", "job_submit_app")
+
+STATE_MACHINE_ARN = "arn:aws:states:us-east-1:123456789012:stateMachine:MySqlWorker"
+NOW = 1_700_000_000.0
+JOB = {"job_name": "db_backup", "job_options": {"db_name": "classicmodels", "db_env": "demo"}}
+
+
+class ExecutionAlreadyExists(Exception):
+    pass
+
+
+class ExecutionDoesNotExist(Exception):
+    pass
+
+
+class FakeStepFunctions:
+    """Just enough of the StepFunctions client for the submit logic"""
+
+    class exceptions:
+        ExecutionAlreadyExists = ExecutionAlreadyExists
+        ExecutionDoesNotExist = ExecutionDoesNotExist
+
+    def __init__(self, executions=None):
+        self.executions = executions or []
+        self.started = []
+        self.described = []
+
+    def start_execution(self, stateMachineArn, name, input):
+        arn = stateMachineArn.replace(":stateMachine:", ":execution:") + ":" + name
+        for execution in self.executions:
+            if execution["executionArn"] == arn:
+                raise ExecutionAlreadyExists(name)
+        self.started.append(name)
+        self.executions.append({"executionArn": arn, "name": name, "status": "RUNNING", "startDate": NOW})
+        return {"executionArn": arn, "startDate": NOW}
+
+    def describe_execution(self, executionArn):
+        self.described.append(executionArn.rsplit(":", 1)[1])
+        for execution in self.executions:
+            if execution["executionArn"] == executionArn:
+                return execution
+        raise ExecutionDoesNotExist(executionArn)
+
+
+def execution(name, status, start_date, stop_date=None):
+    return {
+        "executionArn": STATE_MACHINE_ARN.replace(":stateMachine:", ":execution:") + ":" + name,
+        "name": name,
+        "status": status,
+        "startDate": start_date,
+        "stopDate": stop_date,
+    }
+
+
+def key_for(windows_back):
+    return job_submit.job_key("db_backup", "classicmodels", "demo", job_submit.window_index(NOW, 900) - windows_back)
+
+
+def submit(client, now=NOW, job=JOB, freshness_seconds=3600):
+    return job_submit.submit(client, STATE_MACHINE_ARN, job, now, window_seconds=900, freshness_seconds=freshness_seconds)
+
+
+def test_duplicate_submissions_share_one_execution():
+    client = FakeStepFunctions()
+    first = submit(client)
+    second = submit(client, now=NOW + 5)
+    assert first["coalesced"] is False
+    assert second["coalesced"] is True
+    assert second["executionArn"] == first["executionArn"]
+    assert len(client.started) == 1
+
+
+def test_running_execution_from_an_earlier_window_is_reused():
+    running = execution(key_for(1) + "-0", "RUNNING", NOW - 1200)
+    client = FakeStepFunctions([running])
+    assert submit(client, freshness_seconds=0)["executionArn"] == running["executionArn"]
+    assert client.started == []
+
+
+def test_recent_success_is_returned_stale_success_is_not():
+    done = execution(key_for(3) + "-0", "SUCCEEDED", NOW - 3000, NOW - 2400)
+    client = FakeStepFunctions([done])
+    assert submit(client)["executionArn"] == done["executionArn"]
+    assert submit(client, freshness_seconds=300)["coalesced"] is False
+
+
+def test_later_attempts_of_an_earlier_window_are_found_by_name():
+    failed = execution(key_for(1) + "-0", "FAILED", NOW - 1500, NOW - 1400)
+    retried = execution(key_for(1) + "-1", "RUNNING", NOW - 1300)
+    client = FakeStepFunctions([failed, retried])
+    assert submit(client)["executionArn"] == retried["executionArn"]
+    assert client.started == []
+
+
+def test_new_job_describes_one_name_per_window_looked_back():
+    client = FakeStepFunctions([execution(key_for(5) + "-0", "RUNNING", NOW - 5000)])
+    submit(client)
+    # Only the windows freshness spans are looked at, the first unused name ends each
+    assert client.described == [key_for(back) + "-0" for back in range(1, 5)]
+    assert client.started == [key_for(0) + "-0"]
+
+
+def test_other_databases_and_envs_do_not_coalesce():
+    client = FakeStepFunctions()
+    submit(client)
+    submit(client, job={"job_name": "db_backup", "job_options": {"db_name": "classicmodels", "db_env": "demo_2"}})
+    submit(client, job={"job_name": "db_backup", "job_options": {"db_name": "classicmodels2", "db_env": "demo"}})
+    submit(client, job={"job_name": "db_backup", "job_options": {"db_name": "classicmodels", "db_env": "demo-2"}})
+    submit(client, job={"job_name": "db_backup", "job_options": {"db_name": "classicmodels", "db_env": "demo.2"}})
+    # "demo" is a prefix of "demo-2" once escaped too, names only match on the whole job prefix
+    submit(client, job={"job_name": "db_backup", "job_options": {"db_name": "classicmodels", "db_env": "dem"}})
+    assert len(client.started) == 6
+
+
+def test_failed_execution_in_same_window_bumps_attempt():
+    key = job_submit.job_key("db_backup", "classicmodels", "demo", job_submit.window_index(NOW, 900))
+    failed = execution(key + "-0", "FAILED", NOW - 60, NOW - 30)
+    client = FakeStepFunctions([failed])
+    result = submit(client)
+    assert result["coalesced"] is False
+    assert client.started == [key + "-1"]
+
+
+def test_long_keys_fit_in_an_execution_name():
+    key = job_submit.job_key("db_backup", "x" * 100, "demo", 12345)
+    assert len(key) <= job_submit.MAX_EXECUTION_NAME - 3
+    assert key != job_submit.job_key("db_backup", "x" * 99 + "y", "demo", 12345)
+
+
+def test_long_names_still_coalesce():
+    job = {"job_name": "db_backup", "job_options": {"db_name": "x" * 100, "db_env": "production.eu-west-1"}}
+    client = FakeStepFunctions()
+    first = submit(client, job=job)
+    later = submit(client, now=NOW + 1800, job=job)
+    assert later["coalesced"] is True and later["executionArn"] == first["executionArn"]
+    assert all(len(name) <= job_submit.MAX_EXECUTION_NAME for name in client.started)
+    assert len(client.started) == 1
+
+
+def test_handler_rejects_bad_body():
+    response = job_submit.handler({"body": "not json"}, None)
+    assert response["statusCode"] == 400
+    assert "job_name" in json.loads(response["body"])["message"]
+    response = job_submit.handler({"body": json.dumps({"job_name": "db_backup", "job_options": ["classicmodels"]})}, None)
+    assert response["statusCode"] == 400
+    assert "job_options" in json.loads(response["body"])["message"]
+
+
+def test_null_job_options_are_no_options():
+    client = FakeStepFunctions()
+    submit(client, job={"job_name": "db_backup", "job_options": None})
+    assert client.started == [job_submit.job_key("db_backup", None, None, job_submit.window_index(NOW, 900)) + "-0"]
+
+
+def test_handler_answers_429_or_503_when_it_cannot_submit(monkeypatch):
+    monkeypatch.setenv("STATE_MACHINE_ARN", STATE_MACHINE_ARN)
+    key = job_submit.job_key("db_backup", "classicmodels", "demo", job_submit.window_index(NOW, 900))
+    failed = [execution(key + "-" + str(attempt), "FAILED", NOW - 60, NOW - 30) for attempt in range(job_submit.MAX_ATTEMPTS)]
+    monkeypatch.setattr(job_submit, "sfn", FakeStepFunctions(failed))
+    monkeypatch.setattr(job_submit.time, "time", lambda: NOW)
+    response = job_submit.handler({"body": json.dumps(JOB)}, None)
+    assert response["statusCode"] == 429 and int(response["headers"]["Retry-After"]) > 0
+
+    class Throttled(FakeStepFunctions):
+        def describe_execution(self, executionArn):
+            raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "DescribeExecution")
+    monkeypatch.setattr(job_submit, "sfn", Throttled())
+    response = job_submit.handler({"body": json.dumps(JOB)}, None)
+    assert response["statusCode"] == 503 and "Rate exceeded" in json.loads(response["body"])["message"]
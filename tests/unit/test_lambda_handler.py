@@ -0,0 +1,17 @@
+import pytest
+
+from tests.unit.asset_modules import load_asset_module
+
+lambda_handler = load_asset_module("docker/mysql-worker/lambda_handler.py", "worker_lambda_handler")
+
+
+def test_job_options_win_over_parameter_store():
+    options = {"db_name": "classicmodels", "db_env": "demo", "db_host": "db.local", "db_port": "3306",
+        "db_user": "admin", "db_pass": "secret", "s3_bucket": "backups", "s3_path": "mysql", "profile": ""}
+    assert lambda_handler.job_settings(options) == {"db_host": "db.local", "db_port": "3306", "db_user": "admin",
+        "db_pass": "secret", "s3_bucket": "backups", "s3_path": "mysql"}
+
+
+def test_unknown_action_is_an_error():
+    with pytest.raises(ValueError):
+        lambda_handler.handler({"action": "restore", "job_options": {}}, None)
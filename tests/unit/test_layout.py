@@ -0,0 +1,41 @@
+import collections
+
+import pytest
+
+from tests.unit.asset_modules import load_asset_module
+
+layout = load_asset_module("docker/mysql-worker/layout.py", "worker_layout")
+envelope = load_asset_module("docker/mysql-worker/envelope.py", "worker_envelope")
+
+
+def test_flat_keeps_the_original_keys_and_hashed_shards_them():
+    assert layout.KeyLayout().physical("/backups/", "classicmodels.sql.gz") == "backups/classicmodels.sql.gz"
+    hashed = layout.KeyLayout("hashed", 3)
+    key = hashed.physical("backups", "classicmodels.sql.gz")
+    shard, name = key.split("/")[1], key.split("/", 2)[2]
+    assert len(shard) == 3 and name == "classicmodels.sql.gz"
+    # Stable, so a key can always be recomputed from its name
+    assert hashed.physical("backups", "classicmodels.sql.gz") == key
+    with pytest.raises(ValueError):
+        layout.KeyLayout("random")
+
+
+def test_hashed_spreads_names_evenly_over_prefixes():
+    hashed = layout.KeyLayout("hashed", 2)
+    names = ["exports/db-2024-01-01/orders/part-%05d.csv.gz" % number for number in range(25600)]
+    counts = collections.Counter(hashed.physical("backups", name).split("/")[1] for name in names)
+    assert len(counts) == 256
+    assert max(counts.values()) < 2 * 100 and min(counts.values()) > 100 / 2
+
+
+def test_manifest_maps_names_to_keys_for_restores():
+    s3 = envelope.LocalS3()
+    manifest = layout.Manifest(layout.KeyLayout("hashed"), "backups", "classicmodels.sql.gz.enc")
+    key = manifest.place("classicmodels.sql.gz.enc")
+    manifest.add("classicmodels.sql.gz.enc.sums.json", key + ".sums.json")
+    manifest_key = manifest.write(s3, "bucket")
+    # The manifest itself sits at a place that can be found without the shard
+    assert manifest_key == "backups/manifests/classicmodels.sql.gz.enc.layout.json"
+    assert layout.resolve(s3, "bucket", manifest_key) == key
+    assert layout.resolve(s3, "bucket", manifest_key, "classicmodels.sql.gz.enc.sums.json") == key + ".sums.json"
+    assert layout.resolve(s3, "bucket", key) == key
@@ -0,0 +1,34 @@
+import os
+
+from tests.unit.asset_modules import REPO_ROOT, load_asset_module
+
+metrics = load_asset_module("docker/mysql-worker/metrics.py", "worker_metrics")
+
+
+def test_one_emf_document_per_flush():
+    sink = metrics.ListSink()
+    recorder = metrics.Metrics({"db": "classicmodels", "env": "demo", "job": "db_backup"}, sink = sink)
+    with recorder.timer("DumpTime"):
+        pass
+    recorder.begin("CompressTime")
+    recorder.put("DumpBytes", 1000, "Bytes")
+    recorder.flush()
+    recorder.flush()
+
+    assert len(sink.documents) == 1
+    document = sink.documents[0]
+    directive = document["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Dimensions"] == [["db", "env", "job"]]
+    assert {metric["Name"]: metric["Unit"] for metric in directive["Metrics"]} == {
+        "CompressTime": "Milliseconds", "DumpBytes": "Bytes", "DumpTime": "Milliseconds"}
+    assert document["db"] == "classicmodels" and document["DumpBytes"] == 1000
+
+
+def test_lambda_copies_are_in_sync():
+    def code(path):
+        # Everything but the docstring note saying which file is the copy
+        with open(os.path.join(REPO_ROOT, path)) as file:
+            return [line for line in file if not line.startswith("Note: ")]
+    for module in ["metrics.py", "profiling.py"]:
+        assert code("docker/mysql-worker/" + module) == code("lambda/mysql-users/" + module)
+    assert code("docker/mysql-worker/metrics.py") == code("lambda/mysql-diagnostics/metrics.py")
@@ -0,0 +1,149 @@
+import threading
+import time
+
+import pytest
+
+from tests.unit.asset_modules import load_asset_module
+
+diagnostics = load_asset_module("lambda/mysql-diagnostics/diagnostics.py", "mysql_diagnostics")
+app = load_asset_module("lambda/mysql-diagnostics/app.py", "mysql_diagnostics_app")
+
+SETTINGS = {"db_host": "db1", "db_port": "3306", "db_user": "admin", "db_pass": "x",
+    "diagnostics": {"queries": ["processlist", "table_sizes"], "ttl_seconds": {"table_sizes": 600}}}
+
+
+class FakeConnection:
+    def __init__(self, log):
+        self.log = log
+        self.closed = False
+        self.alive = True
+
+    def cursor(self):
+        return FakeCursor(self.log)
+
+    def ping(self, reconnect = True):
+        if not self.alive:
+            raise ConnectionError("gone away")
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor:
+    def __init__(self, log):
+        self.log = log
+        self.description = [("ID",), ("TIME",)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, args = None):
+        self.log.append((query, args))
+
+    def fetchall(self):
+        return [(7, 120)]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_only_allowed_queries_run_and_results_are_cached_for_their_ttl():
+    log = []
+    clock = Clock()
+    cache = diagnostics.TtlCache(clock = clock)
+    pool = diagnostics.ConnectionPool(lambda settings: FakeConnection(log), clock = clock)
+    first = diagnostics.diagnose(cache, pool, "shop", "demo", SETTINGS, "processlist")
+    assert first["rows"] == [{"ID": 7, "TIME": 120}] and not first["cached"] and first["ttl_seconds"] == 5
+    clock.now += 4
+    assert diagnostics.diagnose(cache, pool, "shop", "demo", SETTINGS, "processlist")["cached"]
+    clock.now += 2
+    assert not diagnostics.diagnose(cache, pool, "shop", "demo", SETTINGS, "processlist")["cached"]
+    assert len(log) == 2
+    # Both queries went over the one pooled connection
+    assert pool.stats == {"opened": 1, "reused": 1, "discarded": 0}
+
+    sizes = diagnostics.diagnose(cache, pool, "shop", "demo", SETTINGS, "table_sizes")
+    assert sizes["ttl_seconds"] == 600 and log[-1][1] == {"db_name": "shop"}
+    with pytest.raises(diagnostics.UnknownQuery):
+        diagnostics.diagnose(cache, pool, "shop", "demo", SETTINGS, "lock_waits")
+    with pytest.raises(diagnostics.UnknownQuery):
+        diagnostics.diagnose(cache, pool, "shop", "demo", SETTINGS, "DROP TABLE orders")
+
+
+def test_concurrent_requests_share_one_load():
+    cache = diagnostics.TtlCache()
+    loads = []
+
+    def load():
+        loads.append(1)
+        time.sleep(0.05)
+        return "result"
+
+    results = []
+    threads = [threading.Thread(target = lambda: results.append(cache.get("key", 10, load))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+    assert sorted(cached for value, age, cached in results) == [False] + [True] * 7
+
+
+def test_pool_replaces_dead_and_old_connections():
+    clock = Clock()
+    opened = []
+
+    def connect(settings):
+        opened.append(FakeConnection([]))
+        return opened[-1]
+
+    pool = diagnostics.ConnectionPool(connect, max_age_seconds = 60, clock = clock)
+    with pool.connection(SETTINGS):
+        pass
+    opened[0].alive = False
+    with pool.connection(SETTINGS) as connection:
+        assert connection is opened[1]
+    clock.now += 61
+    with pool.connection(SETTINGS) as connection:
+        assert connection is opened[2]
+    assert opened[0].closed and opened[1].closed and pool.stats["discarded"] == 2
+
+
+def test_handler_reads_the_api_query_string():
+    event = {"httpMethod": "GET", "queryStringParameters": {"db_name": "shop"}}
+    assert app.handler(event, None)["statusCode"] == 400
+    app.cache.entries[("settings", "/serverlessops/databases/shop/demo")] = (app.cache.clock(), SETTINGS)
+    listing = app.handler({"db_name": "shop", "db_env": "demo"}, None)
+    assert listing["statusCode"] == 200 and '"processlist"' in listing["body"] and "lock_waits" not in listing["body"]
+    assert app.handler({"db_name": "shop", "db_env": "demo", "query": "lock_waits"}, None)["statusCode"] == 400
+
+
+def test_keys_layout_reads_the_optional_diagnostics_keys(monkeypatch):
+    class ParameterNotFound(Exception):
+        pass
+
+    class FakeSsm:
+        exceptions = type("exceptions", (), {"ParameterNotFound": ParameterNotFound})
+        parameters = {"/serverlessops/databases/shop/keys": "Settings for ServerlessOps DB worker task",
+            "/serverlessops/databases/shop/keys/db_host": "db", "/serverlessops/databases/shop/keys/db_port": "3306",
+            "/serverlessops/databases/shop/keys/db_user": "admin", "/serverlessops/databases/shop/keys/db_pass": "pw",
+            "/serverlessops/databases/shop/keys/diagnostics": '{"queries": ["processlist"]}',
+            "/serverlessops/databases/shop/keys/diagnostics_user": "diag"}
+
+        def get_parameter(self, Name, WithDecryption):
+            if Name not in self.parameters:
+                raise ParameterNotFound(Name)
+            return {"Parameter": {"Value": self.parameters[Name]}}
+
+    monkeypatch.setattr(app, "ssm", FakeSsm())
+    settings = app.db_settings("shop", "keys")
+    assert settings["diagnostics_user"] == "diag" and "diagnostics_pass" not in settings
+    assert list(diagnostics.allowed_queries(settings)) == ["processlist"]
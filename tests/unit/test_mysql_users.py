@@ -0,0 +1,10 @@
+from tests.unit.asset_modules import load_asset_module
+
+app = load_asset_module("lambda/mysql-users/app.py", "mysql_users_app")
+
+
+def test_init_creates_clients_but_not_the_driver():
+    # The SSM client is built once at init, pymysql waits for the first database call
+    assert app.ssm.meta.service_model.service_name == "ssm"
+    assert not hasattr(app, "pymysql")
+    assert app.mysql().__name__ == "pymysql"
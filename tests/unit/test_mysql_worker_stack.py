@@ -0,0 +1,34 @@
+import aws_cdk as core
+import aws_cdk.assertions as assertions
+from aws_cdk import aws_apigateway as api_gw, aws_ec2 as ec2, aws_ecs as ecs
+
+from aws_serverless_ops.tasks.task_ecs_mysqlworker import MySqlWorker
+
+
+def synth(**task_options):
+    app = core.App()
+    stack = core.Stack(app, "MySqlWorkerTest", env = core.Environment(account = "123456789012", region = "us-east-1"))
+    cluster = ecs.Cluster(stack, "Cluster", vpc = ec2.Vpc(stack, "Vpc", max_azs = 2, nat_gateways = 1))
+    api = api_gw.RestApi(stack, "Api")
+    MySqlWorker(stack, "MySqlWorkerTask", ops_cluster = cluster, ops_api = api, docker_path = "docker/mysql-worker", **task_options)
+    return assertions.Template.from_stack(stack)
+
+
+def test_pool_workers_may_set_their_scale_in_protection():
+    template = synth(worker_pool = {"enabled": True})
+    template.has_resource_properties("AWS::IAM::Policy", {
+        "PolicyDocument": {"Statement": assertions.Match.array_with([assertions.Match.object_like({
+            "Action": ["ecs:UpdateTaskProtection", "ecs:GetTaskProtection"],
+            "Effect": "Allow",
+        })])}
+    })
+
+
+def test_encrypted_backups_get_a_bigger_task_and_size_their_uploads_to_it():
+    template = synth(backup_encryption = {"enabled": True, "memory_mib": 1024})
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Memory": "1024",
+        "ContainerDefinitions": assertions.Match.array_with([assertions.Match.object_like({
+            "Environment": assertions.Match.array_with([{"Name": "BACKUP_STREAM_MEMORY_MB", "Value": "1024"}]),
+        })])
+    })
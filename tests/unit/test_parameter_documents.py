@@ -0,0 +1,25 @@
+import json
+
+from tests.unit.asset_modules import load_asset_module
+
+worker = load_asset_module("docker/mysql-worker/worker.py", "mysql_worker")
+
+KEYBASE = "/serverlessops/databases/classicmodels/demo"
+VALUES = {"db_host": "db.example.com", "db_port": "3306"}
+
+
+def test_document_layout_is_one_lookup(monkeypatch):
+    lookups = []
+    def get_parameter(keyname):
+        lookups.append(keyname)
+        return json.dumps(VALUES)
+    monkeypatch.setattr(worker, "get_parameter", get_parameter)
+    assert worker.get_settings(KEYBASE, ["db_host", "db_port"]) == VALUES
+    assert lookups == [KEYBASE]
+
+
+def test_falls_back_to_one_parameter_per_key(monkeypatch):
+    parameters = {KEYBASE: "Settings for ServerlessOps DB worker task"}
+    parameters.update({KEYBASE + "/" + key: value for key, value in VALUES.items()})
+    monkeypatch.setattr(worker, "get_parameter", parameters.__getitem__)
+    assert worker.get_settings(KEYBASE, ["db_host", "db_port"]) == VALUES
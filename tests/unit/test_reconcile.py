@@ -0,0 +1,68 @@
+from tests.unit.asset_modules import load_asset_module
+
+reconcile = load_asset_module("lambda/mysql-users/reconcile.py", "mysql_users_reconcile")
+
+
+class SnapshotCursor:
+    """Returns canned rows for the snapshot query"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query):
+        assert "mysql.user" in query and "TABLE_PRIVILEGES" in query
+
+    def fetchall(self):
+        return self.rows
+
+
+def current_state():
+    return reconcile.read_state(SnapshotCursor([
+        ("account", "admin", "%", "mysql_native_password", reconcile.native_password_hash("admin")),
+        ("account", "app", "%", "mysql_native_password", reconcile.native_password_hash("old")),
+        ("account", "reports", "%", "caching_sha2_password", "$A$005$salted"),
+        ("account", "legacy", "10.0.0.%", "mysql_native_password", ""),
+        ("grant", "'app'@'%'", "*.*", "USAGE", None),
+        ("grant", "'app'@'%'", "classicmodels.*", "SELECT", None),
+        ("grant", "'app'@'%'", "classicmodels.*", "DROP", None),
+        ("grant", "'reports'@'%'", "classicmodels.*", "SELECT", None),
+    ]))
+
+
+def test_snapshot_groups_grants_by_account():
+    state = current_state()
+    assert state[("app", "%")]["grants"] == {("classicmodels.*", "SELECT"), ("classicmodels.*", "DROP")}
+    assert state[("legacy", "10.0.0.%")]["grants"] == set()
+
+
+def test_only_differences_are_planned():
+    users = [
+        {"user": "app", "password": "new", "grants": [{"on": "classicmodels", "privileges": ["select", "insert"]}]},
+        {"user": "reports", "password": "same", "grants": [{"on": "classicmodels.*", "privileges": ["SELECT"]}]},
+        {"user": "etl", "host": "10.%", "password": "pw", "grants": [{"on": "classicmodels.orders", "privileges": ["SELECT"]}]},
+    ]
+    statements = reconcile.plan(current_state(), users, drop_unlisted = True, protected = ["admin"])
+    assert reconcile.describe(statements) == [
+        "ALTER USER 'app'@'%' IDENTIFIED BY '***'",
+        "REVOKE DROP ON `classicmodels`.* FROM 'app'@'%'",
+        "GRANT INSERT ON `classicmodels`.* TO 'app'@'%'",
+        "CREATE USER 'etl'@'10.%' IDENTIFIED BY '***'",
+        "GRANT SELECT ON `classicmodels`.`orders` TO 'etl'@'10.%'",
+        "DROP USER 'legacy'@'10.0.0.%'",
+    ]
+    # In sync: nothing to send
+    assert reconcile.plan(current_state(), [users[1]]) == []
+
+
+def test_wildcard_levels_survive_formatting():
+    users = [{"user": "app", "host": "10.%", "password": "pw", "grants": [{"on": "app_%", "privileges": ["SELECT"]}]}]
+    statements = reconcile.plan({}, users)
+    assert reconcile.describe(statements)[1] == "GRANT SELECT ON `app_%`.* TO 'app'@'10.%'"
+    # What mogrify does with the escaped arguments
+    sql, args = statements[1]
+    assert sql % tuple("'" + arg + "'" for arg in args) == "GRANT SELECT ON `app_%`.* TO 'app'@'10.%'"
+
+
+def test_all_expands_per_level():
+    grants = reconcile.desired_grants({"user": "x", "grants": [{"on": "db.t", "privileges": ["ALL"]}]})
+    assert grants == {("db.t", privilege) for privilege in reconcile.TABLE_ALL}
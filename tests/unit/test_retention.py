@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta, timezone
+
+from tests.unit.asset_modules import load_asset_module
+
+catalog = load_asset_module("docker/mysql-worker/catalog.py", "backup_catalog")
+retention = load_asset_module("docker/mysql-worker/retention.py", "backup_retention")
+
+START = datetime(2023, 1, 1, 3, tzinfo = timezone.utc)
+
+
+class FakeS3:
+    def __init__(self, refuse = (), fail = ()):
+        self.calls = []
+        self.refuse = set(refuse)
+        self.fail = set(fail)
+
+    def delete_objects(self, Bucket, Delete):
+        keys = [item["Key"] for item in Delete["Objects"]]
+        self.calls.append(keys)
+        if self.fail & set(keys):
+            raise RuntimeError("SlowDown")
+        return {"Errors": [{"Key": key, "Code": "AccessDenied", "Message": "no"} for key in keys if key in self.refuse]}
+
+
+def daily_backups(days):
+    store = catalog.SqliteCatalog(":memory:")
+    for day in range(days):
+        created_at = (START + timedelta(days = day)).timestamp()
+        store.put(catalog.make_entry("classicmodels", "demo", "bucket", ["backups/day" + str(day) + ".tgz"],
+            100, "sha", "tar+gzip", created_at = created_at))
+    return store
+
+
+def test_gfs_keeps_dailies_weeklies_and_monthlies():
+    entries = daily_backups(120).entries("classicmodels", "demo")
+    kept, expired = retention.split_expired(entries, retention.parse_policy({"daily": 7, "weekly": 4, "monthly": 3}))
+    kept_days = sorted((datetime.fromtimestamp(entry["created_at"], tz = timezone.utc) - START).days for entry in kept)
+    # Last 7 days, the newest backup of the last 4 ISO weeks, the newest of the last 3 months
+    assert kept_days[-7:] == list(range(113, 120))
+    assert 89 in kept_days and 58 in kept_days     # newest of March and February
+    assert len(kept) + len(expired) == 120
+    assert len(kept) < 15
+
+
+def test_no_policy_keeps_everything():
+    entries = daily_backups(10).entries("classicmodels", "demo")
+    assert retention.split_expired(entries, retention.parse_policy(None)) == (entries, [])
+
+
+def test_deletes_are_batched_and_dry_run_deletes_nothing():
+    s3 = FakeS3()
+    assert retention.delete_keys(s3, "bucket", ["k" + str(n) for n in range(2500)]) == []
+    assert [len(call) for call in s3.calls] == [1000, 1000, 500]
+
+    store = daily_backups(30)
+    report = retention.apply_retention(store, s3, "classicmodels", "demo", {"daily": 5}, dry_run = True)
+    assert report["expired"] == 25
+    assert len(report["would_delete"]["bucket"]) == 25
+    assert len(store.entries("classicmodels", "demo")) == 30
+
+
+def test_failed_deletes_stay_in_the_catalog():
+    store = daily_backups(10)
+    s3 = FakeS3(refuse = ["backups/day0.tgz"])
+    report = retention.apply_retention(store, s3, "classicmodels", "demo", '{"daily": 2}')
+    assert report["expired"] == 8
+    assert report["removed_from_catalog"] == 7
+    assert [entry["object_keys"] for entry in store.entries("classicmodels", "demo")][0] == ["backups/day0.tgz"]
+
+
+def test_a_failed_batch_keeps_only_its_backups_in_the_catalog():
+    store = daily_backups(10)
+    # day0 is in its own prefix's batch, the call fails outright
+    store.put(catalog.make_entry("classicmodels", "demo", "bucket", ["other/day0.tgz"], 100, "sha", "tar+gzip",
+        created_at = (START - timedelta(days = 1)).timestamp()))
+    s3 = FakeS3(fail = ["other/day0.tgz"])
+    report = retention.apply_retention(store, s3, "classicmodels", "demo", {"daily": 2})
+    assert report["expired"] == 9
+    assert report["removed_from_catalog"] == 8
+    assert report["errors"] == [{"bucket": "bucket", "key": "other/day0.tgz", "error": "SlowDown"}]
+    assert [entry["object_keys"] for entry in store.entries("classicmodels", "demo")][0] == ["other/day0.tgz"]
+
+
+def test_objects_reused_by_kept_backups_are_not_deleted():
+    store = catalog.SqliteCatalog(":memory:")
+    for day, keys in enumerate([["day0.data.sql.gz", "day0.tables.json"], ["day1.tables.json", "day0.data.sql.gz"],
+            ["day2.data.sql.gz", "day2.tables.json", "day0.data.sql.gz"]]):
+        store.put(catalog.make_entry("classicmodels", "demo", "bucket", keys, 100, "sha", "tables+gzip",
+            created_at = (START + timedelta(days = day)).timestamp()))
+    s3 = FakeS3()
+    report = retention.apply_retention(store, s3, "classicmodels", "demo", {"daily": 1})
+    assert report["removed_from_catalog"] == 2
+    # day0's data object is still part of the day2 backup
+    assert sorted(key for call in s3.calls for key in call) == ["day0.tables.json", "day1.tables.json"]
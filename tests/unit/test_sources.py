@@ -0,0 +1,132 @@
+from tests.unit.asset_modules import load_asset_module
+
+sources = load_asset_module("docker/mysql-worker/sources.py", "worker_sources")
+
+WRITER = "serverlessops1.cluster-czpi934xq9hf.us-east-1.rds.amazonaws.com"
+
+
+class FakeRds:
+    """An Aurora cluster with a writer and two readers, one of them still starting"""
+
+    def describe_db_clusters(self, DBClusterIdentifier):
+        assert DBClusterIdentifier == "serverlessops1"
+        return {"DBClusters": [{"DBClusterMembers": [
+            {"DBInstanceIdentifier": "writer-1", "IsClusterWriter": True},
+            {"DBInstanceIdentifier": "reader-1", "IsClusterWriter": False},
+            {"DBInstanceIdentifier": "reader-2", "IsClusterWriter": False},
+            {"DBInstanceIdentifier": "reader-3", "IsClusterWriter": False},
+        ]}]}
+
+    def describe_db_instances(self, DBInstanceIdentifier = None, Filters = None):
+        if DBInstanceIdentifier:
+            return {"DBInstances": [{"DBInstanceIdentifier": DBInstanceIdentifier, "ReadReplicaDBInstanceIdentifiers": ["reader-1"]}]}
+        instances = {
+            "reader-1": {"DBInstanceStatus": "available", "Endpoint": {"Address": "reader-1.czpi934xq9hf.us-east-1.rds.amazonaws.com"}},
+            "reader-2": {"DBInstanceStatus": "available", "Endpoint": {"Address": "reader-2.czpi934xq9hf.us-east-1.rds.amazonaws.com"}},
+            "reader-3": {"DBInstanceStatus": "creating"},
+        }
+        return {"DBInstances": [instances[name] for name in Filters[0]["Values"] if name in instances]}
+
+
+class HostCursor:
+    """A server's status and its own Aurora lag, or with lag None a MySQL replica whose replication stopped"""
+
+    def __init__(self, threads_running, lag_ms):
+        self.threads_running = threads_running
+        self.lag_ms = lag_ms
+        self.row = None
+        self.rows = None
+
+    def execute(self, query):
+        if query.startswith("SHOW GLOBAL STATUS"):
+            self.rows = [("Threads_running", str(self.threads_running)), ("Innodb_rows_read", "100")]
+        elif self.lag_ms is None:
+            if "REPLICA_HOST_STATUS" in query:
+                raise Exception("Unknown table 'REPLICA_HOST_STATUS'")
+            self.description = [("Replica_IO_State",), ("Seconds_Behind_Source",)]
+            self.row = ("", None)
+        else:
+            self.row = (self.lag_ms,)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def connector(hosts):
+    """connect(host) over a dict of host -> (threads_running, lag_ms), or an exception"""
+    def connect(host):
+        state = hosts[host]
+        if isinstance(state, Exception):
+            raise state
+
+        class Connection:
+            def cursor(self):
+                return HostCursor(*state)
+
+            def close(self):
+                pass
+        return Connection()
+    return connect
+
+
+def test_discover_aurora_readers_and_replicas():
+    assert sources.discover_readers(WRITER, FakeRds()) == [
+        "reader-1.czpi934xq9hf.us-east-1.rds.amazonaws.com", "reader-2.czpi934xq9hf.us-east-1.rds.amazonaws.com"]
+    assert sources.discover_readers("primary.czpi934xq9hf.us-east-1.rds.amazonaws.com", FakeRds()) == [
+        "reader-1.czpi934xq9hf.us-east-1.rds.amazonaws.com"]
+    assert sources.discover_readers("mysql.internal.example.com", FakeRds()) == []
+
+
+def test_least_loaded_reader_is_picked_and_exports_spread():
+    connect = connector({
+        "reader-1.czpi934xq9hf.us-east-1.rds.amazonaws.com": (12, 100),
+        "reader-2.czpi934xq9hf.us-east-1.rds.amazonaws.com": (3, 200),
+        "replica.internal": (5, 0),
+    })
+    hosts, report = sources.choose_sources(WRITER, {"mode": "auto", "hosts": ["replica.internal"]}, connect, rds = FakeRds())
+    assert hosts == ["reader-2.czpi934xq9hf.us-east-1.rds.amazonaws.com"]
+    assert report["fallback"] is None and len(report["candidates"]) == 3
+    assert "reader-2" in sources.describe(hosts, report)
+
+    hosts, _ = sources.choose_sources(WRITER, {"mode": "auto", "spread": True}, connect, rds = FakeRds(), count = 4)
+    assert hosts == ["reader-2.czpi934xq9hf.us-east-1.rds.amazonaws.com", "reader-1.czpi934xq9hf.us-east-1.rds.amazonaws.com"]
+    hosts, _ = sources.choose_sources(WRITER, '{"mode": "auto"}', connect, rds = FakeRds(), count = 4)
+    assert len(hosts) == 1
+
+
+def test_writer_by_default_and_for_dumps_recording_binlog_coordinates():
+    connect = connector({"reader-1.czpi934xq9hf.us-east-1.rds.amazonaws.com": (1, 0),
+        "reader-2.czpi934xq9hf.us-east-1.rds.amazonaws.com": (1, 0)})
+    hosts, report = sources.choose_sources(WRITER, None, connect, rds = FakeRds(), count = 4)
+    assert hosts == [WRITER] and report["fallback"] == "mode is writer"
+
+    assert sources.records_binlog("--single-transaction --master-data=2")
+    assert sources.records_binlog("--source-data=2") and not sources.records_binlog("--single-transaction")
+    hosts, report = sources.choose_sources(WRITER, {"mode": "auto"}, connect, rds = FakeRds(), writer_only = "binlog")
+    assert hosts == [WRITER] and report["fallback"] == "binlog"
+
+
+def test_lagging_broken_or_unreachable_readers_fall_back_to_the_writer():
+    connect = connector({
+        "reader-1.czpi934xq9hf.us-east-1.rds.amazonaws.com": (1, 45000),
+        "reader-2.czpi934xq9hf.us-east-1.rds.amazonaws.com": OSError("timed out"),
+        "replica.internal": (1, None),
+    })
+    hosts, report = sources.choose_sources(WRITER, {"mode": "auto", "hosts": ["replica.internal"], "max_lag_seconds": 30}, connect, rds = FakeRds())
+    assert hosts == [WRITER]
+    assert "lag under 30s" in report["fallback"]
+
+    hosts, report = sources.choose_sources(WRITER, {"mode": "writer"}, connect, rds = FakeRds())
+    assert hosts == [WRITER] and report["candidates"] == []
+    # mode hosts: only the listed ones, no discovery
+    hosts, report = sources.choose_sources(WRITER, {"mode": "hosts"}, connect, rds = FakeRds())
+    assert hosts == [WRITER] and report["fallback"] == "no readers found"
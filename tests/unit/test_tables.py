@@ -0,0 +1,115 @@
+import gzip
+import io
+
+from tests.unit.asset_modules import load_asset_module
+
+envelope = load_asset_module("docker/mysql-worker/envelope.py", "worker_envelope")
+tables = load_asset_module("docker/mysql-worker/tables.py", "worker_tables")
+
+SETTINGS = {**tables.DEFAULTS, "enabled": True, "checksum_max_mb": 1}
+SERVER = {"server": "db1:1", "started": 1700000000}
+
+
+class FakeCursor:
+    """Answers the queries fingerprint() makes, from canned rows"""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.row = None
+
+    def execute(self, query, args = None):
+        self.query = query
+        self.row = next((rows for prefix, rows in self.answers if query.startswith(prefix)), [])
+
+    def fetchone(self):
+        return self.row[0] if self.row else None
+
+    def fetchall(self):
+        return self.row
+
+
+def status(engine, size, update_time = None):
+    return {"table": "orders", "engine": engine, "update_time": update_time, "bytes": size}
+
+
+def test_fingerprint_uses_the_cheapest_signal_per_engine():
+    cursor = FakeCursor([("CHECKSUM TABLE `shop`.`orders` QUICK", [("shop.orders", 42)]),
+        ("CHECKSUM TABLE", [("shop.orders", 7)]), ("SELECT COUNT(*)", [(10, 99)]),
+        ("SELECT COLUMN_NAME", [("id", "int", "int", "PRI", 10, 0)])])
+    assert tables.fingerprint(cursor, "shop", status("myisam", 10 ** 9), SETTINGS, SERVER) == {"method": "live_checksum", "value": "42"}
+    assert tables.fingerprint(cursor, "shop", status("innodb", 1000), SETTINGS, SERVER) == {"method": "checksum", "value": "7"}
+    # Too big to checksum: the update time, or the row count and highest key, both only valid on the same server
+    large = tables.fingerprint(cursor, "shop", status("innodb", 10 ** 9, "2024-01-01 00:00:00"), SETTINGS, SERVER)
+    assert large == {"method": "update_time", "value": "2024-01-01 00:00:00", **SERVER}
+    # Count + max key misses UPDATEs, so it's only for tables declared append-only
+    assert tables.fingerprint(cursor, "shop", status("innodb", 10 ** 9), SETTINGS, SERVER) is None
+    append_only = {**SETTINGS, "append_only": ["orders"]}
+    assert tables.fingerprint(cursor, "shop", status("innodb", 10 ** 9), append_only, SERVER)["value"] == [10, 99]
+    keyless = FakeCursor([("SELECT COLUMN_NAME", [("code", "varchar", "varchar(8)", "PRI", None, None)])])
+    assert tables.fingerprint(keyless, "shop", status("innodb", 10 ** 9), append_only, SERVER) is None
+
+
+def test_fingerprints_see_fresh_update_times_and_column_changes():
+    def fingerprints(column_type):
+        cursor = FakeCursor([("SELECT @@hostname", [("db1", 1, 1700000600)]), ("SHOW GLOBAL STATUS", [("Uptime", 600)]),
+            ("SELECT TABLE_NAME, COLUMN_NAME", [("orders", "id", 1, "int", "NO", None, ""), ("orders", "note", 2, column_type, "YES", None, "")]),
+            ("SELECT TABLE_NAME, ENGINE", [("orders", "InnoDB", "2024-01-01 00:00:00", 10 ** 9)])])
+        queries = []
+        execute = cursor.execute
+        cursor.execute = lambda query, args = None: queries.append(query) or execute(query, args)
+        return tables.fingerprint_tables(cursor, "shop", SETTINGS), queries
+
+    before, queries = fingerprints("varchar(8)")
+    assert queries.index("SET SESSION information_schema_stats_expiry = 0") < queries.index(next(q for q in queries if "TABLES" in q))
+    after, queries = fingerprints("varchar(16)")
+    # Same data signal, different columns: an instant ALTER still means a dump
+    assert before["orders"]["value"] == after["orders"]["value"] and before["orders"] != after["orders"]
+
+
+def test_plan_reuses_only_unchanged_tables_until_the_next_full():
+    now = 1700000000
+    fingerprints = {"a": {"method": "checksum", "value": "1"}, "b": {"method": "checksum", "value": "2"}, "c": None}
+    previous = {"full_at": now - 86400, "tables": {
+        "a": {"fingerprint": {"method": "checksum", "value": "1"}, "object": "old.data.sql.gz"},
+        "b": {"fingerprint": {"method": "checksum", "value": "1"}, "object": "old.data.sql.gz"},
+        "c": {"fingerprint": None, "object": "old.data.sql.gz"}}}
+    backup_plan = tables.plan(fingerprints, previous, SETTINGS, now)
+    assert backup_plan["dump"] == ["b", "c"] and list(backup_plan["reuse"]) == ["a"] and not backup_plan["full"]
+    assert tables.plan(fingerprints, previous, SETTINGS, now + 7 * 86400)["dump"] == ["a", "b", "c"]
+    assert tables.plan(fingerprints, None, SETTINGS, now)["full"]
+
+
+def gz(text):
+    return gzip.compress(text.encode())
+
+
+def data_dump(rows):
+    sections = "".join("--\n-- Dumping data for table `" + table + "`\n--\n\nINSERT INTO `" + table + "` VALUES " + values + ";\n"
+        for table, values in rows)
+    return "/*!40101 SET NAMES utf8mb4 */;\n" + sections + "/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;\n-- Dump completed\n"
+
+
+def test_restore_takes_each_table_from_the_object_holding_it():
+    s3 = envelope.LocalS3(keep = False)
+    s3.put_object(Bucket = "b", Key = "old.data.sql.gz", Body = gz(data_dump([("a", "(1)"), ("b", "(1)")])))
+    s3.put_object(Bucket = "b", Key = "new.schema.sql.gz", Body = gz("CREATE TABLE `a` (id int);\nCREATE TABLE `b` (id int);\n"))
+    s3.put_object(Bucket = "b", Key = "new.data.sql.gz", Body = gz(data_dump([("b", "(2)")])))
+    s3.put_object(Bucket = "b", Key = "new.triggers.sql.gz", Body = gz("CREATE TRIGGER `a_audit` AFTER INSERT ON `a` FOR EACH ROW SET @n = 1;\n"))
+    fingerprints = {"a": {"method": "checksum", "value": "1"}, "b": {"method": "checksum", "value": "2"}}
+    previous = {"full_at": 1, "objects": {"old.data.sql.gz": {"sha256": "x", "bytes": 1, "backup": "old"}},
+        "tables": {table: {"fingerprint": {"method": "checksum", "value": "1"}, "object": "old.data.sql.gz"} for table in "ab"}}
+    backup_plan = tables.plan(fingerprints, previous, SETTINGS, 2)
+    manifest = tables.build_manifest("shop", "new", backup_plan, fingerprints, {"key": "new.schema.sql.gz", "sha256": "s", "bytes": 1},
+        {"key": "new.data.sql.gz", "sha256": "d", "bytes": 1}, previous, 2, triggers = {"key": "new.triggers.sql.gz", "sha256": "t", "bytes": 1})
+    assert manifest["tables"]["a"] == {"fingerprint": fingerprints["a"], "object": "old.data.sql.gz", "reused": True}
+    assert sorted(manifest["objects"]) == ["new.data.sql.gz", "old.data.sql.gz"] and manifest["full_at"] == 1
+
+    script = io.BytesIO()
+    tables.combine(manifest, lambda key: s3.get_object(Bucket = "b", Key = key)["Body"], script.write)
+    text = script.getvalue().decode()
+    assert text.startswith("CREATE TABLE `a`")
+    # The old object's copy of b is left out, only the new one is restored
+    assert "INSERT INTO `a` VALUES (1)" in text and "INSERT INTO `b` VALUES (2)" in text
+    assert "INSERT INTO `b` VALUES (1)" not in text
+    # Triggers come after every table's rows, so restoring them doesn't fire them
+    assert text.index("CREATE TRIGGER") > text.index("INSERT INTO `b` VALUES (2)")
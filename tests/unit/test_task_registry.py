@@ -0,0 +1,59 @@
+import pytest
+
+from aws_serverless_ops import task_registry
+from aws_serverless_ops.task_registry import TaskRegistry, pack_tasks, task_specs
+
+
+def test_pack_tasks_stays_under_budget():
+    estimates = {"task" + str(n): 30 for n in range(40)}
+    shards = pack_tasks(estimates, max_resources = 400)
+    assert sorted(name for shard in shards for name in shard) == sorted(estimates)
+    assert all(sum(estimates[name] for name in shard) <= 400 for shard in shards)
+    assert len(shards) == 4
+
+
+def test_pack_tasks_is_stable_and_respects_pins():
+    estimates = {"big": 300, "medium": 150, "small": 50, "pinned": 10}
+    shards = pack_tasks(estimates, max_resources = 400, pinned = {"pinned": 1})
+    assert shards == pack_tasks(dict(reversed(list(estimates.items()))), max_resources = 400, pinned = {"pinned": 1})
+    assert "pinned" in shards[1]
+
+
+def test_oversized_task_gets_its_own_shard():
+    shards = pack_tasks({"huge": 600, "small": 5}, max_resources = 400)
+    assert ["huge"] in shards
+
+
+def test_task_specs_skip_disabled_and_non_task_entries():
+    specs = task_specs({
+        "fargate": {"worker": {"module": "m", "class": "C", "name": "Worker"}},
+        "lambda": {"off": {"module": "m", "class": "C", "name": "Off", "enabled": False}, "notes": "x"},
+    })
+    assert [spec["name"] for spec in specs] == ["Worker"]
+
+
+def test_unknown_task_module_names_the_settings_entry():
+    registry = TaskRegistry({"fargate": {"worker": {"module": "no.such.module", "class": "C", "name": "Worker"}}})
+    with pytest.raises(ValueError, match="fargate: worker"):
+        registry.plan()
+
+
+
+class FixedSizeTask:
+    @staticmethod
+    def estimate_resources(task_settings):
+        return 10
+
+
+def test_tasks_keep_their_own_stack_unless_sharded(monkeypatch):
+    monkeypatch.setattr(task_registry, "load_task_class", lambda spec: FixedSizeTask)
+    registry = TaskRegistry({"fargate": {
+        "worker": {"module": "m", "class": "C", "name": "Worker"},
+        "packed": {"module": "m", "class": "C", "name": "Packed", "shard": "auto"},
+        "pinned": {"module": "m", "class": "C", "name": "Pinned", "shard": 1},
+    }})
+    own, shards = registry.plan()
+    assert own == ["Worker"]
+    assert shards == [["Packed"], ["Pinned"]]
+    with pytest.raises(ValueError, match="fargate: worker"):
+        TaskRegistry({"fargate": {"worker": {"module": "m", "class": "C", "name": "Worker", "shard": "first"}}}).plan()
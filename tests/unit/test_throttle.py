@@ -0,0 +1,90 @@
+import io
+import os
+import tempfile
+import threading
+
+from tests.unit.asset_modules import load_asset_module
+
+throttle = load_asset_module("docker/mysql-worker/throttle.py", "worker_throttle")
+
+SETTINGS = {**throttle.DEFAULTS, "max_threads_running": 20, "max_replica_lag_seconds": 10, "max_rows_read_per_second": 1000,
+    "max_rate_mb": 100, "min_rate_mb": 5, "start_level": 0.5}
+
+
+class StatusCursor:
+    """SHOW GLOBAL STATUS and SHOW REPLICA STATUS answers, as a MySQL replica gives them"""
+
+    def __init__(self, threads_running, rows_read, lag):
+        self.status = [("Threads_running", str(threads_running)), ("Innodb_rows_read", str(rows_read))]
+        self.lag = lag
+        self.description = None
+        self.row = None
+
+    def execute(self, query):
+        if "REPLICA_HOST_STATUS" in query:
+            raise Exception("Unknown table 'REPLICA_HOST_STATUS'")
+        self.description = [("Replica_IO_State",), ("Seconds_Behind_Source",)]
+        self.row = ("Waiting for source", self.lag)
+
+    def fetchall(self):
+        return self.status
+
+    def fetchone(self):
+        return self.row
+
+
+def test_signals_fall_back_to_the_hosts_own_replica_status():
+    assert throttle.read_signals(StatusCursor(7, 12345, 3)) == {"threads_running": 7, "rows_read": 12345, "replica_lag": 3.0}
+
+
+def test_controller_backs_off_fast_and_recovers_slowly():
+    controller = throttle.Controller(SETTINGS)
+    calm = lambda rows: {"threads_running": 5, "rows_read": rows, "replica_lag": 0}
+    assert controller.update(calm(0), 0) == [] and controller.level == 0.6
+    # 10000 rows in 5 seconds is over the 1000/s limit
+    assert controller.update(calm(10000), 5) == ["rows_read_per_second"] and controller.level == 0.3
+    assert controller.update({"threads_running": 50, "rows_read": 10000, "replica_lag": 60}, 10) == ["threads_running", "replica_lag"]
+    assert controller.update({"threads_running": 50, "rows_read": 10000, "replica_lag": None}, 15) == ["threads_running"]
+    controller.update({"threads_running": 50}, 20)
+    # Never below min_rate_mb
+    assert controller.level == 0.05 and controller.rate() == 5 * 1024 * 1024
+    for second in range(25, 125, 5):
+        controller.update(calm(10000), second)
+    assert controller.level == 1.0 and controller.concurrency(4) == 4
+
+
+def test_monitor_drives_the_gate_and_rate_file():
+    with tempfile.TemporaryDirectory() as directory:
+        rate_file = os.path.join(directory, "db.rate")
+        gate = throttle.Gate(4)
+        monitor = throttle.Monitor(None, SETTINGS, rate_file = rate_file, gate = gate, threads = 4, clock = lambda: 0)
+        assert gate.limit == 2 and throttle.read_rate(rate_file, 0) == 50 * 1024 * 1024
+        monitor.sample(StatusCursor(40, 0, 0))
+        assert gate.limit == 1 and throttle.read_rate(rate_file, 0) == 25 * 1024 * 1024
+
+
+def test_gate_limit_changes_apply_to_waiters():
+    gate = throttle.Gate(1)
+    entered = []
+    gate.__enter__()
+    waiter = threading.Thread(target = lambda: (gate.__enter__(), entered.append(True)))
+    waiter.start()
+    waiter.join(0.1)
+    assert not entered
+    gate.set_limit(2)
+    waiter.join(1)
+    assert entered
+
+
+def test_relay_paces_to_the_rate_file():
+    with tempfile.TemporaryDirectory() as directory:
+        rate_file = os.path.join(directory, "db.rate")
+        throttle.write_rate(rate_file, 100 * 1024)
+        now = [0.0]
+        sleep = lambda seconds: now.__setitem__(0, now[0] + seconds)
+        sink = io.BytesIO()
+        data = os.urandom(1024 * 1024)
+        assert throttle.relay(rate_file, source = io.BytesIO(data), sink = sink, clock = lambda: now[0], sleep = sleep) == len(data)
+        assert sink.getvalue() == data
+        # 1MB at 100KB/s
+        assert 9.5 <= now[0] <= 10.5
@@ -0,0 +1,72 @@
+import os
+import sys
+import tempfile
+
+from tests.unit.asset_modules import load_asset_module
+
+pool = load_asset_module("docker/mysql-worker/pool.py", "worker_pool")
+
+
+class RecordingSfn:
+    def __init__(self, answered = ()):
+        self.heartbeats = []
+        self.failures = []
+        self.answered = set(answered)
+
+    def send_task_heartbeat(self, taskToken):
+        self.heartbeats.append(taskToken)
+
+    def send_task_failure(self, taskToken, error, cause):
+        if taskToken in self.answered:
+            error = Exception("Task already answered")
+            error.response = {"Error": {"Code": "TaskTimedOut"}}
+            raise error
+        self.failures.append((taskToken, error))
+
+
+def test_job_environment_matches_the_container_overrides():
+    job = {"task_token": "token-1", "job_name": "db_backup",
+        "job_options": {"db_name": "classicmodels", "db_env": "demo", "db_host": "", "profile": "cpu"}}
+    env = pool.job_environment(job, base = {"DB_HOST": "stale", "PATH": "/bin"})
+    assert env == {"PATH": "/bin", "TASK_TOKEN_ENV_VARIABLE": "token-1", "JOB_NAME": "db_backup",
+        "DB_NAME": "classicmodels", "DB_ENV": "demo", "PROFILE": "cpu"}
+
+
+def test_pool_runs_queued_jobs_and_heartbeats_long_ones():
+    with tempfile.TemporaryDirectory() as directory:
+        # Stand-in for worker.py: records which job it ran, slow enough to need a heartbeat
+        script = ("import os, time; time.sleep(0.3); "
+            "open(os.path.join(" + repr(directory) + ", os.environ['JOB_NAME']), 'w').write(os.environ['DB_NAME'])")
+        queue = pool.LocalQueue()
+        sfn = RecordingSfn()
+        protection = []
+        workers = pool.Pool(queue, jobs_per_worker = 2, command = [sys.executable, "-c", script], sfn = sfn,
+            wait_seconds = 0.1, heartbeat_seconds = 0.1, protect = protection.append)
+        queue.send({"task_token": "t1", "job_name": "db_backup", "job_options": {"db_name": "one"}})
+        queue.send({"task_token": "t2", "job_name": "db_export", "job_options": {"db_name": "two"}})
+
+        for thread in workers.poll():
+            thread.join()
+
+        assert open(os.path.join(directory, "db_backup")).read() == "one"
+        assert open(os.path.join(directory, "db_export")).read() == "two"
+    assert len(queue.deleted) == 2 and workers.completed == 2 and not workers.running
+    assert {"t1", "t2"} <= set(sfn.heartbeats)
+    assert protection == [True, False]
+
+
+def test_jobs_that_die_get_their_token_failed():
+    queue = pool.LocalQueue()
+    sfn = RecordingSfn(answered = ["reported"])
+    workers = pool.Pool(queue, command = [sys.executable, "-c", "import sys; sys.exit(3)"], sfn = sfn,
+        wait_seconds = 0.1, protect = lambda enabled: None)
+    queue.send({"task_token": "crashed", "job_name": "db_backup", "job_options": {}})
+    for thread in workers.poll():
+        thread.join()
+    assert sfn.failures == [("crashed", "WorkerExited")]
+
+    # A job that reported its failure itself: the token is already answered, nothing more to do
+    queue.send({"task_token": "reported", "job_name": "db_backup", "job_options": {}})
+    for thread in workers.poll():
+        thread.join()
+    assert len(sfn.failures) == 1 and len(queue.deleted) == 2